@@ -0,0 +1,44 @@
+"""
+Precompute the stop word list and lemma lookup table used by text_normalizer.
+
+Every distinct token of the training descriptions is lemmatized once with spaCy
+(pl_core_news_md) and the token -> lemma pairs that differ are written, together with
+spaCy's Polish stop words, to cloud function/normalizer_table.json.
+
+Run from the ML directory, next to data.csv and data2.csv, before training with NORMALIZE_TEXT=1:
+    python build_normalizer_table.py
+
+The file is only ever written by this script, so the table always matches the corpus and the spaCy
+model it was built from. Commit it together with the model trained on it.
+"""
+
+import json
+
+from tfidfvectorizermodel import load_corpus, get_nlp, BATCH_SIZE
+from text_normalizer import TextNormalizer, DEFAULT_TABLE_PATH
+
+if __name__ == "__main__":
+    merged_df = load_corpus()
+
+    tokenizer = TextNormalizer()
+    tokens = set()
+    for text in merged_df['counter_party_name'].astype(str):
+        tokens.update(tokenizer.tokens(text))
+    tokens = sorted(tokens)
+    print('distinct tokens', len(tokens))
+
+    nlp = get_nlp()
+    lemmas = {}
+    for token, doc in zip(tokens, nlp.pipe(tokens, batch_size=BATCH_SIZE)):
+        if len(doc) != 1:
+            continue
+        lemma = doc[0].lemma_.casefold()
+        if lemma and lemma != token:
+            lemmas[token] = lemma
+
+    table = {'stop_words': sorted(nlp.Defaults.stop_words), 'lemmas': lemmas}
+    with open(DEFAULT_TABLE_PATH, 'w', encoding='utf8') as table_file:
+        json.dump(table, table_file, ensure_ascii=False, indent=1, sort_keys=True)
+        table_file.write('\n')
+
+    print('stop words', len(table['stop_words']), 'lemmas', len(lemmas), '->', DEFAULT_TABLE_PATH)
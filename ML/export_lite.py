@@ -0,0 +1,177 @@
+"""
+Export of the compact "lite" serving artifact.
+
+Usage:
+    python export_lite.py [--teacher random_forest.joblib] [--vocab 5000] [--output lite_model.bin]
+                          [--report lite_report.json] [--no-distill]
+
+A LogisticRegression over a CountVectorizer limited to the --vocab most frequent tokens and the scaled
+amount is distilled from the full model: it is trained on the predictions of the teacher (the joblib
+pipeline given with --teacher, or a build_pipeline() model trained here) instead of the original labels,
+so it reproduces the served behaviour. With --no-distill it is trained on the labels.
+
+Texts are prepared with preprocess_corpus(), i.e. in the format assign_category() passes to the model at
+serving time (NORMALIZE_TEXT), and the format is recorded in the lite artifact, so the model cache refuses
+it when the Cloud Function runs with the other setting. A --teacher trained on the other format is refused
+too. The student is written in the format of cloud function/lite_model.py; upload it as the model blob and
+the model cache of the Cloud Function memory-maps it instead of unpickling a forest. The report compares
+both models on the test split: file size, load time, per-row latency, accuracy and agreement with the
+teacher.
+"""
+
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.compose import ColumnTransformer
+from sklearn.preprocessing import StandardScaler
+from sklearn.metrics import accuracy_score, f1_score
+import numpy as np
+import joblib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from tfidfvectorizermodel import load_corpus, preprocess_corpus, build_features, build_pipeline, split, tag_text_format
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud function'))
+from lite_model import LiteModel
+from text_normalizer import check_text_format, text_format
+
+VOCAB_SIZE = 5000
+LOAD_RUNS = 5
+SINGLE_ROWS = 200
+
+
+def build_student(vocab_size=VOCAB_SIZE):
+    preprocessor = ColumnTransformer(
+        transformers=[
+            ('text', CountVectorizer(max_features=vocab_size, dtype=np.float32), 'preprocessed_text'),
+            ('numeric', StandardScaler(), ['amount'])
+        ])
+
+    return Pipeline([
+        ('preprocessor', preprocessor),
+        ('classifier', LogisticRegression(max_iter=2000, C=10.0))
+    ])
+
+
+def to_lite(student):
+    """
+    Convert a fitted build_student() pipeline to a LiteModel.
+    """
+    preprocessor = student.named_steps['preprocessor']
+    vectorizer = preprocessor.named_transformers_['text']
+    scaler = preprocessor.named_transformers_['numeric']
+    classifier = student.named_steps['classifier']
+
+    coef, intercepts = classifier.coef_, classifier.intercept_
+    if coef.shape[0] == 1:
+        # Dla dwóch klas LogisticRegression trzyma jeden wektor wag
+        coef, intercepts = np.vstack([-coef / 2, coef / 2]), np.array([-intercepts[0] / 2, intercepts[0] / 2])
+
+    return LiteModel(
+        vocabulary={token: int(index) for token, index in vectorizer.vocabulary_.items()},
+        weights=coef.T.astype(np.float32),
+        intercepts=intercepts.astype(np.float32),
+        classes=classifier.classes_.tolist(),
+        amount_mean=float(scaler.mean_[0]),
+        amount_scale=float(scaler.scale_[0]),
+        token_pattern=vectorizer.token_pattern,
+        lowercase=vectorizer.lowercase,
+        text_format=text_format(),
+    )
+
+
+def median_load_seconds(load, path, runs=LOAD_RUNS):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        load(path)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def measure(model, path, load, X_test, y_test, teacher_pred):
+    start = time.perf_counter()
+    y_pred = model.predict(X_test)
+    batch_ms = (time.perf_counter() - start) * 1000 / len(X_test)
+
+    single = []
+    for position in range(min(SINGLE_ROWS, len(X_test))):
+        row = X_test.iloc[[position]]
+        start = time.perf_counter()
+        model.predict(row)
+        single.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'size_mb': round(os.path.getsize(path) / 1024 ** 2, 3),
+        'load_ms': round(median_load_seconds(load, path) * 1000, 2),
+        'batch_ms_per_row': round(batch_ms, 4),
+        'single_p50_ms': round(float(np.percentile(single, 50)), 3),
+        'accuracy': round(accuracy_score(y_test, y_pred), 4),
+        'f1_macro': round(f1_score(y_test, y_pred, average='macro'), 4),
+        'agreement_with_full': round(float(np.mean(y_pred == teacher_pred)), 4),
+    }
+
+
+def export(df2, teacher_path=None, vocab_size=VOCAB_SIZE, output='lite_model.bin', distill=True):
+    """
+    Train (or load) the teacher, distill the lite model and compare the two.
+
+    Returns:
+        dict: Report with 'full' and 'lite' entries.
+    """
+    X_train, X_test, y_train, y_test = split(df2)
+
+    if teacher_path:
+        teacher = joblib.load(teacher_path)
+        # Nauczyciel musi widzieć ten sam format tekstu co uczeń i model w Cloud Function
+        check_text_format(teacher, teacher_path)
+    else:
+        teacher = build_pipeline().fit(X_train, y_train)
+        teacher_path = os.path.join(tempfile.mkdtemp(), 'random_forest.joblib')
+        joblib.dump(tag_text_format(teacher), teacher_path)
+
+    student = build_student(vocab_size)
+    targets = teacher.predict(X_train) if distill else y_train
+    start = time.perf_counter()
+    student.fit(X_train, targets)
+    print('student trained in {:.1f}s'.format(time.perf_counter() - start))
+
+    lite = to_lite(student)
+    lite.save(output)
+    parity = float(np.mean(lite.predict(X_test) == student.predict(X_test)))
+    print('lite model written to {}, parity with the sklearn student {:.4f}'.format(output, parity))
+
+    teacher_pred = teacher.predict(X_test)
+    report = {
+        'full': measure(teacher, teacher_path, joblib.load, X_test, y_test, teacher_pred),
+        'lite': measure(LiteModel.load(output), output, LiteModel.load, X_test, y_test, teacher_pred),
+        'vocabulary': len(lite.vocabulary),
+        'distilled': distill,
+        'text_format': lite.text_format,
+    }
+    return report
+
+
+def print_report(report):
+    print("{:<22} {:>12} {:>12}".format('', 'full', 'lite'))
+    for metric in report['full']:
+        print("{:<22} {:>12} {:>12}".format(metric, report['full'][metric], report['lite'][metric]))
+
+
+if __name__ == "__main__":
+    teacher_path = sys.argv[sys.argv.index('--teacher') + 1] if '--teacher' in sys.argv else None
+    vocab_size = int(sys.argv[sys.argv.index('--vocab') + 1]) if '--vocab' in sys.argv else VOCAB_SIZE
+    output = sys.argv[sys.argv.index('--output') + 1] if '--output' in sys.argv else 'lite_model.bin'
+    report_path = sys.argv[sys.argv.index('--report') + 1] if '--report' in sys.argv else 'lite_report.json'
+
+    merged_df = load_corpus()
+    merged_df['preprocessed_text'] = preprocess_corpus(merged_df['counter_party_name'].astype(str).tolist())
+    report = export(build_features(merged_df), teacher_path, vocab_size, output,
+                    distill='--no-distill' not in sys.argv)
+    print_report(report)
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
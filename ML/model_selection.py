@@ -0,0 +1,218 @@
+"""
+Model selection for the transaction categorization pipeline.
+
+Usage:
+    python model_selection.py [--output DIR] [--top N]
+    (or python tfidfvectorizermodel.py --select)
+
+The vectorizer (CountVectorizer / TfidfVectorizer, n-grams, min_df) and the classifier
+(RandomForestClassifier / LogisticRegression and their settings) are chosen with successive halving:
+all candidates are cross-validated on a small part of the training set, and only the best third goes
+on to the next round with three times more rows. Folds and candidates run on all cores (n_jobs=-1).
+
+The pipeline is built with memory=<cache dir>, so the fitted ColumnTransformer of a given
+vectorizer setting and fold is computed once and reused by every classifier tried with it.
+
+Artifacts written to the output directory:
+    selected_pipeline.joblib: the best pipeline refitted on the whole training set, without the cache.
+    leaderboard.csv / leaderboard.json: the top candidates refitted on the training set with their
+        CV score, test accuracy and macro F1, serialized size and prediction latency.
+    cv_results.csv: the full successive-halving results.
+"""
+
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 (włącza HalvingGridSearchCV)
+from sklearn.model_selection import HalvingGridSearchCV, StratifiedKFold
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.compose import ColumnTransformer
+from sklearn.preprocessing import StandardScaler
+from sklearn.metrics import accuracy_score, f1_score
+from io import BytesIO
+import pandas as pd
+import numpy as np
+import joblib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from tfidfvectorizermodel import load_corpus, preprocess_corpus, build_features, split, tag_text_format
+
+OUTPUT_DIR = os.environ.get("MODEL_SELECTION_DIR", "model_selection")
+CACHE_DIR = os.environ.get("MODEL_SELECTION_CACHE", os.path.join(tempfile.gettempdir(), "model_selection_cache"))
+TOP_CANDIDATES = 5
+CV_FOLDS = 5
+SCORING = 'f1_macro'
+
+# Ustawienia wektoryzatora są wspólne dla obu klasyfikatorów, więc ich dopasowanie trafia do cache
+VECTORIZER_GRID = {
+    'preprocessor__text': [CountVectorizer(), TfidfVectorizer(sublinear_tf=True)],
+    'preprocessor__text__ngram_range': [(1, 1), (1, 2)],
+    'preprocessor__text__min_df': [1, 2],
+}
+PARAM_GRID = [
+    dict(VECTORIZER_GRID, **{
+        'classifier': [RandomForestClassifier(random_state=2024)],
+        'classifier__n_estimators': [100, 300],
+        'classifier__max_depth': [None, 40],
+    }),
+    dict(VECTORIZER_GRID, **{
+        'classifier': [LogisticRegression(max_iter=2000)],
+        'classifier__C': [1.0, 10.0],
+    }),
+]
+
+
+def build_search_pipeline(memory=None):
+    """
+    Pipeline with the same steps as build_pipeline(); the vectorizer and the classifier are replaced
+    by the parameter grid.
+    """
+    preprocessor = ColumnTransformer(
+        transformers=[
+            ('text', CountVectorizer(), 'preprocessed_text'),
+            ('numeric', StandardScaler(), ['amount'])
+        ])
+
+    return Pipeline([
+        ('preprocessor', preprocessor),
+        ('classifier', RandomForestClassifier())
+    ], memory=memory)
+
+
+def search(X_train, y_train, cache_dir=CACHE_DIR, n_jobs=-1, cv_folds=CV_FOLDS):
+    """
+    Run the successive-halving search.
+
+    Returns:
+        HalvingGridSearchCV: The fitted search; best_estimator_ is refitted on the whole training set.
+    """
+    cv = StratifiedKFold(n_splits=cv_folds, shuffle=True, random_state=2024)
+    # Najmniejsza porcja danych musi mieć przykład każdej klasy w każdym foldzie
+    min_resources = max(cv_folds * y_train.nunique() * 2, min(len(y_train), 500))
+    halving = HalvingGridSearchCV(
+        build_search_pipeline(memory=cache_dir),
+        PARAM_GRID,
+        factor=3,
+        resource='n_samples',
+        min_resources=min(min_resources, len(y_train)),
+        cv=cv,
+        scoring=SCORING,
+        n_jobs=n_jobs,
+        refit=True,
+        random_state=2024,
+        verbose=1,
+    )
+    start = time.perf_counter()
+    halving.fit(X_train, y_train)
+    print('search: {} candidates, {} iterations in {:.1f}s, best {} = {:.4f}'.format(
+        len(halving.cv_results_['params']), halving.n_iterations_, time.perf_counter() - start,
+        SCORING, halving.best_score_))
+    return halving
+
+
+def describe_params(params):
+    described = {}
+    for name, value in params.items():
+        if name in ('preprocessor__text', 'classifier'):
+            value = type(value).__name__
+        elif isinstance(value, tuple):
+            value = list(value)
+        described[name] = value
+    return described
+
+
+def model_size(model):
+    buffer = BytesIO()
+    joblib.dump(model, buffer)
+    return buffer.getbuffer().nbytes
+
+
+def prediction_latency(model, X_test, single_rows=200):
+    """
+        Return the per-row latency of a batch prediction and the p50/p95 latency of one-row predictions, in ms.
+    """
+    start = time.perf_counter()
+    model.predict(X_test)
+    batch_ms = (time.perf_counter() - start) * 1000 / len(X_test)
+
+    timings = []
+    for position in range(min(single_rows, len(X_test))):
+        row = X_test.iloc[[position]]
+        start = time.perf_counter()
+        model.predict(row)
+        timings.append((time.perf_counter() - start) * 1000)
+    return batch_ms, float(np.percentile(timings, 50)), float(np.percentile(timings, 95))
+
+
+def leaderboard(halving, X_train, y_train, X_test, y_test, top=TOP_CANDIDATES, cache_dir=CACHE_DIR):
+    """
+    Refit the best candidates of the last halving round and measure accuracy, size and latency.
+
+    Returns:
+        pandas.DataFrame: One row per candidate, sorted by the CV score.
+    """
+    results = pd.DataFrame(halving.cv_results_)
+    last_round = results[results['iter'] == results['iter'].max()]
+    candidates = last_round.sort_values('mean_test_score', ascending=False).head(top)
+
+    rows = []
+    for _, candidate in candidates.iterrows():
+        model = build_search_pipeline(memory=cache_dir).set_params(**candidate['params'])
+        start = time.perf_counter()
+        model.fit(X_train, y_train)
+        fit_seconds = time.perf_counter() - start
+        y_pred = model.predict(X_test)
+        model.set_params(memory=None)
+        batch_ms, single_p50_ms, single_p95_ms = prediction_latency(model, X_test)
+        rows.append({
+            'params': json.dumps(describe_params(candidate['params'])),
+            'cv_' + SCORING: round(candidate['mean_test_score'], 4),
+            'cv_std': round(candidate['std_test_score'], 4),
+            'test_accuracy': round(accuracy_score(y_test, y_pred), 4),
+            'test_f1_macro': round(f1_score(y_test, y_pred, average='macro'), 4),
+            'size_mb': round(model_size(model) / 1024 ** 2, 2),
+            'fit_seconds': round(fit_seconds, 2),
+            'batch_ms_per_row': round(batch_ms, 4),
+            'single_p50_ms': round(single_p50_ms, 3),
+            'single_p95_ms': round(single_p95_ms, 3),
+        })
+    return pd.DataFrame(rows)
+
+
+def write_artifacts(halving, board, output_dir=OUTPUT_DIR):
+    os.makedirs(output_dir, exist_ok=True)
+    best = halving.best_estimator_
+    # Model do wdrożenia nie może wskazywać na lokalny katalog cache
+    best.set_params(memory=None)
+    joblib.dump(tag_text_format(best), os.path.join(output_dir, 'selected_pipeline.joblib'))
+    board.to_csv(os.path.join(output_dir, 'leaderboard.csv'), index=False)
+    board.to_json(os.path.join(output_dir, 'leaderboard.json'), orient='records', indent=2)
+    cv_results = pd.DataFrame(halving.cv_results_)
+    cv_results['params'] = cv_results['params'].map(lambda params: json.dumps(describe_params(params)))
+    cv_results.drop(columns=[column for column in cv_results.columns if column.startswith('param_')]) \
+        .to_csv(os.path.join(output_dir, 'cv_results.csv'), index=False)
+    print('artifacts written to', output_dir)
+
+
+def run_selection(output_dir=OUTPUT_DIR, top=TOP_CANDIDATES, df2=None):
+    if df2 is None:
+        merged_df = load_corpus()
+        merged_df['preprocessed_text'] = preprocess_corpus(merged_df['counter_party_name'].astype(str).tolist())
+        df2 = build_features(merged_df)
+
+    X_train, X_test, y_train, y_test = split(df2)
+    halving = search(X_train, y_train)
+    board = leaderboard(halving, X_train, y_train, X_test, y_test, top=top)
+    print(board.to_string(index=False))
+    write_artifacts(halving, board, output_dir)
+    return halving, board
+
+
+if __name__ == "__main__":
+    output_dir = sys.argv[sys.argv.index('--output') + 1] if '--output' in sys.argv else OUTPUT_DIR
+    top = int(sys.argv[sys.argv.index('--top') + 1]) if '--top' in sys.argv else TOP_CANDIDATES
+    run_selection(output_dir, top)
@@ -0,0 +1,214 @@
+"""
+Incrementally trained variant of the categorization model.
+
+Usage:
+    python online_model.py init [--epochs N] [--publish]
+    python online_model.py update corrections.csv [--passes N] [--publish]
+
+Both steps of the pipeline are stateless: the description is hashed with HashingVectorizer and the amount
+is squashed with arcsinh, so no vocabulary or scaler has to be refitted when new transactions arrive.
+The classifier is an SGDClassifier trained with partial_fit, so newly labelled or corrected transactions
+(a CSV with date_time, counter_party_name, amount and label columns, like data.csv) are folded into the
+existing model in seconds instead of retraining on the whole corpus.
+
+A few passes over a small batch of one category would pull the whole model towards it, so every update
+is mixed with a replay sample of earlier training rows. The sample (at most REPLAY_SIZE rows) is kept next
+to the model in ONLINE_REPLAY_PATH and the new rows are added to it after each update.
+
+The model is kept locally in ONLINE_MODEL_PATH. With --publish every version is uploaded as an immutable
+blob models/online_sgd/<UTC timestamp>.joblib and copied to the serving blob models/online_sgd.joblib.
+The Cloud Function serves it with MODEL_BLOB=models/online_sgd.joblib; its model cache and prediction
+cache follow the generation of the serving blob, so the new version is picked up on the next invocation.
+"""
+
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.compose import ColumnTransformer
+from sklearn.preprocessing import FunctionTransformer
+from sklearn.metrics import classification_report, accuracy_score
+from datetime import datetime, timezone
+import pandas as pd
+import numpy as np
+import joblib
+import os
+import sys
+import time
+
+from tfidfvectorizermodel import (LABELS, selected_columns, load_corpus, preprocess_corpus, build_features, split,
+                                  tag_text_format)
+from text_normalizer import check_text_format
+
+ONLINE_MODEL_PATH = os.environ.get("ONLINE_MODEL_PATH", "online_model.joblib")
+ONLINE_REPLAY_PATH = os.environ.get("ONLINE_REPLAY_PATH", "online_replay.joblib")
+REPLAY_SIZE = 5000
+# Ile wierszy z próbki historycznej przypada na jeden nowy wiersz przy aktualizacji
+REPLAY_RATIO = 20
+MIN_REPLAY_ROWS = 1000
+MODEL_BUCKET_NAME = "bank_data_milo"
+SERVING_BLOB = "models/online_sgd.joblib"
+VERSIONS_PREFIX = "models/online_sgd/"
+BATCH_SIZE = 1000
+CLASSES = np.array(sorted(LABELS.values()))
+
+
+def build_online_pipeline():
+    # Oba przekształcenia są bezstanowe, więc fit() nie uczy się niczego z danych
+    preprocessor = ColumnTransformer(
+        transformers=[
+            ('text', HashingVectorizer(n_features=2 ** 20, ngram_range=(1, 2), alternate_sign=False,
+                                       norm='l2'), 'preprocessed_text'),
+            ('numeric', FunctionTransformer(np.arcsinh, feature_names_out='one-to-one'), ['amount'])
+        ])
+
+    return Pipeline([
+        ('preprocessor', preprocessor),
+        ('classifier', SGDClassifier(loss='log_loss', alpha=1e-5, random_state=2024))
+    ])
+
+
+def partial_fit(model, X, y):
+    """
+    Fold one batch of labelled transactions into the model.
+
+    Args:
+        model (sklearn.pipeline.Pipeline): Pipeline from build_online_pipeline().
+        X (pandas.DataFrame): Rows with the selected_columns.
+        y: Numeric labels (LABELS values).
+    """
+    preprocessor = model.named_steps['preprocessor']
+    if not hasattr(preprocessor, 'transformers_'):
+        preprocessor.fit(X)
+    model.named_steps['classifier'].partial_fit(preprocessor.transform(X), y, classes=CLASSES)
+    return model
+
+
+def train_batches(model, X, y, batch_size=BATCH_SIZE, epochs=1, seed=2024):
+    rng = np.random.default_rng(seed)
+    for _ in range(epochs):
+        order = rng.permutation(len(X))
+        for start in range(0, len(X), batch_size):
+            rows = order[start:start + batch_size]
+            partial_fit(model, X.iloc[rows], y.iloc[rows])
+    return model
+
+
+def add_to_replay(replay, df_new, size=REPLAY_SIZE, seed=2024):
+    """
+    Add labelled rows to the replay sample, keeping at most `size` rows.
+
+    New rows are always kept; the older ones are dropped at random.
+    """
+    df_new = df_new[selected_columns + ['label_num']]
+    if replay is None or replay.empty:
+        replay = df_new.iloc[:0]
+    keep = max(0, size - len(df_new))
+    if len(replay) > keep:
+        replay = replay.sample(keep, random_state=seed)
+    return pd.concat([replay, df_new], ignore_index=True).tail(size)
+
+
+def initial_fit(df2, epochs=5):
+    """
+    Train a new online model from the full corpus and print the report on the test split.
+
+    Returns:
+        tuple: The model and the replay sample of the training rows.
+    """
+    X_train, X_test, y_train, y_test = split(df2)
+    model = build_online_pipeline()
+    start = time.perf_counter()
+    train_batches(model, X_train, y_train, epochs=epochs)
+    print('init: {} rows x {} epochs in {:.1f}s'.format(len(X_train), epochs, time.perf_counter() - start))
+    print(classification_report(y_test, model.predict(X_test), zero_division=0))
+
+    train = X_train.assign(label_num=y_train)
+    replay = add_to_replay(None, train.sample(min(REPLAY_SIZE, len(train)), random_state=2024))
+    return model, replay
+
+
+def load_corrections(path):
+    """
+    Read newly labelled transactions in the format of data.csv.
+    """
+    corrections = pd.read_csv(path)
+    corrections.dropna(subset=['counter_party_name', 'label'], inplace=True)
+    corrections['label_num'] = corrections.label.map(LABELS)
+    unknown = corrections['label_num'].isna()
+    if unknown.any():
+        raise ValueError("Unknown labels: {}".format(sorted(corrections.loc[unknown, 'label'].unique())))
+    corrections['preprocessed_text'] = preprocess_corpus(corrections['counter_party_name'].astype(str).tolist())
+    return build_features(corrections)
+
+
+def update(model, df_new, replay, passes=3):
+    """
+    Fold new labelled transactions into the model.
+
+    Args:
+        model (sklearn.pipeline.Pipeline): The current online model.
+        df_new (pandas.DataFrame): Output of load_corrections().
+        replay (pandas.DataFrame): Replay sample of earlier training rows, mixed into every pass.
+        passes (int): Number of passes over the new rows; corrections usually need more than one
+            to change the prediction of similar transactions.
+
+    Returns:
+        tuple: The updated model and replay sample.
+    """
+    X, y = df_new[selected_columns], df_new.label_num.astype(int)
+    before = accuracy_score(y, model.predict(X))
+
+    replay_rows = min(len(replay), max(MIN_REPLAY_ROWS, REPLAY_RATIO * len(df_new)))
+    sample = replay.sample(replay_rows, random_state=2024)
+    X_mix = pd.concat([X, sample[selected_columns]], ignore_index=True)
+    y_mix = pd.concat([y, sample.label_num.astype(int)], ignore_index=True)
+
+    start = time.perf_counter()
+    train_batches(model, X_mix, y_mix, epochs=passes)
+    print('update: {} rows (+{} replayed) x {} passes in {:.2f}s, accuracy on the new rows {:.3f} -> {:.3f}, '
+          'on the replay sample {:.3f}'.format(
+              len(X), replay_rows, passes, time.perf_counter() - start, before, accuracy_score(y, model.predict(X)),
+              accuracy_score(sample.label_num.astype(int), model.predict(sample[selected_columns]))))
+    return model, add_to_replay(replay, df_new)
+
+
+def publish(model, bucket_name=MODEL_BUCKET_NAME, path=ONLINE_MODEL_PATH):
+    """
+    Upload the model as a new immutable version and make it the serving blob.
+
+    Returns:
+        str: Name of the version blob.
+    """
+    from google.cloud import storage
+    joblib.dump(tag_text_format(model), path)
+    bucket = storage.Client(project='bank-account-analysis-412412').bucket(bucket_name)
+    version = VERSIONS_PREFIX + datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ') + '.joblib'
+    bucket.blob(version).upload_from_filename(path)
+    # Kopia po stronie GCS; nowa generacja blobu serwującego unieważnia cache modelu i predykcji
+    bucket.copy_blob(bucket.blob(version), bucket, SERVING_BLOB)
+    print('published {} as {}'.format(version, SERVING_BLOB))
+    return version
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'init'
+
+    if command == 'init':
+        epochs = int(sys.argv[sys.argv.index('--epochs') + 1]) if '--epochs' in sys.argv else 5
+        merged_df = load_corpus()
+        merged_df['preprocessed_text'] = preprocess_corpus(merged_df['counter_party_name'].astype(str).tolist())
+        model, replay = initial_fit(build_features(merged_df), epochs=epochs)
+    elif command == 'update':
+        passes = int(sys.argv[sys.argv.index('--passes') + 1]) if '--passes' in sys.argv else 3
+        model = joblib.load(ONLINE_MODEL_PATH)
+        # Poprawki przygotowywane są w bieżącym formacie tekstu, więc musi się zgadzać z modelem
+        check_text_format(model, ONLINE_MODEL_PATH)
+        model, replay = update(model, load_corrections(sys.argv[2]), joblib.load(ONLINE_REPLAY_PATH),
+                               passes=passes)
+    else:
+        raise ValueError("Unknown command {}. Use 'init' or 'update'.".format(command))
+
+    joblib.dump(tag_text_format(model), ONLINE_MODEL_PATH)
+    joblib.dump(replay, ONLINE_REPLAY_PATH)
+    if '--publish' in sys.argv:
+        publish(model)
@@ -7,51 +7,20 @@ from sklearn.pipeline import Pipeline
 from sklearn.metrics import classification_report
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.compose import ColumnTransformer
-import spacy
+from sklearn.preprocessing import StandardScaler
 import joblib
+import os
+import sys
+
+# Przygotowanie tekstu współdzielone z Cloud Function, żeby model widział ten sam tekst przy treningu i predykcji
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud function'))
+from text_normalizer import NORMALIZE_TEXT, prepare_texts, text_format
 pd.set_option('display.max_rows', 50)
 pd.set_option('display.max_columns', 5000)
 pd.set_option('display.width', 10000)
 
 
-
-corpus = pd.read_csv("data.csv")
-corpus2 = pd.read_csv('data2.csv')
-corpus2.dropna(inplace=True)
-corpus2.drop(columns=['institution', 'currency'], inplace=True)
-corpus2.rename(columns={'descritpion': 'counter_party_name', 'labell': 'label'}, inplace=True)
-# print(corpus.shape)
-# print(corpus2.shape)
-merged_df = pd.concat([corpus, corpus2])
-# print(merged_df.head())
-
-merged_df.dropna(inplace=True)
-
-# text = merged_df.counter_party_name
-# text = merged_df.drop(columns=['label', 'date_time'])
-
-v = TfidfVectorizer()
-# transormed_output = v.fit_transform(text)
-# print('v.vocabulary_', v.vocabulary_)
-
-
-# features = v.get_feature_names_out()
-# print(features)
-
-# for word in features:
-#     for x in word:
-#         indx = v.vocabulary_.get(x)
-#         print(f'{x} {v.idf_[indx]}')
-
-# print(text[:2])
-#
-# print(transormed_output.toarray()[:2])
-#
-# print(corpus.shape)
-# print(corpus.head())
-# print(corpus.label.value_counts())
-
-merged_df['label_num'] = merged_df.label.map({
+LABELS = {
     'Other': 0,
     'Food and drinks': 1,
     'Entertainment': 2,
@@ -70,77 +39,139 @@ merged_df['label_num'] = merged_df.label.map({
     'Travel': 15,
     'Debt collection': 16,
     'Cash transfer': 17
-})
+}
 
-nlp = spacy.load("pl_core_news_md")
-def preprocess(text):
-    # remove stop words and lemmatize the text
-    doc = nlp(text)
-    filtered_tokens = []
-    for token in doc:
-        if token.is_stop or token.is_punct:
-            continue
-        filtered_tokens.append(token.lemma_)
-    return " ".join(filtered_tokens)
+selected_columns = ['day', 'month', 'year', 'day_of_week', 'preprocessed_text', 'amount']
 
-merged_df['preprocessed_text'] = merged_df['counter_party_name'].apply(preprocess)
+# Komponenty niepotrzebne do lematyzacji i stop words
+DISABLED_COMPONENTS = ["parser", "ner"]
+BATCH_SIZE = 1000
 
-df2 = merged_df[['date_time','preprocessed_text', 'amount', 'label_num']]
+_nlp = None
 
 
-# Ekstrakcja składników daty
-df2['date_time'] = pd.to_datetime(df2['date_time'])
-df2.loc[:, 'day'] = df2['date_time'].dt.day
-df2['month'] = df2['date_time'].dt.month
-df2['year'] = df2['date_time'].dt.year
-df2['day_of_week'] = df2['date_time'].dt.dayofweek
+def load_corpus():
+    corpus = pd.read_csv("data.csv")
+    corpus2 = pd.read_csv('data2.csv')
+    corpus2.dropna(inplace=True)
+    corpus2.drop(columns=['institution', 'currency'], inplace=True)
+    corpus2.rename(columns={'descritpion': 'counter_party_name', 'labell': 'label'}, inplace=True)
+    # print(corpus.shape)
+    # print(corpus2.shape)
+    merged_df = pd.concat([corpus, corpus2])
+    # print(merged_df.head())
 
-print('df2', df2.head())
+    merged_df.dropna(inplace=True)
 
-selected_columns = ['day', 'month', 'year', 'day_of_week', 'preprocessed_text', 'amount']
+    # print(corpus.label.value_counts())
 
+    merged_df['label_num'] = merged_df.label.map(LABELS)
+    return merged_df
 
-# print("shape of X_train", X_train.shape)
-# print("shape of X_test", X_test.shape)
-# print("shape of y_train", y_train.shape)
 
-# print(y_train.value_counts())
-# print(y_test.value_counts())
+def get_nlp():
+    global _nlp
+    if _nlp is None:
+        import spacy
+        _nlp = spacy.load("pl_core_news_md", disable=DISABLED_COMPONENTS)
+    return _nlp
 
-from sklearn.preprocessing import StandardScaler
 
-# Definiowanie przekształceń dla poszczególnych kolumn
-preprocessor = ColumnTransformer(
-    transformers=[
-        ('text', CountVectorizer(), 'preprocessed_text'),
-        ('numeric', StandardScaler(), ['amount'])
+def tokens_to_text(doc):
+    # remove stop words and lemmatize the text
+    filtered_tokens = []
+    for token in doc:
+        if token.is_stop or token.is_punct:
+            continue
+        filtered_tokens.append(token.lemma_)
+    return " ".join(filtered_tokens)
+
+
+def preprocess(text):
+    return tokens_to_text(get_nlp()(text))
+
+
+def preprocess_corpus(texts, normalize_text=NORMALIZE_TEXT):
+    """
+    Prepare descriptions the same way assign_category does: raw text, or the shared normalizer with
+    NORMALIZE_TEXT=1. The setting is read by both sides, so a model is always served the text format
+    it was trained on.
+    """
+    return prepare_texts(texts, normalize_text)
+
+
+def tag_text_format(model, normalize_text=NORMALIZE_TEXT):
+    """
+    Record the text format of preprocess_corpus() in `model` before it is saved, checked at load time.
+    """
+    model.text_format = text_format(normalize_text)
+    return model
+
+
+def build_features(merged_df):
+    df2 = merged_df[['date_time', 'preprocessed_text', 'amount', 'label_num']].copy()
+
+    # Ekstrakcja składników daty
+    df2['date_time'] = pd.to_datetime(df2['date_time'])
+    df2.loc[:, 'day'] = df2['date_time'].dt.day
+    df2['month'] = df2['date_time'].dt.month
+    df2['year'] = df2['date_time'].dt.year
+    df2['day_of_week'] = df2['date_time'].dt.dayofweek
+    return df2
+
+
+def build_pipeline():
+    # Definiowanie przekształceń dla poszczególnych kolumn
+    preprocessor = ColumnTransformer(
+        transformers=[
+            ('text', CountVectorizer(), 'preprocessed_text'),
+            ('numeric', StandardScaler(), ['amount'])
+        ])
+
+    # 1. Create a pipeline object
+    return Pipeline([
+        ('preprocessor', preprocessor),
+        ('classifier', RandomForestClassifier())
     ])
 
 
-# 1. Create a pipeline object
-clf = Pipeline([
-    ('preprocessor', preprocessor),
-    ('classifier', RandomForestClassifier())
-])
+def split(df2):
+    # Podział danych na zbiór treningowy i testowy
+    return train_test_split(
+        df2[selected_columns], df2.label_num, test_size=0.2,
+        random_state=2024, stratify=df2.label_num)
+
+
+if __name__ == "__main__":
+    if '--select' in sys.argv:
+        # Wybór wektoryzatora i klasyfikatora zamiast treningu jednego modelu
+        from model_selection import run_selection
+        run_selection()
+        sys.exit(0)
+
+    merged_df = load_corpus()
+    merged_df['preprocessed_text'] = preprocess_corpus(merged_df['counter_party_name'].astype(str).tolist())
 
-# Podział danych na zbiór treningowy i testowy
-X_train, X_test, y_train, y_test = train_test_split(
-    df2[selected_columns], df2.label_num, test_size=0.2,
-    random_state=2024, stratify=df2.label_num)
+    df2 = build_features(merged_df)
+    print('df2', df2.head())
 
-# 2. fit with X_train and y_train
-clf.fit(X_train, y_train)
+    X_train, X_test, y_train, y_test = split(df2)
+    # print("shape of X_train", X_train.shape)
+    # print("shape of X_test", X_test.shape)
 
-# 3. get the predictions for X_test and store it in y_pred
-y_pred = clf.predict(X_test)
+    clf = build_pipeline()
 
-# 4. print the classification report
-print(classification_report(y_test, y_pred))
-print('X_test', X_test[:5])
-print('y_test', y_test[:5])
-print('y_pred', y_pred[:5])
+    # 2. fit with X_train and y_train
+    clf.fit(X_train, y_train)
 
+    # 3. get the predictions for X_test and store it in y_pred
+    y_pred = clf.predict(X_test)
 
+    # 4. print the classification report
+    print(classification_report(y_test, y_pred))
+    print('X_test', X_test[:5])
+    print('y_test', y_test[:5])
+    print('y_pred', y_pred[:5])
 
-# Zapisz model do pliku
-# joblib.dump(clf, 'random_forest_TFIvectorizer.joblib')
+    # Zapisz model do pliku
+    # joblib.dump(tag_text_format(clf), 'random_forest_TFIvectorizer.joblib')
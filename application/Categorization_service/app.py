@@ -0,0 +1,164 @@
+"""
+Transaction Categorization Service
+
+Long-lived Flask service exposing the trained categorization pipeline over HTTP. The model (joblib
+pipeline or lite model) is loaded once at startup, from MODEL_PATH if set or from the bucket through the
+model cache of the Cloud Function. Transactions are categorized with the same assign_category() as the Cloud Function,
+so merchant rules, text normalization and the prediction cache give the same labels as the batch
+pipeline.
+
+Concurrent requests are grouped by MicroBatcher: every request thread submits its transaction and
+waits, while one background thread calls the model once for up to MAX_BATCH_SIZE transactions
+gathered within MAX_WAIT_MS.
+
+Endpoints:
+- `POST /categorize`: One transaction, or a list of transactions, either in the Nordigen booked format
+  (bookingDate, transactionAmount, remittanceInformationUnstructured) or as
+  {"description", "amount", "date"}. Returns {"label": ...} or a list of them, or 503 when the labels
+  are not ready within REQUEST_TIMEOUT seconds. A transaction without a description or a numeric
+  amount, or with an unparsable date, is rejected with 400; in a list, such a transaction and one whose
+  categorization failed get {"error": ...} in its place and the others are still labelled.
+- `GET /health`: Batching statistics.
+
+Usage:
+    python wsgi.py  (waitress with SERVICE_THREADS threads on APP_PORT)
+"""
+
+import math
+import os
+import sys
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'cloud function'))
+
+import pandas as pd
+from flask import Flask, jsonify, request
+from main import assign_category, create_categories_mapping, extract_booked, load_model_with_version
+from batcher import MicroBatcher
+
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 64))
+MAX_WAIT_MS = float(os.environ.get("MAX_WAIT_MS", 5))
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", 30))
+MODEL_PATH = os.environ.get("MODEL_PATH")
+
+app = Flask(__name__)
+
+
+def load_service_model():
+    """
+        Return the model and its version, which keys the predictions in the prediction cache.
+    """
+    if MODEL_PATH:
+        from model_cache import load_model_file
+        # Nowy plik pod tą samą ścieżką ma inny czas modyfikacji, więc nie korzysta ze starych predykcji
+        return load_model_file(MODEL_PATH), 'file:{}'.format(os.stat(MODEL_PATH).st_mtime_ns)
+    return load_model_with_version()
+
+
+def to_booked(transaction):
+    """
+        Convert a request transaction to the Nordigen booked format read by extract_booked().
+
+        Raises:
+            ValueError: When the transaction has no description, no numeric amount or an unparsable date.
+    """
+    if not isinstance(transaction, dict):
+        raise ValueError("Transaction must be a JSON object")
+    if 'remittanceInformationUnstructured' in transaction:
+        booked = transaction
+    else:
+        booked = {
+            'bookingDate': transaction.get('date'),
+            'transactionAmount': {'amount': transaction.get('amount'),
+                                  'currency': transaction.get('currency', 'PLN')},
+            'remittanceInformationUnstructured': transaction.get('description'),
+        }
+    if not booked.get('remittanceInformationUnstructured'):
+        raise ValueError("Transaction has no description")
+    transaction_amount = booked.get('transactionAmount')
+    check_amount(transaction_amount.get('amount') if isinstance(transaction_amount, dict) else None)
+    check_date(booked.get('bookingDate'))
+    return booked
+
+
+def check_amount(amount):
+    # Brak kwoty dałby NaN na wejściu modelu i błąd całej paczki
+    if amount is None or isinstance(amount, bool):
+        raise ValueError("Transaction has no amount")
+    try:
+        value = float(amount)
+    except (TypeError, ValueError):
+        raise ValueError("Transaction amount {!r} is not a number".format(amount))
+    if not math.isfinite(value):
+        raise ValueError("Transaction amount {!r} is not a number".format(amount))
+
+
+def check_date(date):
+    if date is None:
+        return
+    try:
+        if not isinstance(date, str):
+            raise TypeError
+        pd.to_datetime(date)
+    except (TypeError, ValueError):
+        raise ValueError("Transaction date {!r} is not a valid date".format(date))
+
+
+def categorize_batch(transactions):
+    """
+        Categorize a batch of booked transactions with one call of the model.
+
+        Returns:
+            list: Category name of every transaction, in order.
+    """
+    df = extract_booked(transactions, None)
+    df = assign_category(df, category_mapping=CATEGORIES_MAPPING, loaded_model=MODEL, model_version=MODEL_VERSION)
+    return df['label'].tolist()
+
+
+CATEGORIES_MAPPING = create_categories_mapping()
+MODEL, MODEL_VERSION = load_service_model()
+BATCHER = MicroBatcher(categorize_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS)
+
+
+@app.route("/categorize", methods=["POST"])
+def categorize():
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return jsonify({'error': 'Expected a JSON body'}), 400
+
+    single = not isinstance(payload, list)
+    transactions = [payload] if single else payload
+    results = [None] * len(transactions)
+    futures = [None] * len(transactions)
+    for position, transaction in enumerate(transactions):
+        try:
+            booked = to_booked(transaction)
+        except ValueError as error:
+            if single:
+                return jsonify({'error': str(error)}), 400
+            results[position] = {'error': str(error)}
+            continue
+        # Każda transakcja trafia do wspólnej kolejki, model wywoływany jest dla całych paczek
+        futures[position] = BATCHER.submit(booked)
+
+    for position, future in enumerate(futures):
+        if future is None:
+            continue
+        try:
+            results[position] = {'label': future.result(timeout=REQUEST_TIMEOUT)}
+        except FutureTimeoutError:
+            # Kolejka nie nadąża; klient może ponowić żądanie
+            return jsonify({'error': 'Categorization timed out'}), 503
+        except Exception as error:
+            # Błąd jednej transakcji nie przerywa pozostałych
+            results[position] = {'error': 'Categorization failed: {}'.format(error)}
+
+    if single:
+        return jsonify(results[0]), 500 if 'error' in results[0] else 200
+    return jsonify(results)
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    return jsonify(BATCHER.stats())
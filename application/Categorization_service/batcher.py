@@ -0,0 +1,131 @@
+"""
+Micro-batching of concurrent prediction requests.
+
+Request threads call MicroBatcher.submit() with a single item and wait on the returned Future.
+One background thread takes the first waiting item, keeps collecting items until max_batch_size
+items are gathered or max_wait_ms passed since the first one, and resolves all of them with a single
+call of predict_batch. Under load the model is called with full batches; a lone request waits at
+most max_wait_ms. When the batch call raises, its items are predicted one by one and only the items
+that fail on their own get the exception.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Groups single items submitted from many threads into batches for one predict call.
+
+    Args:
+        predict_batch (callable): Function taking a list of items and returning a list of results
+            in the same order.
+        max_batch_size (int): Maximum number of items passed to one predict_batch call.
+        max_wait_ms (float): How long the first item of a batch waits for more items.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=64, max_wait_ms=5):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._counters = {
+            'batches': 0,
+            'items': 0,
+            'errors': 0,
+            'batch_errors': 0,
+            'predict_seconds': 0.0,
+            'max_batch': 0,
+        }
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """
+            Queue one item for the next batch.
+
+            Returns:
+                concurrent.futures.Future: Resolved with the result of the item.
+        """
+        if self._stopped.is_set():
+            raise RuntimeError("MicroBatcher is closed")
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def predict(self, item, timeout=None):
+        """
+            Submit one item and wait for its result.
+        """
+        return self.submit(item).result(timeout=timeout)
+
+    def _collect(self):
+        try:
+            first = self._queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set() or not self._queue.empty():
+            batch = self._collect()
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = self.predict_batch(items)
+            except Exception:
+                # Jeden zły element nie może zepsuć całej paczki: każdy element liczony jest osobno
+                self._counters['batch_errors'] += 1
+                self._predict_each(batch)
+                continue
+            self._counters['predict_seconds'] += time.perf_counter() - start
+            self._counters['batches'] += 1
+            self._counters['items'] += len(batch)
+            self._counters['max_batch'] = max(self._counters['max_batch'], len(batch))
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def _predict_each(self, batch):
+        """
+            Resolve every item of a failed batch with its own predict_batch call, so only the items that
+            fail on their own get the exception.
+        """
+        for item, future in batch:
+            try:
+                result = self.predict_batch([item])[0]
+            except Exception as error:
+                self._counters['errors'] += 1
+                future.set_exception(error)
+            else:
+                self._counters['items'] += 1
+                future.set_result(result)
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats['avg_batch'] = round(stats['items'] / stats['batches'], 2) if stats['batches'] else 0.0
+        stats['queued'] = self._queue.qsize()
+        stats['max_batch_size'] = self.max_batch_size
+        stats['max_wait_ms'] = self.max_wait * 1000
+        return stats
+
+    def close(self, timeout=5):
+        """
+            Stop accepting items and finish the ones already queued.
+        """
+        self._stopped.set()
+        self._thread.join(timeout)
@@ -0,0 +1,92 @@
+import importlib
+import os
+import sys
+
+import joblib
+import pandas as pd
+import pytest
+from sklearn.compose import ColumnTransformer
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+from batcher import MicroBatcher
+
+
+def train_model():
+    X = pd.DataFrame({'preprocessed_text': ['biedronka zakupy', 'orlen paliwo', 'lidl zakupy', 'shell paliwo'],
+                      'amount': [-50.0, -200.0, -30.0, -180.0]})
+    preprocessor = ColumnTransformer(transformers=[('text', CountVectorizer(), 'preprocessed_text'),
+                                                   ('numeric', StandardScaler(), ['amount'])])
+    return Pipeline([('preprocessor', preprocessor), ('classifier', LogisticRegression())]).fit(X, [1, 3, 1, 3])
+
+
+@pytest.fixture(scope='module')
+def service(tmp_path_factory):
+    path = tmp_path_factory.mktemp('model') / 'model.joblib'
+    joblib.dump(train_model(), path)
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('MODEL_PATH', str(path))
+        patch.setenv('USE_MERCHANT_RULES', '0')
+        # MODEL_PATH czytany jest przy imporcie modułu
+        app = importlib.reload(sys.modules['app']) if 'app' in sys.modules else importlib.import_module('app')
+    yield app
+    app.BATCHER.close()
+
+
+@pytest.fixture
+def client(service):
+    return service.app.test_client()
+
+
+def test_categorize_one_transaction(client):
+    response = client.post('/categorize', json={'description': 'Biedronka', 'amount': '-42.50', 'date': '2024-05-01'})
+    assert response.status_code == 200
+    assert response.get_json()['label'] in ('Food and drinks', 'Transportation')
+
+
+@pytest.mark.parametrize('transaction', [
+    {'description': 'STARBUCKS', 'date': '2024-05-01'},
+    {'description': 'STARBUCKS', 'amount': 'x', 'date': '2024-05-01'},
+    {'description': 'STARBUCKS', 'amount': '12.00', 'date': 'not a date'},
+    {'bookingDate': '2024-05-01', 'remittanceInformationUnstructured': 'STARBUCKS'},
+])
+def test_invalid_transaction_is_rejected(client, transaction):
+    response = client.post('/categorize', json=transaction)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_invalid_item_does_not_drop_the_others(client):
+    response = client.post('/categorize', json=[
+        {'description': 'Orlen', 'amount': '-150', 'date': '2024-05-01'},
+        {'description': 'STARBUCKS', 'amount': 'x', 'date': '2024-05-01'},
+    ])
+    assert response.status_code == 200
+    first, second = response.get_json()
+    assert 'label' in first
+    assert 'amount' in second['error']
+
+
+def test_failing_item_returns_json_error(service, client, monkeypatch):
+    def predict_batch(transactions):
+        if any(transaction['remittanceInformationUnstructured'] == 'BOOM' for transaction in transactions):
+            raise RuntimeError('model failed')
+        return ['Other'] * len(transactions)
+
+    batcher = MicroBatcher(predict_batch, max_batch_size=8, max_wait_ms=50)
+    monkeypatch.setattr(service, 'BATCHER', batcher)
+    try:
+        response = client.post('/categorize', json=[
+            {'description': 'Lidl', 'amount': '-10', 'date': '2024-05-01'},
+            {'description': 'BOOM', 'amount': '-10', 'date': '2024-05-01'},
+        ])
+        assert response.status_code == 200
+        assert response.get_json() == [{'label': 'Other'}, {'error': 'Categorization failed: model failed'}]
+
+        response = client.post('/categorize', json={'description': 'BOOM', 'amount': '-10', 'date': '2024-05-01'})
+        assert response.status_code == 500
+        assert response.is_json
+    finally:
+        batcher.close()
@@ -0,0 +1,14 @@
+import os
+import logging
+from waitress import serve
+from app import app
+
+logger = logging.getLogger('waitress')
+logger.setLevel(logging.INFO)
+
+ENVIRONMENT_PORT = int(os.environ.get("APP_PORT", 8080))
+# Wątki waitress obsługują równoległe żądania, które MicroBatcher łączy w paczki
+SERVICE_THREADS = int(os.environ.get("SERVICE_THREADS", 32))
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+if __name__ == "__main__":
+    serve(app, host='0.0.0.0', port=ENVIRONMENT_PORT, threads=SERVICE_THREADS)
@@ -0,0 +1,301 @@
+"""
+Writer of the bank-ndjson account file format (version 1).
+
+A file is gzip-compressed, newline-delimited JSON with one record per line:
+
+    {"type": "header", "format": "bank-ndjson", "version": 1, "created": <unix time>, "user": {...}}
+    {"type": "account", "metadata": {...}, "details": {...}, "balances": {...}, "transactions": {"pending": [...]}}
+    {"type": "booked", "transaction": {...}}      one line per booked transaction of the account above
+    {"type": "account", ...}                      next account, followed by its booked lines
+    ...
+
+The user record is written once in the header instead of after every account. Records are written and
+compressed one by one straight into the upload stream, so no serialized copy of the whole file is built.
+The Cloud Function reads the format with account_reader.iter_ndjson_chunks(); account files in the previous
+JSON list layout (*.json) are still read during the transition.
+
+Incremental sync: the header also keeps "accounts": {<account id>: {"last_booking_date": "YYYY-MM-DD"}},
+the watermark of every account. sync_dates() turns it into the date_from of the next transactions call,
+SYNC_OVERLAP_DAYS before the watermark so that late-posted entries are picked up again. upload_accounts()
+with the stored blob merges the fetched window into the stored file: the old file is read line by line
+while the merged one is streamed to the same blob name, booked transactions already fetched again are
+dropped by transaction_key(), and the upload only succeeds if the stored generation was not replaced
+in the meantime. The merged header keeps the "created" time of the stored file and gzip is written without
+a timestamp, so a sync without new activity produces the same bytes (and md5) as the stored file.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import time
+from datetime import date, timedelta
+
+FORMAT_NAME = "bank-ndjson"
+FORMAT_VERSION = 1
+FILE_SUFFIX = ".ndjson.gz"
+LEGACY_SUFFIX = ".json"
+COMPRESS_LEVEL = 6
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+SYNC_OVERLAP_DAYS = int(os.environ.get("SYNC_OVERLAP_DAYS", 3))
+
+
+def _line(record):
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf8")
+
+
+def header_record(user, accounts=None, created=None):
+    return {"type": "header", "format": FORMAT_NAME, "version": FORMAT_VERSION,
+            "created": created if created is not None else time.time(), "user": user, "accounts": accounts or {}}
+
+
+def split_account(account_data):
+    """
+        Split an account dict into its account record and the list of its booked transactions.
+    """
+    transactions = dict(account_data.get("transactions") or {})
+    inner = dict(transactions.get("transactions") or {})
+    booked = inner.pop("booked", [])
+    transactions["transactions"] = inner
+    record = {key: value for key, value in account_data.items() if key != "transactions"}
+    record.update({"type": "account", "transactions": transactions})
+    return record, booked
+
+
+def iter_records(accounts_data, user, accounts=None):
+    """
+        Generator of the records of a file: the header, then every account followed by its booked transactions.
+    """
+    yield header_record(user, accounts)
+    for account_data in accounts_data:
+        record, booked = split_account(account_data)
+        yield record
+        for transaction in booked:
+            yield {"type": "booked", "transaction": transaction}
+
+
+def transaction_key(transaction):
+    """
+        Return the dedupe key of a booked transaction, the same as watermarks.transaction_key() of the
+        Cloud Function: the bank's transactionId, or a hash of the booking date, amount, currency and description.
+    """
+    transaction_id = transaction.get("transactionId")
+    if transaction_id:
+        return "id:" + str(transaction_id)
+
+    amount = transaction.get("transactionAmount") or {}
+    content = "|".join([
+        str(transaction.get("bookingDate", "")),
+        str(amount.get("amount", "")),
+        str(amount.get("currency", "")),
+        str(transaction.get("remittanceInformationUnstructured", "")),
+    ])
+    return "sha1:" + hashlib.sha1(content.encode("utf8")).hexdigest()
+
+
+def account_id(account_data):
+    return (account_data.get("metadata") or {}).get("id")
+
+
+def read_header(blob):
+    """
+        Return the header record of a stored bank-ndjson blob; only the first line is decompressed.
+    """
+    with blob.open("rb") as stored:
+        with gzip.GzipFile(fileobj=stored, mode="rb") as lines:
+            header = json.loads(lines.readline() or b"{}")
+    if header.get("type") != "header" or header.get("format") != FORMAT_NAME:
+        raise ValueError("Not a {} file: {}".format(FORMAT_NAME, blob.name))
+    return header
+
+
+def iter_stored_lines(blob):
+    """
+        Generator of the raw lines of a stored bank-ndjson blob after its header.
+    """
+    with blob.open("rb") as stored:
+        with gzip.GzipFile(fileobj=stored, mode="rb") as lines:
+            lines.readline()
+            yield from lines
+
+
+def iter_stored_records(blob):
+    """
+        Generator of the records of a stored bank-ndjson blob after its header.
+    """
+    for line in iter_stored_lines(blob):
+        yield json.loads(line)
+
+
+def sync_dates(header, account_ids, overlap_days=SYNC_OVERLAP_DAYS):
+    """
+        Return the date_from of the transactions call of every account.
+
+        Args:
+            header (dict): Header of the stored file, or None when there is none yet.
+            account_ids (list): Accounts of the requisition.
+            overlap_days (int): Days before the watermark fetched again for late-posted transactions.
+
+        Returns:
+            dict: Account id -> 'YYYY-MM-DD', or None when the whole history has to be fetched.
+    """
+    stored = (header or {}).get("accounts") or {}
+    dates = {}
+    for account in account_ids:
+        last_booking_date = (stored.get(account) or {}).get("last_booking_date")
+        if last_booking_date:
+            dates[account] = (date.fromisoformat(last_booking_date) - timedelta(days=overlap_days)).isoformat()
+        else:
+            dates[account] = None
+    return dates
+
+
+def account_watermarks(accounts_data, header=None):
+    """
+        Return the "accounts" header entry after a sync: the latest bookingDate of every account,
+        from the fetched transactions and the stored header.
+    """
+    accounts = dict((header or {}).get("accounts") or {})
+    for account_data in accounts_data:
+        booked = ((account_data.get("transactions") or {}).get("transactions") or {}).get("booked") or []
+        dates = [transaction["bookingDate"] for transaction in booked if transaction.get("bookingDate")]
+        entry = dict(accounts.get(account_id(account_data)) or {})
+        if dates:
+            entry["last_booking_date"] = max(dates + [entry.get("last_booking_date") or ""])
+        accounts[account_id(account_data)] = entry
+    return accounts
+
+
+def merge_records(stored_lines, accounts_data, user, accounts, counters, created=None):
+    """
+        Generator of the records of the merged file.
+
+        Accounts are kept in the stored order. A fetched account replaces the stored account record and its
+        fetched booked transactions come first (newest first, as returned by the API), followed by the stored
+        ones whose transaction_key() was not fetched again. Accounts not fetched are copied unchanged, new
+        accounts are appended at the end. Stored lines that are kept are yielded as the raw bytes, so they
+        are not encoded again.
+
+        Args:
+            stored_lines: Raw lines of the stored file after the header (iter_stored_lines()).
+            accounts_data (list): Fetched accounts, with only the transactions of the sync window.
+            user (dict): User data stored in the header.
+            accounts (dict): "accounts" header entry (account_watermarks()).
+            counters (dict): Updated with the number of 'fetched', 'duplicates' and 'kept' booked transactions.
+            created (float): Creation time kept from the stored header.
+
+        Yields:
+            dict or bytes: Records, starting with the header.
+    """
+    fetched = {account_id(account_data): account_data for account_data in accounts_data}
+    written = set()
+    fetched_keys = set()
+    yield header_record(user, accounts, created)
+
+    def fetched_account(account):
+        record, booked = split_account(fetched[account])
+        written.add(account)
+        counters["fetched"] += len(booked)
+        yield record
+        for transaction in booked:
+            fetched_keys.add(transaction_key(transaction))
+            yield {"type": "booked", "transaction": transaction}
+
+    for line in stored_lines:
+        record = json.loads(line)
+        if record.get("type") == "account":
+            account = (record.get("metadata") or {}).get("id")
+            fetched_keys = set()
+            if account in fetched and account not in written:
+                yield from fetched_account(account)
+            else:
+                yield line
+        elif record.get("type") == "booked":
+            if transaction_key(record["transaction"]) in fetched_keys:
+                counters["duplicates"] += 1
+            else:
+                counters["kept"] += 1
+                yield line
+
+    for account_data in accounts_data:
+        if account_id(account_data) not in written:
+            fetched_keys = set()
+            yield from fetched_account(account_id(account_data))
+
+
+def write_records(fp, records, compresslevel=COMPRESS_LEVEL):
+    """
+        Write records (dicts, or already encoded lines as bytes) to a binary file-like object as
+        gzip-compressed NDJSON.
+
+        Returns:
+            int: Number of uncompressed bytes written.
+    """
+    written = 0
+    with gzip.GzipFile(fileobj=fp, mode="wb", compresslevel=compresslevel, mtime=0) as output:
+        for record in records:
+            written += output.write(record if isinstance(record, bytes) else _line(record))
+    return written
+
+
+def write_accounts(fp, accounts_data, user, compresslevel=COMPRESS_LEVEL):
+    """
+        Write accounts to a binary file-like object in the bank-ndjson format.
+
+        The booked transactions may be generators; no watermarks are written, so the next sync of
+        such a file fetches the whole history.
+
+        Args:
+            fp: Binary file-like object, e.g. blob.open('wb').
+            accounts_data (list): Account dicts with 'metadata', 'details', 'balances' and 'transactions'.
+            user (dict): User data stored in the header.
+
+        Returns:
+            int: Number of uncompressed bytes written.
+    """
+    return write_records(fp, iter_records(accounts_data, user), compresslevel)
+
+
+def upload_accounts(bucket, base_name, accounts_data, user, stored=None, header=None):
+    """
+        Stream accounts to the blob `base_name` + FILE_SUFFIX and remove the legacy JSON blob of the same user.
+
+        Args:
+            bucket: Bucket the file is written to.
+            base_name (str): Blob name without the suffix.
+            accounts_data (list): Fetched accounts, booked transactions as lists.
+            user (dict): User data stored in the header.
+            stored: The stored blob (bucket.get_blob()) the fetched transactions are merged into, or None
+                to write the fetched accounts as the whole file.
+            header (dict): Header of `stored` (read_header()).
+
+        Returns:
+            dict: 'blob_name', 'bytes' (uncompressed), 'fetched', 'duplicates' and 'kept' booked transactions.
+
+        Raises:
+            google.api_core.exceptions.PreconditionFailed: When the blob was changed after `stored` was read,
+                or created meanwhile when `stored` is None.
+    """
+    blob_name = base_name + FILE_SUFFIX
+    blob = bucket.blob(blob_name)
+    counters = {"fetched": 0, "duplicates": 0, "kept": 0}
+    accounts = account_watermarks(accounts_data, header)
+    if stored is not None:
+        records = merge_records(iter_stored_lines(stored), accounts_data, user, accounts, counters,
+                                (header or {}).get("created"))
+        # Zapis nie nadpisze pliku, który w międzyczasie zmieniła inna synchronizacja
+        generation = stored.generation
+    else:
+        records = merge_records([], accounts_data, user, accounts, counters)
+        # Generacja 0: plik nie może istnieć, więc równoległa pierwsza synchronizacja też nie zostanie nadpisana
+        generation = 0
+    with blob.open("wb", content_type="application/gzip", chunk_size=UPLOAD_CHUNK_SIZE,
+                   if_generation_match=generation) as output:
+        counters["bytes"] = write_records(output, records)
+
+    # Stary plik .json tego samego użytkownika byłby przetwarzany drugi raz
+    legacy = bucket.blob(base_name + LEGACY_SUFFIX)
+    if legacy.exists():
+        legacy.delete()
+    counters["blob_name"] = blob_name
+    return counters
@@ -0,0 +1,145 @@
+"""
+Caching of Nordigen API state shared by all requests of a worker.
+
+InstitutionCache keeps the institution list of every country in a TTL cache, so the landing page is served
+from memory and only one request per country and TTL goes upstream. When the refresh fails, the last list
+is served instead of an error.
+
+TokenManager keeps the access token of the NordigenClient valid: the token is refreshed with the refresh
+token TOKEN_REFRESH_MARGIN seconds before it expires, and a new pair is generated when the refresh token
+itself is about to expire.
+"""
+
+import os
+import threading
+import time
+
+from cachetools import TTLCache
+
+INSTITUTIONS_TTL = int(os.environ.get("INSTITUTIONS_TTL", 3600))
+TOKEN_REFRESH_MARGIN = int(os.environ.get("TOKEN_REFRESH_MARGIN", 300))
+
+
+class InstitutionCache:
+    """
+    TTL cache of client.institution.get_institutions(country=...) per country.
+
+    Args:
+        client (nordigen.NordigenClient): Client used on a cache miss.
+        ttl (int): Seconds an institution list is served from memory.
+        maxsize (int): Maximum number of countries kept.
+    """
+
+    def __init__(self, client, ttl=INSTITUTIONS_TTL, maxsize=64):
+        self.client = client
+        self.ttl = ttl
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Ostatnia udana odpowiedź, zwracana gdy odświeżenie się nie powiedzie
+        self._last = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'stale': 0, 'errors': 0, 'load_seconds': 0.0}
+
+    def get(self, country):
+        with self._lock:
+            institutions = self._cache.get(country)
+            if institutions is not None:
+                self._counters['hits'] += 1
+                return institutions
+
+        # Tylko jedno żądanie pobiera listę, pozostałe czekają i dostają wynik z cache
+        with self._load_lock:
+            with self._lock:
+                institutions = self._cache.get(country)
+                if institutions is not None:
+                    self._counters['hits'] += 1
+                    return institutions
+                self._counters['misses'] += 1
+
+            start = time.perf_counter()
+            try:
+                institutions = self.client.institution.get_institutions(country=country)
+            except Exception:
+                with self._lock:
+                    self._counters['errors'] += 1
+                    if country in self._last:
+                        self._counters['stale'] += 1
+                        return self._last[country]
+                raise
+            finally:
+                with self._lock:
+                    self._counters['load_seconds'] += time.perf_counter() - start
+
+            with self._lock:
+                self._cache[country] = institutions
+                self._last[country] = institutions
+            return institutions
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            requests = stats['hits'] + stats['misses']
+            stats['hit_ratio'] = round(stats['hits'] / requests, 4) if requests else None
+            stats['countries'] = len(self._cache)
+            stats['ttl'] = self.ttl
+            return stats
+
+
+class TokenManager:
+    """
+    Keeps the access token of a NordigenClient valid.
+
+    Args:
+        client (nordigen.NordigenClient): Client whose token is managed.
+        margin (int): Refresh this many seconds before the token expires.
+    """
+
+    def __init__(self, client, margin=TOKEN_REFRESH_MARGIN, clock=time.time):
+        self.client = client
+        self.margin = margin
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._access_expires_at = 0.0
+        self._refresh_token = None
+        self._refresh_expires_at = 0.0
+        self._counters = {'generated': 0, 'refreshed': 0, 'errors': 0}
+
+    def _generate(self, now):
+        response = self.client.generate_token()
+        self._refresh_token = response.get('refresh')
+        self._refresh_expires_at = now + response.get('refresh_expires', 0)
+        self._access_expires_at = now + response.get('access_expires', 0)
+        self._counters['generated'] += 1
+
+    def _refresh(self, now):
+        response = self.client.exchange_token(self._refresh_token)
+        self._access_expires_at = now + response.get('access_expires', 0)
+        self._counters['refreshed'] += 1
+
+    def ensure(self):
+        """
+            Refresh the token if it expires within `margin` seconds; cheap when it is still valid.
+        """
+        if self.clock() < self._access_expires_at - self.margin:
+            return
+        with self._lock:
+            now = self.clock()
+            if now < self._access_expires_at - self.margin:
+                return
+            try:
+                if self._refresh_token and now < self._refresh_expires_at - self.margin:
+                    self._refresh(now)
+                else:
+                    self._generate(now)
+            except Exception:
+                self._counters['errors'] += 1
+                # Wygasający token jest nadal ważny, więc odświeżenie zostanie ponowione przy następnym żądaniu
+                if now >= self._access_expires_at:
+                    raise
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['access_expires_in'] = round(self._access_expires_at - self.clock(), 1)
+            stats['refresh_expires_in'] = round(self._refresh_expires_at - self.clock(), 1)
+            return stats
@@ -1,4 +1,5 @@
 import os
+import time
 from uuid import uuid4
 import json
 from dotenv import load_dotenv
@@ -6,6 +7,9 @@ from flask import Flask, jsonify, redirect, render_template, session, url_for, r
 from nordigen import NordigenClient
 from google.cloud import storage
 from google.oauth2.service_account import Credentials
+from account_fetcher import AccountFetcher
+from account_writer import FILE_SUFFIX, read_header, sync_dates, upload_accounts
+from api_cache import InstitutionCache, TokenManager
 
 
 """
@@ -24,11 +28,16 @@ Endpoints:
 - `/`: Landing page displaying a list of available institutions for account authorization.
 - `/agreements/<institution_id>`: Handles the authorization process for a specific institution.
 - `/results`: Displays transaction results after successful authorization.
+- `/metrics`: Institution cache, token and account fetching counters as JSON.
 
 Functionality:
 1. **Authorization**: Users select an institution on the landing page and authorize access to their bank accounts.
 2. **Data Retrieval**: Transactions, account details, balances, and metadata are retrieved using the Nordigen API.
-3. **Data Processing**: Retrieved data is processed and stored in a JSON file.
+   The calls of all accounts run concurrently over a pooled session with retry/backoff (account_fetcher.py).
+3. **Data Processing**: Retrieved data is processed and stored as a gzip-compressed NDJSON file
+   (account_writer.py; UPLOAD_FORMAT=json keeps the previous JSON list layout). When the file already exists,
+   only transactions booked since its per-account watermark (minus SYNC_OVERLAP_DAYS) are requested and
+   merged into it.
 4. **Google Cloud Storage**: Processed data is uploaded to GCS for storage.
 
 Usage:
@@ -47,6 +56,8 @@ app.config["SECRET_KEY"] = os.urandom(24)
 app.config['STATIC_FOLDER'] = 'static'
 COUNTRY = "PL"
 REDIRECT_URI = "your-url"
+# 'ndjson' zapisuje strumieniowo plik .ndjson.gz, 'json' poprzedni format listy JSON
+UPLOAD_FORMAT = os.environ.get("UPLOAD_FORMAT", "ndjson")
 # REDIRECT_URI = 'https://127.0.0.1:5000/results'
 
 # Load secrets from .env file
@@ -56,7 +67,9 @@ load_dotenv()
 # In this example we will load secrets from .env file
 client = NordigenClient(
     secret_id=os.environ.get("SECRET_ID"),
-    secret_key=os.environ.get("SECRET_KEY")
+    secret_key=os.environ.get("SECRET_KEY"),
+    # np. http://127.0.0.1:8765/api/v2 dla benchmarks/stub_nordigen.py
+    base_url=os.environ.get("NORDIGEN_BASE_URL", "https://ob.nordigen.com/api/v2")
 )
 # @app.route("/")
 # def form():
@@ -81,14 +94,26 @@ client = NordigenClient(
 #         else:
 #             return redirect(url_for("home"))
 
-# Generate access & refresh token
-client.generate_token()
+# Generate access & refresh token; TokenManager odświeża go przed wygaśnięciem
+tokens = TokenManager(client)
+tokens.ensure()
+
+# Lista instytucji per kraj serwowana z pamięci przez INSTITUTIONS_TTL sekund
+institutions = InstitutionCache(client)
+
+# Wspólna pula połączeń do API Nordigen dla wszystkich żądań
+fetcher = AccountFetcher(client)
+
+
+@app.before_request
+def ensure_token():
+    tokens.ensure()
 
 
 @app.route("/", methods=["GET"])
 def home():
     # Get list of institutions
-    institution_list = client.institution.get_institutions(country=COUNTRY)
+    institution_list = institutions.get(COUNTRY)
 
     return render_template("index.html", institutions=institution_list)
 
@@ -139,32 +164,10 @@ def results():
         print("session['req_id']=", cookie_name)
         # global accounts
         accounts = client.requisition.get_requisition_by_id(requisition_id = cookie_name)["accounts"]
-        accounts_data = []
-        for id in accounts:
-            account = client.account_api(id)
-            metadata = account.get_metadata()
-            transactions = account.get_transactions()
-            details = account.get_details()
-            balances = account.get_balances()
-
-            accounts_data.append(
-                {
-                    "metadata": metadata,
-                    "details": details,
-                    "balances": balances,
-                    "transactions": transactions,
-                }
-            )
-            accounts_data.append(user)
-
-        print("accounts_data", accounts_data)
-
-        # with open(f"{user['user_full_name']+' '+user['institution']}.json", "w") as outfile:
-        #     json.dump(accounts_data, outfile)
 
         bucket_name = "bank_data_milo"
         # Ustawienie ścieżki w GCS, gdzie plik ma być umieszczony
-        blob_name = f"{user['user_full_name']+' '+user['institution']}.json"
+        base_name = f"{user['user_full_name']+' '+user['institution']}"
 
 
         # The ID of your GCS object
@@ -183,9 +186,38 @@ def results():
         client2 = storage.Client(credentials=credentials, project='project')
         bucket = client2.get_bucket(bucket_name)
 
-        blob = bucket.blob(blob_name)
-        contents_enc = json.dumps(accounts_data, ensure_ascii=False).encode('utf8')
-        blob.upload_from_string(data=contents_enc, content_type='application/json')
+        # Zapisany plik wyznacza date_from każdego konta, pobierane są tylko nowe transakcje
+        stored = bucket.get_blob(base_name + FILE_SUFFIX) if UPLOAD_FORMAT != 'json' else None
+        header = read_header(stored) if stored is not None else None
+        date_from = sync_dates(header, accounts)
+        print("date_from", date_from)
+
+        sync_start = time.perf_counter()
+        bytes_before = fetcher.bytes_received
+        # Wszystkie wywołania wszystkich kont idą równolegle, zamiast jedno po drugim
+        accounts_data = fetcher.fetch_accounts(accounts, date_from=date_from)
+        fetch_seconds = time.perf_counter() - sync_start
+
+        print("accounts_data", accounts_data)
+
+        # with open(f"{user['user_full_name']+' '+user['institution']}.json", "w") as outfile:
+        #     json.dump(accounts_data, outfile)
+
+        if UPLOAD_FORMAT == 'json':
+            blob_name = base_name + '.json'
+            legacy_data = []
+            for account_data in accounts_data:
+                legacy_data.append(account_data)
+                legacy_data.append(user)
+            blob = bucket.blob(blob_name)
+            contents_enc = json.dumps(legacy_data, ensure_ascii=False).encode('utf8')
+            blob.upload_from_string(data=contents_enc, content_type='application/json')
+        else:
+            upload = upload_accounts(bucket, base_name, accounts_data, user, stored=stored, header=header)
+            blob_name = upload['blob_name']
+            print("sync: fetch {:.2f}s, payload {} B, total {:.2f}s, booked fetched {}, duplicates {}, kept {}".format(
+                fetch_seconds, fetcher.bytes_received - bytes_before, time.perf_counter() - sync_start,
+                upload['fetched'], upload['duplicates'], upload['kept']))
         print("user", user.values())
 
         print(f"Plik {blob_name} został pomyślnie przesłany do GCS.")
@@ -199,3 +231,12 @@ def results():
     raise Exception(
         "Requisition ID is not found. Please complete authorization with your bank"
     )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return jsonify({
+        "institutions_cache": institutions.stats(),
+        "token": tokens.stats(),
+        "account_fetcher": {"calls": fetcher.calls, "bytes_received": fetcher.bytes_received},
+    })
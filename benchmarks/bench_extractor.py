@@ -0,0 +1,142 @@
+"""
+Benchmark of the columnar extractor against the previous Excel round-trip.
+
+Usage:
+    python benchmarks/bench_extractor.py [rows ...]
+
+For every size a synthetic Nordigen account is built in memory and passed to both
+extractor() and extractor_excel(). The best of three runs is reported. The Excel round-trip (xlsxwriter and
+openpyxl) lives only here, so the Cloud Function does not carry it.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud function'))
+from main import extractor
+from synthetic_data import make_account
+
+
+def bank_millenium(path):
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(path)
+    worksheet = workbook.add_worksheet()
+
+    worksheet.write('A1', 'date_time')
+    worksheet.write('B1', 'currency')
+    worksheet.write('C1', 'amount')
+    worksheet.write('D1', 'description')
+    worksheet.write('E1', 'institution')
+
+    return worksheet, workbook
+
+
+def extractor_excel(file, filename, quantity):
+    """
+        Previous extraction path writing transactions to an Excel workbook and reading it back.
+
+        Baseline for the benchmark, moved here from main.py; the Cloud Function uses extractor().
+
+        Args:
+            file (dict): The file containing transaction data.
+            filename (str): The name of the file.
+            quantity (int): The quantity of files.
+
+        Returns:
+            pandas.DataFrame: DataFrame containing the extracted transaction data.
+    """
+    # Skoroszyt trafia do katalogu tymczasowego, a nie do bieżącego katalogu
+    workdir = tempfile.TemporaryDirectory()
+    path = os.path.join(workdir.name, '{}.xlsx'.format(filename))
+    worksheet, workbook = bank_millenium(path)
+    print(type(file))
+
+    position = 0
+
+    data = file[0]
+
+    print(type(data))
+    # print(data)
+
+    for position, key in enumerate(data['transactions']['transactions']['booked'][:]):
+        for name in key.keys():
+            # print("keys", name)
+
+            if name == 'bookingDate':
+                try:
+                    __transaction_date = data['transactions']['transactions']['booked'][position][name]
+                    worksheet.write(position + 1, 0, __transaction_date)
+                except:
+                    pass
+
+            if name == 'transactionAmount':
+                try:
+                    __amount = data['transactions']['transactions']['booked'][position][name]['amount']
+                    __currency = data['transactions']['transactions']['booked'][position][name]['currency']
+                    worksheet.write(position + 1, 2, __amount)
+                    worksheet.write(position + 1, 1, __currency)
+                except:
+                    pass
+
+            if name == 'remittanceInformationUnstructured':
+                try:
+                    __counter_party_name = data['transactions']['transactions']['booked'][position][name]
+                    worksheet.write(position + 1, 3, __counter_party_name)
+
+                except:
+                    pass
+            if data['metadata']['institution_id'] == "PKO_BPKOPLPW":
+                worksheet.write(position + 1, 4, "PKO_BPKOPLPW")
+            else:
+                worksheet.write(position + 1, 4, "MBANK_RETAIL_BREXPLPW")
+
+    suma = position + 1
+    print("This many transactions:", suma)
+    print("This many files:", quantity)
+
+    workbook.close()
+
+    with workdir:
+        df = pd.read_excel(path, engine='openpyxl')  # openpyxl importowany przez pandas
+
+    # df["labell"] = np.nan
+
+    # for possition, el in enumerate(df['description']):
+    #     df.loc[possition, 'labell'] = assign_category(el, category_mapping)
+
+    try:
+        df = df.drop('Unnamed: 0', axis=1)
+    except:
+        pass
+
+    df['date_time'] = pd.to_datetime(df['date_time'])
+    df.loc[:, 'day'] = df['date_time'].dt.day
+    df['month'] = df['date_time'].dt.month
+    df['year'] = df['date_time'].dt.year
+    df['day_of_week'] = df['date_time'].dt.dayofweek
+
+    return df
+
+
+def best_of(func, account, runs=3):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(account, "Jacek", 1)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or [1000, 10000, 50000]
+    print("{:>10} {:>12} {:>12} {:>9}".format('rows', 'excel [s]', 'columnar [s]', 'speedup'))
+    for rows in sizes:
+        account = make_account(rows)
+        excel_time = best_of(extractor_excel, account)
+        columnar_time = best_of(extractor, account)
+        print("{:>10} {:>12.4f} {:>12.4f} {:>8.1f}x".format(rows, excel_time, columnar_time,
+                                                           excel_time / columnar_time))
@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCH_DIR, '..', 'application', 'Static_version'))
+
+from nordigen import NordigenClient
+from account_fetcher import AccountFetcher
+from stub_nordigen import start_stub
+
+"""
+Benchmark of account retrieval in the results endpoint against the local Nordigen stub.
+
+Usage:
+    python benchmarks/bench_fetch.py [accounts ...] [--latency-ms 100] [--fail-every N]
+
+For every number of accounts (default 1 3 5) the stub serves synthetic accounts with the given latency, and
+the previous sequential loop (NordigenClient.account_api() calls one after another) is compared with
+AccountFetcher. With --fail-every N the stub answers every N-th request with 503, which AccountFetcher
+retries; the sequential loop has no retries and is skipped then.
+"""
+
+
+def sequential(client, account_ids):
+    accounts_data = []
+    for account_id in account_ids:
+        account = client.account_api(account_id)
+        accounts_data.append({
+            "metadata": account.get_metadata(),
+            "details": account.get_details(),
+            "balances": account.get_balances(),
+            "transactions": account.get_transactions(),
+        })
+    return accounts_data
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    latency_ms = int(sys.argv[sys.argv.index('--latency-ms') + 1]) if '--latency-ms' in sys.argv else 100
+    fail_every = int(sys.argv[sys.argv.index('--fail-every') + 1]) if '--fail-every' in sys.argv else 0
+    options = {sys.argv[position + 1] for position, arg in enumerate(sys.argv) if arg.startswith('--')}
+    sizes = [int(arg) for arg in sys.argv[1:] if arg.isdigit() and arg not in options] or [1, 3, 5]
+
+    print("{:>9} {:>15} {:>15} {:>9} {:>14}".format(
+        'accounts', 'sequential [s]', 'concurrent [s]', 'speedup', 'max in flight'))
+    for accounts in sizes:
+        server, state, base_url = start_stub(latency_ms=latency_ms, accounts=accounts, fail_every=fail_every)
+        client = NordigenClient(secret_id='stub', secret_key='stub', base_url=base_url)
+        client.generate_token()
+        account_ids = client.requisition.get_requisition_by_id(requisition_id='stub')['accounts']
+
+        sequential_time = None
+        if not fail_every:
+            expected, sequential_time = timed(sequential, client, account_ids)
+        state.max_in_flight = 0
+        fetched, concurrent_time = timed(AccountFetcher(client).fetch_accounts, account_ids)
+        if not fail_every:
+            assert fetched == expected
+
+        print("{:>9} {:>15} {:>15.3f} {:>9} {:>14}".format(
+            accounts, '-' if sequential_time is None else '{:.3f}'.format(sequential_time), concurrent_time,
+            '-' if sequential_time is None else '{:.1f}x'.format(sequential_time / concurrent_time),
+            state.max_in_flight))
+        server.shutdown()
@@ -0,0 +1,57 @@
+"""
+Benchmark of the bank-ndjson account file format against the previous JSON list layout.
+
+Usage:
+    python benchmarks/bench_format.py [rows ...]
+
+For every size (default 10000 100000) the same synthetic account is written in both formats, then read
+back with the streaming readers of the Cloud Function. Reported: file size, write time, read time and the
+peak of Python allocations while reading.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud function'))
+from account_reader import iter_account_chunks
+from synthetic_data import write_account, write_account_ndjson
+
+
+def read_all(path):
+    rows = 0
+    with open(path, 'rb') as fp:
+        for _, chunk in iter_account_chunks(fp, path):
+            rows += len(chunk)
+    return rows
+
+
+def measure(write, path, rows):
+    start = time.perf_counter()
+    write(path, rows)
+    write_seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    read_rows = read_all(path)
+    read_seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert read_rows == rows
+    return os.path.getsize(path) / 1024 ** 2, write_seconds, read_seconds, peak / 1024 ** 2
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000]
+    print("{:>9} {:>8} {:>10} {:>10} {:>10} {:>13}".format(
+        'rows', 'format', 'size MB', 'write s', 'read s', 'read peak MB'))
+    with tempfile.TemporaryDirectory() as workdir:
+        for rows in sizes:
+            for name, write, suffix in (('json', write_account, '.json'),
+                                        ('ndjson', write_account_ndjson, '.ndjson.gz')):
+                path = os.path.join(workdir, 'account{}'.format(suffix))
+                size, write_seconds, read_seconds, peak = measure(write, path, rows)
+                print("{:>9} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>13.1f}".format(
+                    rows, name, size, write_seconds, read_seconds, peak))
@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+
+ML_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ML')
+sys.path.append(ML_DIR)
+from sklearn.metrics import classification_report, accuracy_score
+from tfidfvectorizermodel import (load_corpus, get_nlp, tokens_to_text, build_features, build_pipeline, split,
+                                  BATCH_SIZE)
+from text_normalizer import TextNormalizer, DEFAULT_TABLE_PATH
+
+"""
+Benchmark of the shared text normalizer against spaCy preprocessing.
+
+Usage:
+    python benchmarks/bench_normalizer.py [data_dir]
+
+data_dir must contain data.csv and data2.csv (defaults to the ML directory). The script reports
+preprocessing throughput of both variants and the classification_report of the training pipeline
+fitted on text preprocessed by each of them.
+"""
+
+
+def throughput(name, func, texts):
+    start = time.perf_counter()
+    result = func(texts)
+    elapsed = time.perf_counter() - start
+    print("{:<24} {:>10.0f} texts/s ({:.2f}s)".format(name, len(texts) / elapsed, elapsed))
+    return result
+
+
+def spacy_preprocess(texts):
+    return [tokens_to_text(doc) for doc in get_nlp().pipe(texts, batch_size=BATCH_SIZE)]
+
+
+def evaluate(name, merged_df, preprocessed):
+    merged_df = merged_df.copy()
+    merged_df['preprocessed_text'] = preprocessed
+    X_train, X_test, y_train, y_test = split(build_features(merged_df))
+    clf = build_pipeline()
+    clf.fit(X_train, y_train)
+    y_pred = clf.predict(X_test)
+    print('=== {} (accuracy {:.4f}) ==='.format(name, accuracy_score(y_test, y_pred)))
+    print(classification_report(y_test, y_pred))
+
+
+if __name__ == "__main__":
+    os.chdir(sys.argv[1] if len(sys.argv) > 1 else ML_DIR)
+    merged_df = load_corpus()
+    texts = merged_df['counter_party_name'].astype(str).tolist()
+    print('texts', len(texts), 'unique', len(set(texts)))
+
+    # Świeża instancja, żeby pierwszy pomiar nie korzystał z cache wyników
+    normalizer = TextNormalizer.from_file(DEFAULT_TABLE_PATH)
+    normalized = throughput('normalizer (cold)', normalizer.normalize_many, texts)
+    throughput('normalizer (warm cache)', normalizer.normalize_many, texts)
+    get_nlp()
+    lemmatized = throughput('spacy nlp.pipe', spacy_preprocess, texts)
+
+    evaluate('normalizer', merged_df, normalized)
+    evaluate('spacy', merged_df, lemmatized)
@@ -0,0 +1,227 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCH_DIR, '..', 'cloud function'))
+sys.path.append(os.path.join(BENCH_DIR, '..', 'ML'))
+
+"""
+End-to-end benchmark of the Cloud Function pipeline on synthetic data.
+
+Usage:
+    python benchmarks/bench_pipeline.py [rows ...] [--output report.json]
+
+For every size (rows per bank file, default 1000 10000 100000) a fresh interpreter:
+    1. writes three synthetic account files (PKO, mBank and a second user's PKO file) into a local
+       bucket directory,
+    2. trains a small model with the training pipeline and stores it as random_forest.joblib,
+    3. runs the stages download, parse+extract, categorize, concat, load (Parquet sink) and trend
+       with the functions of main.py, then the whole function() end to end, again with no file changed
+       (unchanged) and for the event of a single rewritten file (event_one_file). After the event the
+       table and the trend aggregates must still hold the rows of the other user's file of the same
+       institution.
+GCS and BigQuery are replaced with benchmarks/local_gcs.py and sinks.ParquetSink. For every stage
+the report contains rows/s, p50/p95/p99 latency of its calls and the peak RSS of the process
+after the stage.
+"""
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+TRAINING_ROWS = 20000
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[position]
+
+
+def peak_rss_mb():
+    # ru_maxrss jest w KB na Linuksie
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, stage, seconds, rows=0, bytes_read=0):
+        entry = self.stages.setdefault(stage, {'latencies': [], 'rows': 0, 'bytes': 0})
+        entry['latencies'].append(seconds)
+        entry['rows'] += rows
+        entry['bytes'] += bytes_read
+        entry['peak_rss_mb'] = peak_rss_mb()
+
+    def report(self):
+        report = {}
+        for stage, entry in self.stages.items():
+            total = sum(entry['latencies'])
+            report[stage] = {
+                'calls': len(entry['latencies']),
+                'rows': entry['rows'],
+                'bytes': entry['bytes'],
+                'seconds': round(total, 4),
+                'rows_per_second': round(entry['rows'] / total, 1) if total and entry['rows'] else None,
+                'p50_ms': round(percentile(entry['latencies'], 50) * 1000, 3),
+                'p95_ms': round(percentile(entry['latencies'], 95) * 1000, 3),
+                'p99_ms': round(percentile(entry['latencies'], 99) * 1000, 3),
+                'peak_rss_mb': round(entry['peak_rss_mb'], 1),
+            }
+        return report
+
+
+def train_model(path):
+    from synthetic_data import make_account, iter_transactions
+    from tfidfvectorizermodel import build_pipeline, LABELS, selected_columns, preprocess_corpus, tag_text_format
+    import main
+    import joblib
+
+    df = main.extractor(make_account(TRAINING_ROWS, seed=7), "bench", 1)
+    labels = [LABELS[category] for category, _ in iter_transactions(TRAINING_ROWS, "PKO_BPKOPLPW", seed=7)]
+    # Model dostaje ten sam tekst, co w assign_category()
+    df['preprocessed_text'] = preprocess_corpus(df['description'])
+    clf = build_pipeline().set_params(classifier__n_estimators=30, classifier__n_jobs=1)
+    clf.fit(df[selected_columns], labels)
+    joblib.dump(tag_text_format(clf), path)
+
+
+def run_size(rows, workdir):
+    """
+        Run all stages for one size; executed in a fresh interpreter.
+    """
+    bucket_root = os.path.join(workdir, 'gcs')
+    os.environ.update({
+        'MAX_WORKERS': '1',
+        'SINK': 'parquet',
+        'PARQUET_ROOT': os.path.join(workdir, 'parquet'),
+        'MODEL_CACHE_DIR': os.path.join(workdir, 'model_cache'),
+        'PREDICTION_CACHE_PATH': os.path.join(workdir, 'prediction_cache.sqlite'),
+    })
+    from local_gcs import LocalStorageClient
+    from synthetic_data import write_account, INSTITUTIONS
+    import main
+    from account_reader import iter_booked_chunks
+    from trend_store import TrendStore
+
+    client = LocalStorageClient(bucket_root)
+    main._storage_client = client
+    bucket = client.bucket(main.BUCKET_NAME)
+    for seed, institution_id in enumerate(INSTITUTIONS):
+        write_account(os.path.join(bucket.root, "Jan Kowalski {}.json".format(institution_id)), rows,
+                      institution_id, seed=seed)
+    # Drugi użytkownik tego samego banku: zdarzenie dla pliku Jana nie może usunąć jego wierszy
+    write_account(os.path.join(bucket.root, "Anna Nowak {}.json".format(INSTITUTIONS[0])), rows,
+                  INSTITUTIONS[0], seed=len(INSTITUTIONS) + 1)
+    files = len(INSTITUTIONS) + 1
+    train_model(os.path.join(bucket.root, main.MODEL_FILE_NAME))
+
+    timer = StageTimer()
+    categories_mapping = main.create_categories_mapping()
+
+    start = time.perf_counter()
+    loaded_model = main.load_model()
+    timer.record('model_load', time.perf_counter() - start)
+
+    dfs = []
+    for blob in main.list_account_files(bucket):
+        start = time.perf_counter()
+        payload = blob.download_as_bytes()
+        timer.record('download', time.perf_counter() - start, bytes_read=len(payload))
+
+        chunks = iter_booked_chunks(BytesIO(payload))
+        while True:
+            start = time.perf_counter()
+            account, booked = next(chunks, (None, None))
+            if booked is None:
+                break
+            df = main.extract_booked(booked, main.institution_name(account['institution_id']))
+            timer.record('parse_extract', time.perf_counter() - start, rows=len(df))
+
+            start = time.perf_counter()
+            df = main.assign_category(df, categories_mapping, loaded_model)
+            df['source_file'] = blob.name
+            timer.record('categorize', time.perf_counter() - start, rows=len(df))
+            dfs.append(df)
+
+    start = time.perf_counter()
+    df_final = main.pd.concat(dfs, ignore_index=True)
+    timer.record('concat', time.perf_counter() - start, rows=len(df_final))
+
+    start = time.perf_counter()
+    main.load(df_final, 'bank_data_table', load_mode='truncate')
+    timer.record('load', time.perf_counter() - start, rows=len(df_final))
+
+    start = time.perf_counter()
+    TrendStore.from_frame(df_final).label_totals()
+    timer.record('trend', time.perf_counter() - start, rows=len(df_final))
+
+    start = time.perf_counter()
+    main.function(None, None)
+    timer.record('end_to_end', time.perf_counter() - start, rows=len(df_final))
+
+    # Pliki się nie zmieniły: funkcja kończy po porównaniu odcisków z listingu
+    start = time.perf_counter()
+    main.function(None, None)
+    timer.record('unchanged', time.perf_counter() - start)
+
+    # Wywołanie dla jednego zmienionego pliku, tak jak z triggera bucketa
+    path = write_account(os.path.join(bucket.root, "Jan Kowalski {}.json".format(INSTITUTIONS[0])), rows,
+                         INSTITUTIONS[0], seed=len(INSTITUTIONS))
+    blob = bucket.get_blob(os.path.basename(path))
+    start = time.perf_counter()
+    main.function({'bucket': main.BUCKET_NAME, 'name': blob.name, 'generation': str(blob.generation)}, None)
+    timer.record('event_one_file', time.perf_counter() - start, rows=rows)
+
+    stored = main.get_sink().read('bank_data_table')
+    assert len(stored) == rows * files, "event replaced {} rows of {}".format(rows * files - len(stored), rows * files)
+    assert stored.groupby('source_file', observed=True).size().to_dict() == {
+        blob.name: rows for blob in main.list_account_files(bucket)}, "rows of other files changed"
+    counts = sum(entry['count'] for entry in TrendStore.load(bucket).monthly.values())
+    assert counts == rows * files, "trend aggregates hold {} rows instead of {}".format(counts, rows * files)
+
+    return {'rows_per_file': rows, 'files': files, 'stages': timer.report()}
+
+
+def print_report(result):
+    print("\n== {} rows x {} files ==".format(result['rows_per_file'], result['files']))
+    print("{:<14} {:>12} {:>10} {:>10} {:>10} {:>10}".format(
+        'stage', 'rows/s', 'p50 ms', 'p95 ms', 'p99 ms', 'rss MB'))
+    for stage, values in result['stages'].items():
+        print("{:<14} {:>12} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f}".format(
+            stage, values['rows_per_second'] or '-', values['p50_ms'], values['p95_ms'], values['p99_ms'],
+            values['peak_rss_mb']))
+
+
+if __name__ == "__main__":
+    if '--single' in sys.argv:
+        rows = int(sys.argv[sys.argv.index('--single') + 1])
+        with tempfile.TemporaryDirectory() as workdir:
+            result = run_size(rows, workdir)
+        # Ostatnia linia wyjścia to wynik dla procesu nadrzędnego
+        print(json.dumps(result))
+        sys.exit(0)
+
+    output = sys.argv[sys.argv.index('--output') + 1] if '--output' in sys.argv else None
+    sizes = [int(arg) for arg in sys.argv[1:] if arg.isdigit()] or DEFAULT_SIZES
+    results = []
+    for rows in sizes:
+        # Każdy rozmiar w osobnym procesie, żeby peak RSS nie przenosił się między pomiarami
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--single', str(rows)],
+                                 capture_output=True, text=True)
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr)
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print_report(result)
+
+    if output:
+        with open(output, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
@@ -0,0 +1,102 @@
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCH_DIR, '..', 'application', 'Static_version'))
+
+from nordigen import NordigenClient
+from account_fetcher import AccountFetcher
+from account_writer import FILE_SUFFIX, iter_stored_records, read_header, sync_dates, upload_accounts
+from local_gcs import LocalStorageClient
+from stub_nordigen import start_stub
+from synthetic_data import user_record
+
+"""
+Benchmark of incremental account syncs against the local Nordigen stub and a local bucket.
+
+Usage:
+    python benchmarks/bench_sync.py [--accounts 3] [--transactions 20000] [--days 1 7 30] [--latency-ms 20]
+
+The first sync fetches the whole history of every account. The stub's date is then moved forward by each
+--days value in turn and the account file is synced again the same way app.results() does it: the
+watermark from the stored header gives date_from, only that window is fetched and it is merged into the
+stored file. For every sync the time, the payload received from the API and the number of booked
+transactions fetched, deduplicated and kept is printed, next to a full re-fetch of the same history.
+The merged file is checked to hold every visible transaction exactly once.
+"""
+
+BASE_NAME = 'name surname PKO_BPKOPLPW'
+
+
+def sync(bucket, fetcher, account_ids):
+    stored = bucket.get_blob(BASE_NAME + FILE_SUFFIX)
+    header = read_header(stored) if stored is not None else None
+    start = time.perf_counter()
+    bytes_before = fetcher.bytes_received
+    accounts_data = fetcher.fetch_accounts(account_ids, date_from=sync_dates(header, account_ids))
+    upload = upload_accounts(bucket, BASE_NAME, accounts_data, user_record('PKO_BPKOPLPW'),
+                             stored=stored, header=header)
+    upload['seconds'] = time.perf_counter() - start
+    upload['payload'] = fetcher.bytes_received - bytes_before
+    return upload
+
+
+def full_fetch(fetcher, account_ids):
+    start = time.perf_counter()
+    bytes_before = fetcher.bytes_received
+    fetcher.fetch_accounts(account_ids)
+    return time.perf_counter() - start, fetcher.bytes_received - bytes_before
+
+
+def stored_keys(bucket):
+    keys = []
+    account = None
+    for record in iter_stored_records(bucket.get_blob(BASE_NAME + FILE_SUFFIX)):
+        if record['type'] == 'account':
+            account = record['metadata']['id']
+        elif record['type'] == 'booked':
+            keys.append((account, record['transaction']['transactionId']))
+    assert len(keys) == len(set(keys)), "duplicated transactions in the merged file"
+    return set(keys)
+
+
+if __name__ == "__main__":
+    def option(name, default):
+        return int(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+    days = [int(arg) for arg in sys.argv[sys.argv.index('--days') + 1:] if arg.isdigit()] \
+        if '--days' in sys.argv else [1, 7, 30]
+    server, state, base_url = start_stub(latency_ms=option('--latency-ms', 20), accounts=option('--accounts', 3),
+                                         transactions=option('--transactions', 20000))
+    # Historia syntetyczna kończy się 2024-06-30; startujemy wcześniej, żeby było co dociągać
+    today = date(2024, 6, 30) - timedelta(days=sum(days))
+    state.today = today.isoformat()
+
+    client = NordigenClient(secret_id='stub', secret_key='stub', base_url=base_url)
+    client.generate_token()
+    account_ids = client.requisition.get_requisition_by_id(requisition_id='stub')['accounts']
+    fetcher = AccountFetcher(client)
+
+    with tempfile.TemporaryDirectory() as root:
+        bucket = LocalStorageClient(root).bucket('bank_data_milo')
+        print("{:>10} {:>9} {:>13} {:>9} {:>11} {:>9} {:>14} {:>16}".format(
+            'sync', 'time [s]', 'payload [kB]', 'fetched', 'duplicates', 'kept', 'full time [s]',
+            'full payload [kB]'))
+        label = 'initial'
+        for step in [0] + days:
+            today += timedelta(days=step)
+            state.today = today.isoformat()
+            if step:
+                label = '+{}d'.format(step)
+            result = sync(bucket, fetcher, account_ids)
+            full_seconds, full_payload = full_fetch(fetcher, account_ids)
+            expected = {(account, transaction['transactionId']) for account in account_ids
+                        for transaction in state.account_transactions(account)['transactions']['booked']}
+            assert stored_keys(bucket) == expected, "merged file differs from the full history"
+            print("{:>10} {:>9.3f} {:>13.1f} {:>9} {:>11} {:>9} {:>14.3f} {:>16.1f}".format(
+                label, result['seconds'], result['payload'] / 1024, result['fetched'], result['duplicates'],
+                result['kept'], full_seconds, full_payload / 1024))
+    server.shutdown()
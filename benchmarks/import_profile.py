@@ -0,0 +1,71 @@
+"""
+Import-time profile of the Cloud Function module.
+
+Usage:
+    python benchmarks/import_profile.py [--top N] [--output report.json]
+
+The module is imported in a fresh interpreter with `python -X importtime`. The report contains the
+wall time of `import main` and the modules with the largest cumulative import time. Keep the JSON
+report of every release to track cold-start latency over time.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud function')
+
+
+def parse_importtime(stderr):
+    """
+        Parse `-X importtime` output into a list of (module, self_us, cumulative_us).
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        # Nazwa poprzedzona jest jedną spacją i dwiema kolejnymi na każdy poziom zagnieżdżenia
+        modules.append((name[1:].rstrip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def profile(top=20):
+    env = dict(os.environ, PREWARM_MODEL="0")
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                             cwd=FUNCTION_DIR, env=env, capture_output=True, text=True)
+    wall_seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr)
+
+    modules = parse_importtime(process.stderr)
+    main_us = next(cumulative_us for name, _, cumulative_us in modules if name == 'main')
+    # Bezpośrednie importy modułu main, czyli moduły z jednym poziomem wcięcia
+    direct = [module for module in modules if module[0].startswith('  ') and not module[0].startswith('    ')]
+    return {
+        'python': sys.version.split()[0],
+        'wall_seconds': round(wall_seconds, 4),
+        'import_main_seconds': round(main_us / 1e6, 4),
+        'modules_imported': len(modules),
+        'top_cumulative': [
+            {'module': name.strip(), 'self_ms': round(self_us / 1000, 2), 'cumulative_ms': round(cumulative_us / 1000, 2)}
+            for name, self_us, cumulative_us in sorted(direct, key=lambda module: -module[2])[:top]
+        ],
+    }
+
+
+if __name__ == "__main__":
+    top = int(sys.argv[sys.argv.index('--top') + 1]) if '--top' in sys.argv else 20
+    report = profile(top)
+
+    print("import main: {:.3f}s (process wall {:.3f}s), {} modules".format(
+        report['import_main_seconds'], report['wall_seconds'], report['modules_imported']))
+    for module in report['top_cumulative']:
+        print("{:>10.1f} ms  {}".format(module['cumulative_ms'], module['module']))
+
+    if '--output' in sys.argv:
+        with open(sys.argv[sys.argv.index('--output') + 1], 'w') as output:
+            json.dump(report, output, indent=2)
@@ -0,0 +1,158 @@
+"""
+Local stand-ins for the parts of google.cloud.storage used by the Cloud Function.
+
+A bucket is a directory and a blob is a file inside it; the generation is the file's mtime in
+nanoseconds, so rewriting a file behaves like uploading a new generation. Like an upload, a file opened
+for writing only replaces the blob when it is closed, and if_generation_match is checked then. Used by the
+benchmark harness to run the pipeline offline.
+"""
+
+import base64
+import hashlib
+import io
+import os
+import shutil
+from datetime import datetime, timezone
+
+
+class PreconditionFailed(Exception):
+    pass
+
+
+class LocalUpload(io.FileIO):
+    """
+    Binary file written next to the blob and moved over it on close.
+    """
+
+    def __init__(self, blob, if_generation_match=None):
+        self.blob = blob
+        self.if_generation_match = if_generation_match
+        super().__init__(blob.path + '.upload', 'wb')
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        current = LocalBlob(self.blob.bucket, self.blob.name).generation or 0
+        if self.if_generation_match is not None and current != self.if_generation_match:
+            os.remove(self.name)
+            raise PreconditionFailed("{} was modified".format(self.blob.name))
+        os.replace(self.name, self.blob.path)
+
+
+class LocalBlob:
+
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        # Jak w GCS: obiekt z get_blob() pamięta generację z chwili pobrania
+        self._generation = generation
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    @property
+    def generation(self):
+        if self._generation is not None:
+            return self._generation
+        return os.stat(self.path).st_mtime_ns if self.exists() else None
+
+    @property
+    def etag(self):
+        return str(self.generation)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    @property
+    def updated(self):
+        return datetime.fromtimestamp(os.path.getmtime(self.path), tz=timezone.utc)
+
+    @property
+    def md5_hash(self):
+        digest = hashlib.md5()
+        with open(self.path, 'rb') as blob_file:
+            for block in iter(lambda: blob_file.read(1024 * 1024), b''):
+                digest.update(block)
+        return base64.b64encode(digest.digest()).decode('ascii')
+
+    def reload(self):
+        pass
+
+    def open(self, mode='rb', chunk_size=None, if_generation_match=None, **kwargs):
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if 'b' in mode:
+                return LocalUpload(self, if_generation_match)
+        if 'b' in mode:
+            return open(self.path, mode)
+        return open(self.path, mode, encoding='utf8')
+
+    def download_as_bytes(self):
+        with open(self.path, 'rb') as blob_file:
+            return blob_file.read()
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode('utf8')
+
+    def download_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+    def upload_from_string(self, data, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        with open(self.path, 'wb') as blob_file:
+            blob_file.write(data)
+
+    def upload_from_filename(self, filename, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+    def delete(self):
+        os.remove(self.path)
+
+
+class LocalBucket:
+
+    def __init__(self, root, name):
+        self.root = os.path.join(root, name)
+        self.name = name
+        os.makedirs(self.root, exist_ok=True)
+
+    def blob(self, name, generation=None):
+        return LocalBlob(self, name, generation)
+
+    def get_blob(self, name):
+        blob = LocalBlob(self, name)
+        return LocalBlob(self, name, blob.generation) if blob.exists() else None
+
+    def list_blobs(self, prefix=''):
+        blobs = []
+        for directory, _, names in os.walk(self.root):
+            for file_name in names:
+                name = os.path.relpath(os.path.join(directory, file_name), self.root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    blobs.append(LocalBlob(self, name))
+        return sorted(blobs, key=lambda blob: blob.name)
+
+
+class LocalStorageClient:
+
+    def __init__(self, root):
+        self.root = root
+
+    def bucket(self, name):
+        return LocalBucket(self.root, name)
+
+    def get_bucket(self, name):
+        return self.bucket(name)
+
+    def list_blobs(self, bucket_or_name, prefix=''):
+        bucket = bucket_or_name if isinstance(bucket_or_name, LocalBucket) else self.bucket(bucket_or_name)
+        return bucket.list_blobs(prefix=prefix)
@@ -0,0 +1,163 @@
+"""
+Local stub of the Nordigen API v2 used by application/Static_version/app.py.
+
+Usage:
+    python benchmarks/stub_nordigen.py [--port 8765] [--latency-ms 100] [--accounts 3] [--transactions 500]
+                                       [--fail-every N]
+
+Serves token/new, token/refresh, institutions, requisitions/<id> (with --accounts accounts) and
+accounts/<id>/{,details,balances,transactions} with synthetic data. Every response is delayed by
+--latency-ms to simulate the round-trip to the bank API; with --fail-every N every N-th request is answered
+with 503 and Retry-After: 0, to exercise retries. The transactions endpoint honours date_from, and
+StubState.today hides transactions booked after it, so moving it forward simulates new account activity.
+The base URL for NordigenClient is http://127.0.0.1:<port>/api/v2.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from synthetic_data import account_header, iter_transactions, INSTITUTIONS
+
+API_PREFIX = '/api/v2/'
+
+
+class StubState:
+
+    def __init__(self, latency_ms=100, accounts=3, transactions=500, fail_every=0):
+        self.latency = latency_ms / 1000
+        self.accounts = ['account-{}'.format(position) for position in range(accounts)]
+        self.transactions = transactions
+        self.fail_every = fail_every
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self._transactions_cache = {}
+        # Transakcje z późniejszą datą księgowania jeszcze "nie istnieją"
+        self.today = None
+
+    def institution_id(self, account_id):
+        return INSTITUTIONS[self.accounts.index(account_id) % len(INSTITUTIONS)]
+
+    def account_transactions(self, account_id, date_from=None):
+        if account_id not in self._transactions_cache:
+            booked = [transaction for _, transaction in iter_transactions(
+                self.transactions, self.institution_id(account_id), seed=self.accounts.index(account_id))]
+            self._transactions_cache[account_id] = booked
+        booked = [transaction for transaction in self._transactions_cache[account_id]
+                  if (self.today is None or transaction['bookingDate'] <= self.today)
+                  and (date_from is None or transaction['bookingDate'] >= date_from)]
+        return {'transactions': {'booked': booked, 'pending': []}}
+
+    def route(self, method, path, query=None):
+        """
+            Return (status, body) of a request.
+        """
+        query = query or {}
+        parts = [part for part in path[len(API_PREFIX):].split('/') if part]
+        if method == 'POST' and parts[:1] == ['token']:
+            return 200, {'access': 'stub-access-{}'.format(time.time()), 'access_expires': 86400,
+                         'refresh': 'stub-refresh', 'refresh_expires': 2592000}
+        if parts[:1] == ['institutions']:
+            return 200, [{'id': institution, 'name': institution, 'bic': institution.split('_')[-1],
+                          'transaction_total_days': '730', 'countries': ['PL'], 'logo': ''}
+                         for institution in INSTITUTIONS]
+        if parts[:1] == ['requisitions'] and len(parts) == 2:
+            return 200, {'id': parts[1], 'status': 'LN', 'accounts': self.accounts}
+        if parts[:1] == ['accounts'] and len(parts) >= 2 and parts[1] in self.accounts:
+            account_id = parts[1]
+            header = account_header(self.institution_id(account_id), account_id)
+            resource = parts[2] if len(parts) > 2 else 'metadata'
+            if resource == 'metadata':
+                return 200, header['metadata']
+            if resource == 'details':
+                return 200, header['details']
+            if resource == 'balances':
+                return 200, header['balances']
+            if resource == 'transactions':
+                return 200, self.account_transactions(account_id, (query.get('date_from') or [None])[0])
+        return 404, {'summary': 'Not found', 'status_code': 404}
+
+
+def make_handler(state):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _respond(self, method):
+            with state.lock:
+                state.requests += 1
+                number = state.requests
+                state.in_flight += 1
+                state.max_in_flight = max(state.max_in_flight, state.in_flight)
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                time.sleep(state.latency)
+                if state.fail_every and number % state.fail_every == 0:
+                    status, body, headers = 503, {'summary': 'Service unavailable'}, {'Retry-After': '0'}
+                else:
+                    url = urlparse(self.path)
+                    status, body = state.route(method, url.path, parse_qs(url.query))
+                    headers = {}
+                payload = json.dumps(body).encode('utf8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+            finally:
+                with state.lock:
+                    state.in_flight -= 1
+
+        def do_GET(self):
+            self._respond('GET')
+
+        def do_POST(self):
+            self._respond('POST')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_stub(port=0, **kwargs):
+    """
+        Start the stub on a background thread.
+
+        Returns:
+            tuple: (server, state, base_url); call server.shutdown() to stop it.
+    """
+    state = StubState(**kwargs)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, 'http://127.0.0.1:{}/api/v2'.format(server.server_address[1])
+
+
+if __name__ == "__main__":
+    def option(name, default):
+        return int(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+    server, state, base_url = start_stub(
+        port=option('--port', int(os.environ.get('STUB_PORT', 8765))),
+        latency_ms=option('--latency-ms', 100),
+        accounts=option('--accounts', 3),
+        transactions=option('--transactions', 500),
+        fail_every=option('--fail-every', 0),
+    )
+    print('Nordigen stub listening on', base_url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
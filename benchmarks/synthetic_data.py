@@ -0,0 +1,147 @@
+"""
+Generator of synthetic Nordigen account files.
+
+The files have the exact shape read by extractor() and the streaming reader in the Cloud Function:
+[{"metadata": {"id", "institution_id", ...}, "details": {...}, "balances": {...},
+  "transactions": {"transactions": {"booked": [...], "pending": []}}}, {user}]
+Booked transactions carry transactionId, bookingDate, valueDate, transactionAmount and
+remittanceInformationUnstructured in the PKO or mBank description format. Files are written
+transaction by transaction, so sizes up to 10M rows do not need the whole account in memory.
+write_account_ndjson() writes the same account in the bank-ndjson format of the uploader.
+
+Usage:
+    python benchmarks/synthetic_data.py ROWS [--institution PKO_BPKOPLPW] [--output FILE] [--seed N]
+                                        [--format json|ndjson]
+"""
+
+import json
+import os
+import random
+import sys
+from datetime import date, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'application', 'Static_version'))
+
+INSTITUTIONS = ["PKO_BPKOPLPW", "MBANK_RETAIL_BREXPLPW"]
+
+# (kategoria, sprzedawcy, mediana kwoty, znak)
+MERCHANTS = [
+    ('Food and drinks', ['RESTAURACJA WILCZA', 'PIZZA HUT', 'PP*RESTAUMATIC.COM', 'STARBUCKS', 'MCDONALDS'], 45, -1),
+    ('General merchandise', ['ZABKA Z{n}', 'LIDL SP Z O O', 'CARREFOUR EXPRESS', 'ROSSMANN {n}', 'ALLEGRO.PL'], 60, -1),
+    ('Transportation', ['BOLT.EU/O/{n}', 'CIRCLE K {n}', 'SPP PARKING', 'ORLEN STACJA NR {n}', 'UBER *TRIP'], 35, -1),
+    ('Entertainment', ['NETFLIX.COM', 'SPOTIFY P{n}', 'DISNEY PLUS', 'CINEMA CITY', 'EVENTIM.PL-PL-ECOM'], 50, -1),
+    ('Personal and healthcare', ['APTEKA CEFARM', 'PORADNIA MEDYCZNA', 'LUX MED', 'HEBE {n}'], 80, -1),
+    ('Rent and utilities', ['CZYNSZ MIESZKANIE', 'PGE OBROT FAKTURA {n}', 'ORANGE POLSKA'], 900, -1),
+    ('Income', ['WYNAGRODZENIE ZA MIESIAC', 'PRZELEW OD PRACODAWCY'], 7000, 1),
+    ('Cash', ['WYPLATA Z BANKOMATU {n}'], 200, -1),
+    ('Bank fees', ['OPLATA ZA KARTE', 'PROWIZJA ZA PRZELEW'], 7, -1),
+    ('Travel', ['BOOKING.COM', 'RYANAIR', 'PKP INTERCITY'], 400, -1),
+]
+WEIGHTS = [18, 30, 14, 6, 6, 3, 2, 4, 3, 2]
+
+
+def describe(merchant, institution_id, booking_date, amount, rng):
+    name = merchant.format(n=rng.randint(100, 9999))
+    if institution_id == "PKO_BPKOPLPW":
+        return ("Lokalizacja: Adres: {} Miasto: WARSZAWA Kraj: POLSKA Data wykonania operacji: {} "
+                "Oryginalna kwota operacji: {:.2f} Numer karty: 425125******{:04d}").format(
+            name, booking_date, abs(amount), rng.randint(0, 9999))
+    return "{} /WARSZAWA DATA TRANSAKCJI: {}".format(name, booking_date)
+
+
+def iter_transactions(rows, institution_id, seed=2024, end=date(2024, 6, 30), per_day=None):
+    """
+        Generator of (category, booked transaction) pairs, newest first like the Nordigen API.
+
+        By default at least 4 transactions are booked per day and the history spans at most 10 years.
+    """
+    rng = random.Random(seed)
+    per_day = per_day or max(4, -(-rows // 3650))
+    for position in range(rows):
+        category, merchants, median, sign = rng.choices(MERCHANTS, WEIGHTS)[0]
+        booking_date = (end - timedelta(days=position // per_day)).isoformat()
+        amount = sign * round(rng.lognormvariate(0, 0.6) * median, 2)
+        yield category, {
+            'transactionId': '{}-{:010d}'.format(institution_id[:4], position),
+            'bookingDate': booking_date,
+            'valueDate': booking_date,
+            'transactionAmount': {'amount': '{:.2f}'.format(amount), 'currency': 'PLN'},
+            'remittanceInformationUnstructured': describe(rng.choice(merchants), institution_id, booking_date,
+                                                          amount, rng),
+        }
+
+
+def account_header(institution_id, account_id):
+    return {
+        'metadata': {'id': account_id, 'institution_id': institution_id, 'status': 'READY',
+                     'iban': 'PL00000000000000000000000000', 'owner_name': 'Jan Kowalski'},
+        'details': {'account': {'currency': 'PLN', 'name': 'Konto'}},
+        'balances': {'balances': []},
+    }
+
+
+def make_account(rows, institution_id="PKO_BPKOPLPW", seed=2024):
+    """
+        Build an account file as a Python list, for small sizes.
+    """
+    account = account_header(institution_id, 'account-{}'.format(institution_id))
+    booked = [transaction for _, transaction in iter_transactions(rows, institution_id, seed)]
+    account['transactions'] = {'transactions': {'booked': booked, 'pending': []}}
+    return [account, user_record(institution_id)]
+
+
+def user_record(institution_id):
+    return {'user_name': 'Jan', 'user_last_name': 'Kowalski', 'user_email': 'email',
+            'user_full_name': 'Jan Kowalski', 'institution': institution_id}
+
+
+def write_account(path, rows, institution_id="PKO_BPKOPLPW", seed=2024, labels_path=None):
+    """
+        Write an account file transaction by transaction; optionally write the true category
+        of every transaction (one per line) to `labels_path`.
+    """
+    header = account_header(institution_id, 'account-{}'.format(institution_id))
+    labels = open(labels_path, 'w', encoding='utf8') if labels_path else None
+    with open(path, 'w', encoding='utf8') as output:
+        # Nagłówek konta bez zamykającego nawiasu, transakcje dopisywane są po kolei
+        output.write('[' + json.dumps(header, ensure_ascii=False)[:-1])
+        output.write(', "transactions": {"transactions": {"booked": [')
+        for position, (category, transaction) in enumerate(iter_transactions(rows, institution_id, seed)):
+            if position:
+                output.write(',')
+            output.write(json.dumps(transaction, ensure_ascii=False))
+            if labels:
+                labels.write(category + '\n')
+        output.write('], "pending": []}}}, ')
+        output.write(json.dumps(user_record(institution_id), ensure_ascii=False) + ']')
+    if labels:
+        labels.close()
+    return path
+
+
+def write_account_ndjson(path, rows, institution_id="PKO_BPKOPLPW", seed=2024):
+    """
+        Write an account file in the bank-ndjson format (*.ndjson.gz), transaction by transaction.
+    """
+    from account_writer import write_accounts
+    account = account_header(institution_id, 'account-{}'.format(institution_id))
+    booked = (transaction for _, transaction in iter_transactions(rows, institution_id, seed))
+    account['transactions'] = {'transactions': {'booked': booked, 'pending': []}}
+    with open(path, 'wb') as output:
+        write_accounts(output, [account], user_record(institution_id))
+    return path
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1])
+    institution_id = sys.argv[sys.argv.index('--institution') + 1] if '--institution' in sys.argv else INSTITUTIONS[0]
+    seed = int(sys.argv[sys.argv.index('--seed') + 1]) if '--seed' in sys.argv else 2024
+    file_format = sys.argv[sys.argv.index('--format') + 1] if '--format' in sys.argv else 'json'
+    suffix = '.ndjson.gz' if file_format == 'ndjson' else '.json'
+    output = (sys.argv[sys.argv.index('--output') + 1] if '--output' in sys.argv
+              else "Jan Kowalski {}{}".format(institution_id, suffix))
+    if file_format == 'ndjson':
+        write_account_ndjson(output, rows, institution_id, seed)
+    else:
+        write_account(output, rows, institution_id, seed)
+    print("{} transactions -> {} ({:.1f} MB)".format(rows, output, os.path.getsize(output) / 1e6))
@@ -0,0 +1,153 @@
+"""
+Streaming reader for Nordigen account files.
+
+The account files uploaded to the bucket are JSON lists where every account looks like
+{"metadata": {...}, "details": {...}, "balances": {...}, "transactions": {"transactions": {"booked": [...]}}}.
+Instead of loading the whole document with json.loads, the file is walked event by event and
+booked transactions are handed out in fixed-size chunks, so memory depends on the chunk size
+and not on the length of the history.
+
+Files uploaded in the bank-ndjson format (*.ndjson.gz, written by application/Static_version/account_writer.py)
+are gzip-compressed with one record per line: a header, then every account followed by its booked
+transactions. They are decompressed and parsed line by line by iter_ndjson_chunks(). The previous JSON
+list layout (*.json) is still read with iter_booked_chunks(). A bank-ndjson file replaces the *.json
+file of the same user (see legacy_name()), which the uploader deletes after writing it.
+"""
+
+import gzip
+import json
+
+import ijson
+
+DEFAULT_CHUNK_SIZE = 5000
+
+ACCOUNT_PREFIXES = {
+    'item.metadata.institution_id': 'institution_id',
+    'item.metadata.id': 'id',
+}
+BOOKED_ITEM_PREFIX = 'item.transactions.transactions.booked.item'
+
+# Te same wartości co w account_writer.py aplikacji
+NDJSON_FORMAT = 'bank-ndjson'
+NDJSON_SUFFIX = '.ndjson.gz'
+LEGACY_SUFFIX = '.json'
+SUPPORTED_NDJSON_VERSION = 1
+
+
+def iter_booked_chunks(fp, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+        Generator yielding booked transactions of the first account in the file.
+
+        Like extractor(), only the first account of the list is read; parsing stops
+        as soon as that account is closed.
+
+        Args:
+            fp: Binary file-like object with the account JSON (e.g. blob.open('rb')).
+            chunk_size (int): Maximum number of transactions in one chunk.
+
+        Yields:
+            tuple: (account, list of booked transaction dicts), where account is a dict with
+                the 'institution_id' and 'id' taken from the account metadata.
+    """
+    account = {'institution_id': None, 'id': None}
+    chunk = []
+    builder = None
+
+    for prefix, event, value in ijson.parse(fp):
+        if builder is not None:
+            builder.event(event, value)
+            if event == 'end_map' and prefix == BOOKED_ITEM_PREFIX:
+                chunk.append(builder.value)
+                builder = None
+                # Metadata is written before transactions, but keep buffering if it is not known yet
+                if len(chunk) >= chunk_size and account['institution_id'] is not None:
+                    yield account, chunk
+                    chunk = []
+            continue
+
+        if event == 'start_map' and prefix == BOOKED_ITEM_PREFIX:
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix in ACCOUNT_PREFIXES:
+            account[ACCOUNT_PREFIXES[prefix]] = value
+        elif event == 'end_map' and prefix == 'item':
+            break
+
+    if chunk:
+        yield account, chunk
+
+
+def iter_ndjson_chunks(fp, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+        Generator yielding booked transactions of every account of a bank-ndjson file.
+
+        Args:
+            fp: Binary file-like object with the gzip-compressed file (e.g. blob.open('rb')).
+            chunk_size (int): Maximum number of transactions in one chunk.
+
+        Yields:
+            tuple: (account, list of booked transaction dicts), like iter_booked_chunks().
+
+        Raises:
+            ValueError: When the file has no bank-ndjson header or its version is not supported.
+    """
+    account = None
+    chunk = []
+
+    with gzip.GzipFile(fileobj=fp, mode='rb') as lines:
+        header = json.loads(lines.readline() or b'{}')
+        if header.get('type') != 'header' or header.get('format') != NDJSON_FORMAT:
+            raise ValueError("Not a {} file".format(NDJSON_FORMAT))
+        if header.get('version', 0) > SUPPORTED_NDJSON_VERSION:
+            raise ValueError("Unsupported {} version {}".format(NDJSON_FORMAT, header.get('version')))
+
+        for line in lines:
+            record = json.loads(line)
+            record_type = record.get('type')
+            if record_type == 'booked':
+                chunk.append(record['transaction'])
+                if len(chunk) >= chunk_size:
+                    yield account, chunk
+                    chunk = []
+            elif record_type == 'account':
+                if chunk:
+                    yield account, chunk
+                    chunk = []
+                metadata = record.get('metadata') or {}
+                account = {'institution_id': metadata.get('institution_id'), 'id': metadata.get('id')}
+
+    if chunk:
+        yield account, chunk
+
+
+def is_account_file(name):
+    return name.endswith(NDJSON_SUFFIX) or name.endswith(LEGACY_SUFFIX)
+
+
+def legacy_name(name):
+    """
+        Return the name of the legacy *.json file replaced by the bank-ndjson file `name`, or None when
+        `name` is not a bank-ndjson file.
+    """
+    if name.endswith(NDJSON_SUFFIX):
+        return name[:-len(NDJSON_SUFFIX)] + LEGACY_SUFFIX
+    return None
+
+
+def ndjson_name(name):
+    """
+        Return the name of the bank-ndjson file replacing the legacy *.json file `name`, or None when
+        `name` is not a legacy file.
+    """
+    if name.endswith(LEGACY_SUFFIX):
+        return name[:-len(LEGACY_SUFFIX)] + NDJSON_SUFFIX
+    return None
+
+
+def iter_account_chunks(fp, name, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+        Read an account file in the format given by its name: bank-ndjson for *.ndjson.gz, JSON list otherwise.
+    """
+    if name and name.endswith(NDJSON_SUFFIX):
+        return iter_ndjson_chunks(fp, chunk_size)
+    return iter_booked_chunks(fp, chunk_size)
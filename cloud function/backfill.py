@@ -0,0 +1,552 @@
+"""
+Backfill: re-categorize the stored transaction history with a new model.
+
+Usage:
+    python "cloud function/backfill.py" [--sink parquet|bigquery] [--model random_forest.joblib]
+                                        [--root /tmp/bank_data] [--workers 4] [--chunk-rows 50000]
+                                        [--checkpoint path] [--report backfill_report.json] [--restart]
+
+Works on bank_data_table of the sink selected with --sink (SINK by default, like the Cloud Function). The
+table is split into partitions by institution and booking month (institution=<id>/year=<yyyy>/month=<m>),
+which are grouped into tasks of up to --chunk-rows rows for a process pool. Workers load the model once
+(--model, a local joblib or lite file, or MODEL_BLOB from the bucket like the Cloud Function). Labels are
+assigned with main.assign_category(), i.e. with the same merchant rules and text normalization as the
+pipeline.
+
+Parquet (sinks.ParquetSink): row counts come from the Parquet metadata. Small partitions of a task are
+scored in one model call; a larger partition is read in record batches of --chunk-rows, so memory depends
+on the chunk size and not on the partition size. The relabelled partition is written next to the table
+(a hidden .backfill-<run> directory, skipped by Parquet readers) and swapped with the old partition
+directory only when it is complete. Staging directories left by an interrupted run are cleaned up at
+start, and a partition moved aside is put back.
+
+BigQuery (sinks.BigQuerySink): row counts come from one GROUP BY query. A worker reads the rows of its
+task with a query in pages of --chunk-rows, scores every page and appends it to a staging table with the
+schema of bank_data_table. The partitions of the task are then swapped with BigQuerySink.swap(), the same
+transactional DELETE and INSERT as replace() of event-scoped runs. Staging tables left by an interrupted
+run are dropped at start.
+
+Finished partitions are recorded in the checkpoint file together with the model fingerprint, so an
+interrupted run started again with the same model continues with the remaining partitions (--restart
+starts over). At the end the rows per second and the distribution of label changes (old label -> new
+label) are printed and written to --report. The backfill should not run together with a load of the
+Cloud Function, whose rows in the partitions being swapped would be replaced.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import main
+from model_cache import load_model_file
+from prediction_cache import PredictionCache
+from sinks import PARQUET_ROOT, PARTITION_COLUMNS, BigQuerySink, table_schemas
+
+TABLE = 'bank_data_table'
+BIGQUERY_STAGING_PREFIX = TABLE + '__backfill_'
+CHUNK_ROWS = int(os.environ.get("BACKFILL_CHUNK_ROWS", 50000))
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", os.cpu_count() or 1))
+
+_worker_model = None
+_worker_model_version = None
+
+
+def model_fingerprint(model_path=None):
+    """
+        Return an identifier of the model: md5 of the local file, or the generation of MODEL_BLOB.
+    """
+    if model_path:
+        digest = hashlib.md5()
+        with open(model_path, 'rb') as model_file:
+            for block in iter(lambda: model_file.read(1024 * 1024), b''):
+                digest.update(block)
+        return 'md5:' + digest.hexdigest()
+    blob = main.get_storage_client().bucket(main.MODEL_BUCKET_NAME).get_blob(main.MODEL_FILE_NAME)
+    return 'generation:{}'.format(blob.generation)
+
+
+def list_partitions(table_path):
+    """
+        Return the relative paths of the leaf partitions of a table, e.g. 'institution=X/year=2024/month=6'.
+    """
+    partitions = []
+    for directory, directories, names in os.walk(table_path):
+        # Katalogi tymczasowe (.backfill-*, .staging-*) nie są częścią tabeli
+        directories[:] = sorted(name for name in directories if not name.startswith(('.', '_')))
+        if any(name.endswith('.parquet') for name in names):
+            partitions.append(os.path.relpath(directory, table_path).replace(os.sep, '/'))
+    return sorted(partitions)
+
+
+def partition_values(partition):
+    return dict(part.split('=', 1) for part in partition.split('/'))
+
+
+def file_schema(table=TABLE):
+    """
+        Schema of the Parquet files inside a partition: the table schema without the partition columns.
+    """
+    schema = table_schemas()[table]
+    for column in PARTITION_COLUMNS.get(table, []):
+        schema = schema.remove(schema.get_field_index(column))
+    return schema
+
+
+def load_checkpoint(path, model):
+    """
+        Return the partitions finished by an earlier run with the same model.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint.get('model') != model:
+        print("Checkpoint {} belongs to model {}, starting over".format(path, checkpoint.get('model')))
+        return {}
+    return checkpoint.get('partitions', {})
+
+
+def save_checkpoint(path, model, partitions):
+    # Zapis przez plik tymczasowy, żeby przerwanie nie zostawiło uszkodzonego checkpointu
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as checkpoint_file:
+        json.dump({'model': model, 'updated': time.time(), 'partitions': partitions}, checkpoint_file)
+    os.replace(temporary, path)
+
+
+def _init_worker(model_path, model):
+    global _worker_model, _worker_model_version
+    # Predykcje w cache kluczowane są wersją modelu, który proces faktycznie załadował
+    if model_path:
+        _worker_model, _worker_model_version = load_model_file(model_path), model
+    else:
+        _worker_model, generation = main.load_model_with_version()
+        _worker_model_version = 'generation:{}'.format(generation)
+    # Każdy proces ma własny cache predykcji w pamięci, bez blokad na wspólnym pliku SQLite
+    main.PREDICTION_CACHE = PredictionCache(path=':memory:')
+
+
+def relabel_frame(df, categories_mapping, loaded_model):
+    """
+        Assign new labels to stored rows.
+
+        Args:
+            df (pandas.DataFrame): Rows of partition files with the 'institution' column added.
+
+        Returns:
+            tuple: (DataFrame in the file schema with the new labels, Series with the old labels).
+    """
+    old_labels = df['label'].astype(object).reset_index(drop=True)
+    df = df.drop(columns=['label']).reset_index(drop=True)
+    source_file = df.get('source_file')
+    df = main.add_date_parts(df)
+    df = main.assign_category(df, categories_mapping, loaded_model, model_version=_worker_model_version)
+    # assign_category() zwraca tylko kolumny modelu
+    if source_file is not None:
+        df['source_file'] = source_file
+    return df, old_labels
+
+
+def label_transitions(old_labels, new_labels):
+    new_labels = new_labels.astype(object).reset_index(drop=True)
+    changed = old_labels != new_labels
+    return Counter('{} -> {}'.format(old, new) for old, new in zip(old_labels[changed], new_labels[changed]))
+
+
+def partition_files(table_path, partition):
+    source = os.path.join(table_path, partition)
+    return [os.path.join(source, name) for name in sorted(os.listdir(source)) if name.endswith('.parquet')]
+
+
+def partition_rows(table_path, partition):
+    import pyarrow.parquet as pq
+    # Liczba wierszy z metadanych pliku, bez czytania danych
+    return sum(pq.ParquetFile(path).metadata.num_rows for path in partition_files(table_path, partition))
+
+
+def plan_tasks(rows_by_partition, chunk_rows=CHUNK_ROWS, workers=1):
+    """
+        Group partitions into tasks of at most `chunk_rows` rows; a larger partition is a task of its own.
+        Tasks are kept small enough to give every worker a few of them.
+
+        Args:
+            rows_by_partition (dict): Partition -> number of rows, in the order of processing.
+    """
+    chunk_rows = max(1, min(chunk_rows, sum(rows_by_partition.values()) // (workers * 4)))
+    tasks = []
+    group, group_rows = [], 0
+    for partition, rows in rows_by_partition.items():
+        if group and group_rows + rows > chunk_rows:
+            tasks.append(group)
+            group, group_rows = [], 0
+        group.append(partition)
+        group_rows += rows
+    if group:
+        tasks.append(group)
+    return tasks
+
+
+def swap_partition(table_path, partition, staged, staging_root):
+    """
+        Put the complete relabelled partition `staged` in place of the old one.
+    """
+    source = os.path.join(table_path, partition)
+    trash = os.path.join(staging_root, 'old', partition)
+    os.makedirs(os.path.dirname(trash), exist_ok=True)
+    # Stara partycja odkładana jest na bok dopiero, gdy nowa jest kompletna
+    os.replace(source, trash)
+    os.replace(staged, source)
+    shutil.rmtree(trash)
+
+
+def recover(table_path):
+    """
+        Clean up staging directories of an interrupted run. A partition moved aside but not yet replaced
+        is put back; it is not in the checkpoint, so it is relabelled again.
+    """
+    if not os.path.isdir(table_path):
+        return
+    for name in os.listdir(table_path):
+        if not name.startswith('.backfill-'):
+            continue
+        staging_root = os.path.join(table_path, name)
+        old_root = os.path.join(staging_root, 'old')
+        for partition in list_partitions(old_root) if os.path.isdir(old_root) else []:
+            target = os.path.join(table_path, partition)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(os.path.join(old_root, partition), target)
+                print("Restored partition", partition)
+        shutil.rmtree(staging_root)
+
+
+def staged_file(staging_root, partition):
+    staged = os.path.join(staging_root, 'new', partition)
+    os.makedirs(staged, exist_ok=True)
+    return staged, os.path.join(staged, 'part-backfill-{}.parquet'.format(uuid.uuid4().hex))
+
+
+def relabel_partition(table_path, partition, staging_root, chunk_rows=CHUNK_ROWS):
+    """
+        Relabel one partition in record batches of `chunk_rows` and swap it in place of the old one.
+
+        Returns:
+            dict: 'partition', 'rows', 'changed', 'seconds' and 'transitions' ({'old -> new': count}).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    start = time.perf_counter()
+    institution = partition_values(partition)['institution']
+    categories_mapping = main.create_categories_mapping()
+    schema = file_schema()
+    transitions = Counter()
+    rows = 0
+
+    staged, path = staged_file(staging_root, partition)
+    writer = pq.ParquetWriter(path, schema)
+    try:
+        for source in partition_files(table_path, partition):
+            for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_rows):
+                df = batch.to_pandas()
+                df['institution'] = institution
+                df, old_labels = relabel_frame(df, categories_mapping, _worker_model)
+                transitions.update(label_transitions(old_labels, df['label']))
+                rows += len(df)
+                writer.write_table(pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False))
+    finally:
+        writer.close()
+    swap_partition(table_path, partition, staged, staging_root)
+
+    return {'partition': partition, 'rows': rows, 'changed': sum(transitions.values()),
+            'seconds': time.perf_counter() - start, 'transitions': dict(transitions)}
+
+
+def relabel_task(table_path, partitions, staging_root, chunk_rows=CHUNK_ROWS):
+    """
+        Relabel a task of plan_tasks(). Small partitions of a task are scored together in one call of
+        the model, which has a fixed cost per call; every partition is still written and swapped separately.
+
+        Returns:
+            list: Results of the partitions, as returned by relabel_partition().
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if len(partitions) == 1:
+        return [relabel_partition(table_path, partitions[0], staging_root, chunk_rows)]
+
+    start = time.perf_counter()
+    frames = []
+    for position, partition in enumerate(partitions):
+        for source in partition_files(table_path, partition):
+            df = pq.read_table(source).to_pandas()
+            df['institution'] = partition_values(partition)['institution']
+            df['_partition'] = position
+            frames.append(df)
+    # Kategorie (słownikowe kolumny) różnią się między plikami, concat zamienia je na zwykłe wartości
+    df = pd.concat(frames, ignore_index=True)
+    positions = df.pop('_partition')
+    df, old_labels = relabel_frame(df, main.create_categories_mapping(), _worker_model)
+    seconds_per_row = (time.perf_counter() - start) / max(len(df), 1)
+
+    schema = file_schema()
+    results = []
+    for position, partition in enumerate(partitions):
+        write_start = time.perf_counter()
+        selected = (positions == position).to_numpy()
+        part = df[selected]
+        transitions = label_transitions(old_labels[selected].reset_index(drop=True), part['label'])
+        staged, path = staged_file(staging_root, partition)
+        pq.write_table(pa.Table.from_pandas(part[schema.names], schema=schema, preserve_index=False), path)
+        swap_partition(table_path, partition, staged, staging_root)
+        results.append({'partition': partition, 'rows': len(part), 'changed': sum(transitions.values()),
+                        'seconds': len(part) * seconds_per_row + time.perf_counter() - write_start,
+                        'transitions': dict(transitions)})
+    return results
+
+
+def bigquery_sink():
+    return BigQuerySink(main.get_bigquery_client(), main.DATASET_ID)
+
+
+def partition_key(institution, year, month):
+    """
+        Return the partition of a row, in the same form as the Parquet partitions; rows without a booking
+        date are in 'year=null/month=null'.
+    """
+    import pandas as pd
+
+    if year is None or pd.isna(year):
+        return 'institution={}/year=null/month=null'.format(institution)
+    return 'institution={}/year={}/month={}'.format(institution, int(year), int(month))
+
+
+def bigquery_partitions(sink, table=TABLE):
+    """
+        Return the partitions of `table` in BigQuery with their row counts, from one GROUP BY query.
+    """
+    query = """
+        SELECT `institution`, EXTRACT(YEAR FROM `date_time`) AS year, EXTRACT(MONTH FROM `date_time`) AS month,
+               COUNT(*) AS row_count
+        FROM {}
+        WHERE `institution` IS NOT NULL
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+    """.format(sink.table_name(table))
+    return {partition_key(row['institution'], row['year'], row['month']): row['row_count']
+            for row in sink.client.query(query).result()}
+
+
+def partition_filter(partitions):
+    """
+        Return the SQL condition selecting the rows of `partitions` and its query parameters.
+    """
+    from google.cloud import bigquery
+    conditions = []
+    parameters = []
+    for position, partition in enumerate(partitions):
+        values = partition_values(partition)
+        name = 'institution_{}'.format(position)
+        parameters.append(bigquery.ScalarQueryParameter(name, 'STRING', values['institution']))
+        if values['year'] == 'null':
+            conditions.append('(`institution` = @{} AND `date_time` IS NULL)'.format(name))
+        else:
+            # Rok i miesiąc są liczbami z partition_key(), więc mogą trafić wprost do zapytania
+            conditions.append('(`institution` = @{} AND EXTRACT(YEAR FROM `date_time`) = {} '
+                              'AND EXTRACT(MONTH FROM `date_time`) = {})'.format(
+                                  name, int(values['year']), int(values['month'])))
+    return ' OR '.join(conditions), parameters
+
+
+def drop_staging_tables(sink, prefix=BIGQUERY_STAGING_PREFIX):
+    """
+        Drop the staging tables left by an interrupted BigQuery backfill. The swap is one transaction,
+        so bank_data_table itself needs no recovery.
+    """
+    for table in sink.client.list_tables(sink.client.dataset(sink.dataset_id)):
+        if table.table_id.startswith(prefix):
+            sink.drop(table.table_id)
+            print("Dropped staging table", table.table_id)
+
+
+def relabel_bigquery_task(partitions, run_id, chunk_rows=CHUNK_ROWS):
+    """
+        Relabel a task of plan_tasks() in BigQuery: read its rows in pages of `chunk_rows`, score every
+        page, append it to a staging table and swap the partitions of the task in one transaction.
+
+        Returns:
+            list: Results of the partitions, as returned by relabel_partition().
+    """
+    import pandas as pd
+    from google.cloud import bigquery
+
+    start = time.perf_counter()
+    sink = bigquery_sink()
+    condition, parameters = partition_filter(partitions)
+    staging = '{}{}_{}'.format(BIGQUERY_STAGING_PREFIX, run_id, uuid.uuid4().hex[:8])
+    schema = sink.table_schema(TABLE)
+    categories_mapping = main.create_categories_mapping()
+    rows = Counter()
+    transitions = {partition: Counter() for partition in partitions}
+    columns = None
+
+    query = "SELECT * FROM {} WHERE {}".format(sink.table_name(TABLE), condition)
+    pages = sink.client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=parameters)) \
+        .result(page_size=chunk_rows)
+    try:
+        for df in pages.to_dataframe_iterable():
+            if df.empty:
+                continue
+            date_time = pd.to_datetime(df['date_time'])
+            keys = pd.Series([partition_key(institution, year, month) for institution, year, month
+                              in zip(df['institution'], date_time.dt.year, date_time.dt.month)])
+            df, old_labels = relabel_frame(df, categories_mapping, _worker_model)
+            for key in keys.unique():
+                selected = (keys == key).to_numpy()
+                rows[key] += int(selected.sum())
+                transitions.setdefault(key, Counter()).update(
+                    label_transitions(old_labels[selected].reset_index(drop=True), df['label'][selected]))
+            sink.write(df, staging, load_mode='append', schema=schema)
+            columns = list(df.columns)
+        if columns is not None:
+            sink.swap(TABLE, staging, columns, condition, parameters)
+    finally:
+        sink.drop(staging)
+
+    seconds_per_row = (time.perf_counter() - start) / max(sum(rows.values()), 1)
+    return [{'partition': partition, 'rows': rows[partition],
+             'changed': sum(transitions[partition].values()),
+             'seconds': rows[partition] * seconds_per_row, 'transitions': dict(transitions[partition])}
+            for partition in partitions]
+
+
+def summarize(partitions, wall_seconds):
+    """
+        Combine the per-partition results into the report.
+    """
+    transitions = Counter()
+    for result in partitions.values():
+        transitions.update(result['transitions'])
+    rows = sum(result['rows'] for result in partitions.values())
+    changed = sum(result['changed'] for result in partitions.values())
+    worker_seconds = sum(result['seconds'] for result in partitions.values())
+    return {
+        'partitions': len(partitions),
+        'rows': rows,
+        'changed': changed,
+        'changed_share': round(changed / rows, 4) if rows else None,
+        'wall_seconds': round(wall_seconds, 2),
+        'rows_per_second': round(rows / wall_seconds, 1) if wall_seconds else None,
+        'rows_per_worker_second': round(rows / worker_seconds, 1) if worker_seconds else None,
+        'transitions': dict(transitions.most_common()),
+    }
+
+
+def backfill(root=PARQUET_ROOT, model_path=None, workers=BACKFILL_WORKERS, chunk_rows=CHUNK_ROWS,
+             checkpoint_path=None, restart=False, sink=main.SINK):
+    """
+        Relabel every partition of bank_data_table that is not in the checkpoint yet.
+
+        Args:
+            root (str): PARQUET_ROOT of the ParquetSink.
+            model_path (str): Local model file; MODEL_BLOB from the bucket when omitted.
+            workers (int): Size of the process pool.
+            chunk_rows (int): Rows read and scored at once.
+            checkpoint_path (str): Checkpoint file, <root>/backfill_checkpoint.json by default
+                (backfill_checkpoint_bigquery.json in the working directory for BigQuery).
+            restart (bool): Ignore the checkpoint and relabel all partitions.
+            sink (str): 'parquet' or 'bigquery'.
+
+        Returns:
+            dict: Report with rows, rows_per_second and the label transitions of this run and of all
+                partitions finished with this model ('total').
+    """
+    if sink not in ('parquet', 'bigquery'):
+        raise ValueError("Invalid sink. Supported values are 'bigquery' or 'parquet'.")
+    model = model_fingerprint(model_path)
+    run_id = uuid.uuid4().hex
+    if sink == 'bigquery':
+        bigquery = bigquery_sink()
+        checkpoint_path = checkpoint_path or 'backfill_checkpoint_bigquery.json'
+        drop_staging_tables(bigquery)
+        rows_by_partition = bigquery_partitions(bigquery)
+    else:
+        table_path = os.path.join(root, TABLE)
+        checkpoint_path = checkpoint_path or os.path.join(root, 'backfill_checkpoint.json')
+        recover(table_path)
+        staging_root = os.path.join(table_path, '.backfill-{}'.format(run_id))
+        rows_by_partition = {partition: partition_rows(table_path, partition)
+                             for partition in list_partitions(table_path)}
+    done = {} if restart else load_checkpoint(checkpoint_path, model)
+    pending = {partition: rows for partition, rows in rows_by_partition.items() if partition not in done}
+    print("Model {}: {} partitions to relabel, {} already done".format(model, len(pending), len(done)))
+    if not model_path:
+        # Kopia modelu na dysku pobierana jest raz, zanim wystartują procesy
+        main.load_model()
+
+    finished = {}
+    start = time.perf_counter()
+    tasks = plan_tasks(pending, chunk_rows, workers)
+    context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(tasks) or 1)), mp_context=context,
+                                 initializer=_init_worker, initargs=(model_path, model)) as pool:
+            if sink == 'bigquery':
+                futures = [pool.submit(relabel_bigquery_task, task, run_id, chunk_rows) for task in tasks]
+            else:
+                futures = [pool.submit(relabel_task, table_path, task, staging_root, chunk_rows) for task in tasks]
+            for future in as_completed(futures):
+                for result in future.result():
+                    finished[result['partition']] = result
+                    done[result['partition']] = result
+                    print("{}: {} rows, {} changed".format(result['partition'], result['rows'], result['changed']))
+                save_checkpoint(checkpoint_path, model, done)
+    finally:
+        if sink == 'parquet':
+            shutil.rmtree(staging_root, ignore_errors=True)
+
+    report = summarize(finished, time.perf_counter() - start)
+    report['model'] = model
+    report['total'] = summarize(done, sum(result['seconds'] for result in done.values()))
+    return report
+
+
+def print_report(report, top=15):
+    print("\nRelabelled {} rows in {} partitions in {}s: {} rows/s ({} rows/s per worker)".format(
+        report['rows'], report['partitions'], report['wall_seconds'], report['rows_per_second'],
+        report['rows_per_worker_second']))
+    total = report['total']
+    print("All partitions with this model: {} rows, {} changed ({})".format(
+        total['rows'], total['changed'],
+        '-' if total['changed_share'] is None else '{:.2%}'.format(total['changed_share'])))
+    for transition, count in list(total['transitions'].items())[:top]:
+        print("{:>10}  {}".format(count, transition))
+
+
+if __name__ == "__main__":
+    def option(name, default=None):
+        return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else default
+
+    report = backfill(
+        sink=option('--sink', main.SINK),
+        root=option('--root', PARQUET_ROOT),
+        model_path=option('--model'),
+        workers=int(option('--workers', BACKFILL_WORKERS)),
+        chunk_rows=int(option('--chunk-rows', CHUNK_ROWS)),
+        checkpoint_path=option('--checkpoint'),
+        restart='--restart' in sys.argv,
+    )
+    print_report(report)
+    report_path = option('--report')
+    if report_path:
+        with open(report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
@@ -0,0 +1,119 @@
+"""
+Content fingerprints of processed account files.
+
+Nordigen syncs often rewrite an account file with identical content, and every rewrite triggers the
+function. The store keeps the fingerprint of every file as of its last successful processing: the
+md5 (or crc32c for composite objects) and the size, taken from the blob metadata returned by the
+bucket listing, so nothing is downloaded to compute it. Files whose fingerprint did not change are
+skipped. The fingerprint of the model blob is kept too, because a new model changes the labels
+of unchanged files; it is recorded only by runs that labelled every file with that model.
+
+The modification time of bank_data_table after the last load is kept as well. When the table was
+changed by something else since (a backfill, a manual fix, a replace whose run failed before saving
+the state), the fingerprints of the files no longer describe the table and a full run reloads it.
+"""
+
+import json
+
+FINGERPRINTS_BLOB_NAME = "state/fingerprints.json"
+
+
+def fingerprint(blob):
+    """
+        Return the content fingerprint of a blob from its metadata.
+
+        Args:
+            blob: Blob from a bucket listing or get_blob(), with its metadata loaded.
+
+        Returns:
+            str: 'md5:<hash>:<size>' or 'crc32c:<hash>:<size>', or 'generation:<n>' when the blob has no hash.
+    """
+    for field in ('md5_hash', 'crc32c'):
+        value = getattr(blob, field, None)
+        if value:
+            return "{}:{}:{}".format(field.split('_')[0], value, blob.size)
+    # Bez sumy kontrolnej każda nowa generacja traktowana jest jako zmiana
+    return "generation:{}".format(blob.generation)
+
+
+def table_state(modified):
+    return modified.isoformat() if modified is not None else None
+
+
+class FingerprintStore:
+    """
+    Fingerprints of processed account files and of the model, loaded from and saved to a JSON blob.
+
+    The fingerprints of a run are collected with record() and merged by commit(), which should be
+    called only after the output was written successfully.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.files = state.get('files', {})
+        self.model = state.get('model')
+        self.table = state.get('table')
+        self._pending = {}
+        self._pending_model = None
+        self._pending_table = None
+        self._removed = set()
+
+    @classmethod
+    def load(cls, bucket, blob_name=FINGERPRINTS_BLOB_NAME):
+        blob = bucket.get_blob(blob_name)
+        if blob is None:
+            return cls()
+        return cls(json.loads(blob.download_as_text()))
+
+    def save(self, bucket, blob_name=FINGERPRINTS_BLOB_NAME):
+        blob = bucket.blob(blob_name)
+        blob.upload_from_string(json.dumps({'files': self.files, 'model': self.model, 'table': self.table}),
+                                content_type='application/json')
+
+    def is_changed(self, blob):
+        return self.files.get(blob.name) != fingerprint(blob)
+
+    def model_changed(self, model_blob):
+        return model_blob is not None and self.model != fingerprint(model_blob)
+
+    def table_changed(self, modified):
+        """
+            Return True when the table was modified after the load recorded with record_table().
+        """
+        return table_state(modified) != self.table
+
+    def removed(self, blobs):
+        """
+            Return the names of files processed before that are missing from `blobs`.
+        """
+        names = {blob.name for blob in blobs}
+        return sorted(name for name in self.files if name not in names)
+
+    def record(self, blobs, model_blob=None, removed=()):
+        """
+            Remember the fingerprints of processed `blobs` and the model, and forget `removed` files.
+        """
+        for blob in blobs:
+            self._pending[blob.name] = fingerprint(blob)
+        if model_blob is not None:
+            self._pending_model = fingerprint(model_blob)
+        self._removed.update(removed)
+
+    def record_table(self, modified):
+        """
+            Remember the modification time of the table after this run's load.
+        """
+        self._pending_table = table_state(modified)
+
+    def commit(self):
+        for name in self._removed:
+            self.files.pop(name, None)
+        self.files.update(self._pending)
+        if self._pending_model is not None:
+            self.model = self._pending_model
+        if self._pending_table is not None:
+            self.table = self._pending_table
+        self._pending = {}
+        self._pending_model = None
+        self._pending_table = None
+        self._removed = set()
@@ -0,0 +1,141 @@
+"""
+Compact "lite" serving format of the categorization model.
+
+A lite model is a linear classifier over a fixed vocabulary (exported by ML/export_lite.py), stored in a
+single file:
+
+    b'LITEMDL1' | header length (uint64, little endian) | JSON header | padding to 64 bytes |
+    weights float32 [n_features + 1, n_classes] | intercepts float32 [n_classes]
+
+The header holds the vocabulary, the token pattern, the amount scaling, the class labels and the text
+format of 'preprocessed_text' (text_normalizer.text_format()), which load_model_file() checks. The weights
+are not unpickled but memory-mapped, so loading takes milliseconds, pages are read only when used and are
+shared between processes on the same instance. Serving needs only numpy, not scikit-learn.
+"""
+
+import json
+import re
+import struct
+
+import numpy as np
+
+MAGIC = b'LITEMDL1'
+ALIGNMENT = 64
+
+
+def is_lite_file(path):
+    with open(path, 'rb') as model_file:
+        return model_file.read(len(MAGIC)) == MAGIC
+
+
+def _data_offset(header_length):
+    offset = len(MAGIC) + 8 + header_length
+    return offset + (-offset) % ALIGNMENT
+
+
+class LiteModel:
+    """
+    Linear model over bag-of-words counts of 'preprocessed_text' and the scaled 'amount'.
+
+    Args:
+        vocabulary (dict): Token -> feature index.
+        weights (numpy.ndarray): [n_features + 1, n_classes]; the last row is the weight of the amount.
+        intercepts (numpy.ndarray): [n_classes].
+        classes (list): Label of every class column.
+        amount_mean (float), amount_scale (float): Standardization of the amount.
+        token_pattern (str): Regular expression of a token, the same as in the exported CountVectorizer.
+        lowercase (bool): Lowercase texts before tokenizing.
+        text_format (str): Text format the model was trained on, 'raw' or 'normalized'; None when unknown.
+    """
+
+    def __init__(self, vocabulary, weights, intercepts, classes, amount_mean=0.0, amount_scale=1.0,
+                 token_pattern=r"(?u)\b\w\w+\b", lowercase=True, text_format=None):
+        self.vocabulary = vocabulary
+        self.weights = weights
+        self.intercepts = intercepts
+        self.classes_ = np.asarray(classes)
+        self.amount_mean = amount_mean
+        self.amount_scale = amount_scale or 1.0
+        self.token_pattern = token_pattern
+        self.lowercase = lowercase
+        self.text_format = text_format
+        self._token_re = re.compile(token_pattern)
+
+    def save(self, path):
+        header = json.dumps({
+            'format': 1,
+            'vocabulary': self.vocabulary,
+            'classes': self.classes_.tolist(),
+            'shape': list(self.weights.shape),
+            'amount_mean': float(self.amount_mean),
+            'amount_scale': float(self.amount_scale),
+            'token_pattern': self.token_pattern,
+            'lowercase': self.lowercase,
+            'text_format': self.text_format,
+        }, ensure_ascii=False).encode('utf8')
+        with open(path, 'wb') as model_file:
+            model_file.write(MAGIC)
+            model_file.write(struct.pack('<Q', len(header)))
+            model_file.write(header)
+            model_file.write(b'\0' * (_data_offset(len(header)) - model_file.tell()))
+            model_file.write(np.ascontiguousarray(self.weights, dtype='<f4').tobytes())
+            model_file.write(np.ascontiguousarray(self.intercepts, dtype='<f4').tobytes())
+        return path
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+            Load a lite model; with mmap=True the weights stay memory-mapped from `path`.
+        """
+        with open(path, 'rb') as model_file:
+            if model_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a lite model".format(path))
+            header_length, = struct.unpack('<Q', model_file.read(8))
+            header = json.loads(model_file.read(header_length).decode('utf8'))
+
+        rows, n_classes = header['shape']
+        offset = _data_offset(header_length)
+        if mmap:
+            data = np.memmap(path, dtype='<f4', mode='r', offset=offset, shape=(rows * n_classes + n_classes,))
+        else:
+            data = np.fromfile(path, dtype='<f4', offset=offset, count=rows * n_classes + n_classes)
+        weights = data[:rows * n_classes].reshape(rows, n_classes)
+        intercepts = np.array(data[rows * n_classes:])
+        return cls(header['vocabulary'], weights, intercepts, header['classes'], header['amount_mean'],
+                   header['amount_scale'], header['token_pattern'], header['lowercase'],
+                   header.get('text_format'))
+
+    def decision_function(self, X):
+        """
+            Class scores of every row of `X` (a DataFrame with 'preprocessed_text' and 'amount').
+        """
+        texts = X['preprocessed_text'].tolist()
+        amounts = np.nan_to_num(X['amount'].to_numpy(dtype=np.float64))
+
+        rows, columns = [], []
+        vocabulary = self.vocabulary
+        findall = self._token_re.findall
+        for position, text in enumerate(texts):
+            if not isinstance(text, str):
+                continue
+            for token in findall(text.lower() if self.lowercase else text):
+                index = vocabulary.get(token)
+                if index is not None:
+                    rows.append(position)
+                    columns.append(index)
+
+        scores = np.empty((len(texts), len(self.intercepts)), dtype=np.float32)
+        scores[:] = self.intercepts
+        if rows:
+            # Każde wystąpienie tokenu dodaje jego wagi, tak jak zliczenia CountVectorizer
+            np.add.at(scores, np.asarray(rows), self.weights[np.asarray(columns)])
+        scaled = ((amounts - self.amount_mean) / self.amount_scale).astype(np.float32)
+        scores += scaled[:, None] * self.weights[-1]
+        return scores
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.decision_function(X), axis=1)]
+
+
+def load(path):
+    return LiteModel.load(path)
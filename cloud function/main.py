@@ -1,52 +1,67 @@
-import functions_framework
-import json
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from google.cloud import storage
-import xlsxwriter
-import regex as re
 import pandas as pd
 import numpy as np
-from io import BytesIO
-import openpyxl
-from google.cloud import bigquery
-import pyarrow
-import joblib
-from datetime import datetime, timedelta, timezone
-from google.cloud import bigquery
-
-
-# Triggered by a change in a storage bucket
-@functions_framework.cloud_event
-def bank_millenium():
-    workbook = xlsxwriter.Workbook('Jacek.xlsx')
-    worksheet = workbook.add_worksheet()
-
-    worksheet.write('A1', 'date_time')
-    worksheet.write('B1', 'currency')
-    worksheet.write('C1', 'amount')
-    worksheet.write('D1', 'description')
-    worksheet.write('E1', 'institution')
-
-    return worksheet, workbook
+from datetime import datetime, timezone
+from account_reader import iter_account_chunks, is_account_file, legacy_name, ndjson_name
+from model_cache import MODEL_CACHE
+from merchant_rules import get_rules
+from text_normalizer import NORMALIZE_TEXT, prepare_texts
+from prediction_cache import PREDICTION_CACHE, predict_cached
+from watermarks import WatermarkStore, account_key, transaction_key
+from trend_store import TrendStore
+from fingerprints import FingerprintStore
+from sinks import BigQuerySink, ParquetSink, DATASET_ID, PARQUET_ROOT
+from metrics import METRICS, TimedReader
+
+# Rozmiar bufora przy strumieniowym pobieraniu pliku z GCS
+STREAM_CHUNK_BYTES = 1024 * 1024
+
+MODEL_BUCKET_NAME = "bank_data_milo"
+# Blob z modelem, np. models/online_sgd.joblib dla modelu z ML/online_model.py
+MODEL_FILE_NAME = os.environ.get("MODEL_BLOB", "random_forest.joblib")
+USE_PREDICTION_CACHE = os.environ.get("USE_PREDICTION_CACHE", "1") == "1"
+USE_MERCHANT_RULES = os.environ.get("USE_MERCHANT_RULES", "1") == "1"
+
+# 'truncate' przeładowuje całą tabelę, 'incremental' dopisuje tylko nowe transakcje
+LOAD_MODE = os.environ.get("LOAD_MODE", "truncate")
+
+BUCKET_NAME = "bank_data_milo"
+# Pliki kont wykrywane są z listingu bucketa, zamiast z zakodowanej listy file_names
+ACCOUNT_FILES_PREFIX = os.environ.get("ACCOUNT_FILES_PREFIX", "")
+STATE_PREFIX = "state/"
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", os.cpu_count() or 1))
+
+# Zdarzenie z nazwą pliku przetwarza tylko ten plik; 0 wymusza przeliczenie wszystkich plików
+EVENT_SCOPED = os.environ.get("EVENT_SCOPED", "1") == "1"
+
+# 'bigquery' ładuje do datasetu bankData, 'parquet' zapisuje lokalnie w PARQUET_ROOT
+SINK = os.environ.get("SINK", "bigquery")
+# Kolumny bank_data_table w kolejności zwracanej przez process_account_file()
+TABLE_COLUMNS = ['date_time', 'amount', 'currency', 'institution', 'description', 'label', 'source_file']
+
+# Model ładowany już przy starcie instancji, a nie przy pierwszym wywołaniu
+PREWARM_MODEL = os.environ.get("PREWARM_MODEL", "0") == "1"
+
+# google.cloud.bigquery importowany jest dopiero tam, gdzie jest potrzebny;
+# klienci GCS i BigQuery tworzeni są raz i współdzieleni przez kolejne wywołania
+_storage_client = None
+_bigquery_client = None
+_sink = None
+_worker_model = None
+_worker_model_version = None
 
 
 def create_categories_mapping():
     """
-    Function to create a mapping of categories based on patterns.
-    Patterns are defined as a dictionary, where the key is the category name,
-    and the value is a list of patterns matching that category.
-
-    You can customize this function to load rules from an external configuration
-    file or from some data source.
-    """
-    # category_mapping = {
-    #     'Zakupy życiowe': ['Allegro', 'HERBALIFE', 'LIDL', 'CARREFOUR', 'ROSSMANN', 'ZABKA', 'PIWARIUM', 'Kancelaria', 'JMP', 'Top', 'BADYLARNIA', 'Leroy', 'ABUD'],
-    #     'Subskrypcje': ['PAYPAL', 'GOOGLE', 'NETFLIX.COM', 'HEROKU*', 'DISNEY'],
-    #     'Jedzenie/picie': ['PP*RESTAUMATIC.COM', 'WILCZA', 'RESTAURACJA', 'PIZZA', 'XIN', 'BUTCHERY', 'GREEN', 'PIJALNIA', 'WARMUT', 'ARENA'],
-    #     'Transport': ['BOLT', 'Stacja', 'CIRCLE', 'SPP', 'Parking'],
-    #     'Zdrowie': ['MOKOT', 'APTEKA', 'PORADNIA', 'CEFARM-WARSZAWA', 'OSIR', 'PSYCHIATRZY.WARSZAWA'],
-    #     'Zakupy internetowe': ['PayPro', 'Elfi.pl', 'KUBUS', 'EVENTIM.PL-PL-ECOM', 'AVANS.PL', 'PAYPAL *ZALANDOSE'],
-    #     'Inne': ['UBEZP.', 'SPŁATA', 'ZWROT', 'HB', 'ODSETKI']
-    # }
+    Function to create a mapping of model labels to category names.
+
+    Merchant patterns matching a category with certainty are kept in merchant_rules.json,
+    keyed by the category names defined here.
+    """
     category_mapping = {
         0: 'Other',
         1: 'Food and drinks',
@@ -70,7 +85,55 @@ def create_categories_mapping():
     return category_mapping
 
 
-def assign_category(df, category_mapping):
+def get_storage_client():
+    """
+    Return the Cloud Storage client shared by all invocations handled by this instance.
+    """
+    global _storage_client
+    if _storage_client is None:
+        _storage_client = storage.Client(project='bank-account-analysis-412412')
+    return _storage_client
+
+
+def get_bigquery_client():
+    """
+    Return the BigQuery client shared by all invocations handled by this instance.
+    """
+    global _bigquery_client
+    if _bigquery_client is None:
+        from google.cloud import bigquery
+        _bigquery_client = bigquery.Client()
+    return _bigquery_client
+
+
+def load_model():
+    """
+    Function to return the pre-trained model stored in Cloud Storage.
+
+    The model is kept in a process-wide cache keyed by the blob generation, so it is
+    downloaded and deserialized again only when the model blob (MODEL_BLOB, random_forest.joblib by
+    default) changes in the bucket.
+
+    Returns:
+        sklearn.pipeline.Pipeline: The loaded categorization pipeline, or a lite_model.LiteModel
+            when the blob is a lite artifact exported with ML/export_lite.py.
+    """
+    return load_model_with_version()[0]
+
+
+def load_model_with_version():
+    """
+    Function to return the pre-trained model together with the generation of its blob.
+
+    Returns:
+        tuple: (model, as returned by load_model(), generation as str), the generation keys the
+            predictions of that model in PREDICTION_CACHE.
+    """
+    bucket = get_storage_client().bucket(MODEL_BUCKET_NAME)
+    return MODEL_CACHE.get_with_version(bucket, MODEL_FILE_NAME)
+
+
+def assign_category(df, category_mapping, loaded_model=None, model_version=None):
     # print('description', description)
     """
     Function to assign a category label to each transaction based on the transaction description
@@ -83,6 +146,9 @@ def assign_category(df, category_mapping):
         df (pandas.DataFrame): DataFrame containing transaction data, including the description
             of each transaction.
         category_mapping (dict): A dictionary mapping category labels to patterns.
+        loaded_model: Already loaded model. When omitted, the model is downloaded with load_model().
+        model_version (str): Version of `loaded_model` (e.g. the blob generation), used to key the
+            prediction cache. Predictions are not cached when it is None.
 
     Returns:
         pandas.DataFrame: DataFrame with the original transaction data and an additional column
@@ -93,28 +159,55 @@ def assign_category(df, category_mapping):
         'amount', 'day', 'month', 'year', 'day_of_week'.
 
         If the 'description' column is not named 'preprocessed_text', it will be renamed accordingly
-        to match the model's input format.
-    """
-    bucket_name = "bank_data_milo"
-    file_name = "random_forest.joblib"
-    client = storage.Client(project='bank-account-analysis-412412')
-
-    bucket = client.get_bucket(bucket_name)
-    # Utworzenie obiektu Blob (pliku) w GCS
-    blob = bucket.blob(file_name)
+        to match the model's input format. The text passed to the model is prepared with
+        text_normalizer.prepare_texts(), so NORMALIZE_TEXT selects the same format as in the training scripts.
 
-    # Download the model file from Cloud Storage
-    blob.download_to_filename("/tmp/random_forest_TFIvectorizer.joblib")
-
-    loaded_model = joblib.load('/tmp/random_forest_TFIvectorizer.joblib')
+        Descriptions matching exactly one category of the merchant rules (merchant_rules.json) are
+        labelled without the model (disable with USE_MERCHANT_RULES=0). Predictions of the model
+        for the remaining rows are memoized by model version, normalized description and amount
+        bucket in PREDICTION_CACHE (disable with USE_PREDICTION_CACHE=0).
+    """
+    if loaded_model is None:
+        loaded_model, model_version = load_model_with_version()
     # Użyj modelu do dokonania predykcji
     df.rename(columns={'description': 'preprocessed_text'}, inplace=True)
 
-    predictions = loaded_model.predict(
-        df[['date_time', 'preprocessed_text', 'amount', 'day', 'month', 'year', 'day_of_week']])
+    model_input = df[['date_time', 'preprocessed_text', 'amount', 'day', 'month', 'year', 'day_of_week']].copy()
+    if NORMALIZE_TEXT:
+        # To samo przygotowanie tekstu co w ML/tfidfvectorizermodel.py, opis w wyniku zostaje oryginalny
+        model_input['preprocessed_text'] = prepare_texts(model_input['preprocessed_text'])
 
-    df['label'] = predictions
-    df['label'] = df['label'].map(category_mapping)
+    # Znani sprzedawcy dostają kategorię z reguł, reszta idzie do modelu
+    start = time.perf_counter()
+    if USE_MERCHANT_RULES:
+        rules = get_rules()
+        df['label'] = rules.label(df['preprocessed_text'])
+    else:
+        rules = None
+        df['label'] = None
+    to_model = df['label'].isna()
+    rule_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if to_model.any():
+        if USE_PREDICTION_CACHE and model_version is not None:
+            # Do modelu trafiają tylko opisy, których nie ma jeszcze w cache
+            predictions = predict_cached(loaded_model, model_input[to_model], PREDICTION_CACHE, model_version)
+        else:
+            predictions = loaded_model.predict(model_input[to_model])
+        df.loc[to_model, 'label'] = pd.Series(predictions, index=df.index[to_model]).map(category_mapping)
+    model_seconds = time.perf_counter() - start
+
+    rule_rows = len(df) - int(to_model.sum())
+    if rules is not None:
+        rules.counters['rule_rows'] += rule_rows
+        rules.counters['model_rows'] += len(df) - rule_rows
+        rules.counters['rule_seconds'] += rule_seconds
+        rules.counters['model_seconds'] += model_seconds
+    METRICS.record('rules', rule_seconds, rows=len(df))
+    METRICS.record('predict', model_seconds, rows=len(df) - rule_rows)
+    print("rules: {} rows in {:.3f}s, model: {} rows in {:.3f}s".format(
+        rule_rows, rule_seconds, len(df) - rule_rows, model_seconds))
 
     # Wybierz tylko interesujące kolumny
     df_result = df[['date_time', 'amount', 'currency', 'institution', 'preprocessed_text', 'label']]
@@ -122,37 +215,126 @@ def assign_category(df, category_mapping):
     # Zaktualizuj nazwy kolumn
     df = df_result.rename(columns={'preprocessed_text': 'description'})
 
-    print(df.columns)
     return df
 
 
+def get_sink():
+    """
+    Return the output sink selected with the SINK environment variable ('bigquery' or 'parquet').
+    """
+    global _sink
+    if _sink is None:
+        if SINK == 'parquet':
+            _sink = ParquetSink(PARQUET_ROOT)
+        elif SINK == 'bigquery':
+            _sink = BigQuerySink(get_bigquery_client(), DATASET_ID)
+        else:
+            raise ValueError("Invalid SINK. Supported values are 'bigquery' or 'parquet'.")
+    return _sink
+
+
 def load(df, table, load_mode='truncate'):
-    client = bigquery.Client()
-    project = client.project
+    """
+    Write `df` to `table` of the configured sink.
 
-    dataset_id = 'bankData'
-    table_id = table
-    dataset_ref = client.dataset(dataset_id)
-    table_ref = dataset_ref.table(table_id)
+    Args:
+        df (pandas.DataFrame): Data to write.
+        table (str): Table name, e.g. 'bank_data_table'.
+        load_mode (str): 'truncate' to replace the table content or 'append' to add rows.
+    """
+    get_sink().write(df, table, load_mode=load_mode)
 
-    if load_mode == 'truncate':
-        write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
-    elif load_mode == 'append':
-        write_disposition = bigquery.WriteDisposition.WRITE_APPEND
-    else:
-        raise ValueError("Invalid load_mode. Supported values are 'truncate' or 'append'.")
 
-    job_config = bigquery.LoadJobConfig(
-        source_format=bigquery.SourceFormat.PARQUET,  # lub inny format wspierany przez BigQuery
-        write_disposition=write_disposition,
-        autodetect=True
-    )
+def replace(df, table, column, values):
+    """
+    Replace the rows of `table` whose `column` is one of `values` with `df`, keeping all other rows.
+    """
+    get_sink().replace(df, table, column, values)
 
-    job = client.load_table_from_dataframe(df, table_ref, job_config=job_config)
 
-    job.result()  # Czekaj na zakończenie ładowania danych
+def table_modified(table='bank_data_table'):
+    """
+    Return the time of the last write to `table` of the configured sink, or None if it has no data.
+    """
+    return get_sink().last_modified(table)
 
-    print("Loaded {} rows.".format(job.output_rows))
+
+def table_outdated(table):
+    """
+    Return True when `table` exists but was written before its rows were keyed by 'source_file', so
+    single files cannot be replaced in it yet.
+    """
+    columns = get_sink().columns(table)
+    return columns is not None and 'source_file' not in columns
+
+
+def institution_name(institution_id):
+    """
+        Map the account's institution_id to the institution label stored with each transaction.
+
+        Args:
+            institution_id (str): 'metadata.institution_id' of a Nordigen account.
+
+        Returns:
+            str: Institution identifier.
+    """
+    if institution_id == "PKO_BPKOPLPW":
+        return "PKO_BPKOPLPW"
+    return "MBANK_RETAIL_BREXPLPW"
+
+
+def add_date_parts(df):
+    """
+        Parse 'date_time' and add the day, month, year and day_of_week columns used by the model.
+    """
+    df['date_time'] = pd.to_datetime(df['date_time'])
+    df.loc[:, 'day'] = df['date_time'].dt.day
+    df['month'] = df['date_time'].dt.month
+    df['year'] = df['date_time'].dt.year
+    df['day_of_week'] = df['date_time'].dt.dayofweek
+    return df
+
+
+def extract_booked(booked, institution):
+    """
+        Function to turn booked Nordigen transactions into a DataFrame in a single pass.
+
+        Each field is collected into its own column array, so no intermediate workbook is needed.
+
+        Args:
+            booked (list): The 'transactions.transactions.booked' list of an account.
+            institution (str): Institution identifier written to every row.
+
+        Returns:
+            pandas.DataFrame: DataFrame with 'date_time', 'currency', 'amount', 'description',
+                'institution' and the date part columns.
+    """
+    count = len(booked)
+    dates = [None] * count
+    currencies = [None] * count
+    amounts = np.full(count, np.nan, dtype=np.float64)
+    descriptions = [None] * count
+
+    for position, transaction in enumerate(booked):
+        dates[position] = transaction.get('bookingDate')
+        transaction_amount = transaction.get('transactionAmount')
+        if transaction_amount:
+            currencies[position] = transaction_amount.get('currency')
+            try:
+                amounts[position] = float(transaction_amount['amount'])
+            except (KeyError, TypeError, ValueError):
+                pass
+        descriptions[position] = transaction.get('remittanceInformationUnstructured')
+
+    df = pd.DataFrame({
+        'date_time': dates,
+        'currency': currencies,
+        'amount': amounts,
+        'description': descriptions,
+        'institution': np.full(count, institution, dtype=object),
+    })
+
+    return add_date_parts(df)
 
 
 def extractor(file, filename, quantity):
@@ -167,78 +349,235 @@ def extractor(file, filename, quantity):
         Returns:
             pandas.DataFrame: DataFrame containing the extracted transaction data.
     """
-    worksheet, workbook = bank_millenium()
-    print(type(file))
-
-    position = 0
-
     data = file[0]
+    booked = data['transactions']['transactions']['booked']
 
-    print(type(data))
-    # print(data)
-
-    for position, key in enumerate(data['transactions']['transactions']['booked'][:]):
-        for name in key.keys():
-            # print("keys", name)
-
-            if name == 'bookingDate':
-                try:
-                    __transaction_date = data['transactions']['transactions']['booked'][position][name]
-                    worksheet.write(position + 1, 0, __transaction_date)
-                except:
-                    pass
-
-            if name == 'transactionAmount':
-                try:
-                    __amount = data['transactions']['transactions']['booked'][position][name]['amount']
-                    __currency = data['transactions']['transactions']['booked'][position][name]['currency']
-                    worksheet.write(position + 1, 2, __amount)
-                    worksheet.write(position + 1, 1, __currency)
-                except:
-                    pass
-
-            if name == 'remittanceInformationUnstructured':
-                try:
-                    __counter_party_name = data['transactions']['transactions']['booked'][position][name]
-                    worksheet.write(position + 1, 3, __counter_party_name)
-
-                except:
-                    pass
-            if data['metadata']['institution_id'] == "PKO_BPKOPLPW":
-                worksheet.write(position + 1, 4, "PKO_BPKOPLPW")
-            else:
-                worksheet.write(position + 1, 4, "MBANK_RETAIL_BREXPLPW")
+    df = extract_booked(booked, institution_name(data['metadata']['institution_id']))
 
-    suma = position + 1
-    print("This many transactions:", suma)
+    print("This many transactions:", len(df))
     print("This many files:", quantity)
 
-    workbook.close()
+    return df
+
+
+def process_account_file(fp, categories_mapping, loaded_model, watermarks=None, name=None, model_version=None):
+    """
+        Function to extract and categorize all transactions of one account file.
 
-    df = pd.read_excel('Jacek.xlsx', engine='openpyxl')
+        Args:
+            fp: Binary file-like object with the account file (JSON list, or bank-ndjson when `name`
+                ends with .ndjson.gz).
+            categories_mapping (dict): Mapping of model labels to category names.
+            loaded_model: The categorization model.
+            watermarks (WatermarkStore): When given, only transactions not loaded before are kept
+                and categorized.
+            name (str): Blob name, used to choose the file format.
+            model_version (str): Version of `loaded_model`, see assign_category().
 
-    # df["labell"] = np.nan
+        Returns:
+            list: Categorized DataFrames, one per chunk with new transactions, with the blob name in the
+                'source_file' column.
+    """
+    dfs = []
+    chunks = iter_account_chunks(fp, name)
+    while True:
+        with METRICS.stage('parse') as parse:
+            # Czas czekania na strumień z GCS liczony jest jako 'download' (TimedReader)
+            waited = getattr(fp, 'seconds', 0.0)
+            account, booked = next(chunks, (None, None))
+            parse.exclude(getattr(fp, 'seconds', 0.0) - waited)
+            parse.add(rows=len(booked) if booked else 0)
+        if booked is None:
+            break
+        with METRICS.stage('extract', rows=len(booked)):
+            df = extract_booked(booked, institution_name(account['institution_id']))
+        if watermarks is not None:
+            with METRICS.stage('watermark_filter', rows=len(df)):
+                key = account_key(account['institution_id'], account['id'])
+                df = watermarks.filter_new(key, df, [transaction_key(transaction) for transaction in booked])
+            if df.empty:
+                continue
+        with METRICS.stage('categorize', rows=len(df)):
+            df = assign_category(df, category_mapping=categories_mapping, loaded_model=loaded_model,
+                                 model_version=model_version)
+        # Wiersze pliku można potem podmienić bez ruszania innych plików tej samej instytucji
+        df['source_file'] = name
+        dfs.append(df)
+    return dfs
+
+
+def list_account_files(bucket, prefix=ACCOUNT_FILES_PREFIX):
+    """
+        Function to list account files stored in the bucket.
 
-    # for possition, el in enumerate(df['description']):
-    #     df.loc[possition, 'labell'] = assign_category(el, category_mapping)
+        Args:
+            bucket (google.cloud.storage.Bucket): Bucket with the account files.
+            prefix (str): Only blobs starting with this prefix are considered.
 
-    try:
-        df = df.drop('Unnamed: 0', axis=1)
-    except:
-        pass
+        Returns:
+            list: Blobs of the account files (*.ndjson.gz and legacy *.json), without the pipeline state files
+                and without legacy files already replaced by a *.ndjson.gz file of the same user.
+    """
+    blobs = [blob for blob in bucket.list_blobs(prefix=prefix)
+             if is_account_file(blob.name) and not blob.name.startswith(STATE_PREFIX)]
+    names = {blob.name for blob in blobs}
+    # Stary plik .json, który ma już następcę w formacie bank-ndjson, nie jest czytany drugi raz
+    return [blob for blob in blobs if ndjson_name(blob.name) not in names]
 
-    df['date_time'] = pd.to_datetime(df['date_time'])
-    df.loc[:, 'day'] = df['date_time'].dt.day
-    df['month'] = df['date_time'].dt.month
-    df['year'] = df['date_time'].dt.year
-    df['day_of_week'] = df['date_time'].dt.dayofweek
 
-    return df
+def event_target(data):
+    """
+        Return (bucket name, object name, generation) of the storage event that triggered the function.
+
+        Args:
+            data (dict): Event payload of a Cloud Storage trigger, or None for a manual run.
+
+        Returns:
+            tuple: Bucket name (BUCKET_NAME when the event has none), object name and generation;
+                the name and generation are None when the run is not event-scoped.
+    """
+    data = data or {}
+    bucket_name = data.get('bucket') or BUCKET_NAME
+    if not EVENT_SCOPED or not data.get('name'):
+        return bucket_name, None, None
+    generation = data.get('generation')
+    return bucket_name, data['name'], int(generation) if generation else None
+
+
+def event_blob(bucket, name, generation):
+    """
+        Return the blob of the event and whether the object was deleted.
+
+        Returns:
+            tuple: (blob, deleted). The blob is None when the object was deleted (a delete event, or a
+                finalize event of an object deleted or renamed since) or when a newer generation was
+                uploaded meanwhile (that upload triggers its own run).
+    """
+    blob = bucket.get_blob(name)
+    if blob is None:
+        print("{} no longer exists".format(name))
+        return None, True
+    if generation is not None and blob.generation is not None and int(blob.generation) != generation:
+        print("Ignoring {} generation {}: generation {} is current".format(name, generation, blob.generation))
+        return None, False
+    return blob, False
+
+
+def event_sources(name):
+    """
+        Return the source files whose rows an event-scoped run for `name` replaces: the file itself and,
+        for a *.ndjson.gz file, the legacy *.json file of the same user that it replaces.
+    """
+    replaced = legacy_name(name)
+    return [name, replaced] if replaced else [name]
+
+
+def remove_sources(bucket, names):
+    """
+        Remove the rows of deleted account files from 'bank_data_table' and their aggregates from the
+        TrendStore, and forget their fingerprints.
+    """
+    empty = pd.DataFrame(columns=TABLE_COLUMNS)
+    with METRICS.stage('state_load'):
+        fingerprints = FingerprintStore.load(bucket)
+        trends = TrendStore.load(bucket)
+    with METRICS.stage('load'):
+        replace(empty, 'bank_data_table', 'source_file', names)
+    fingerprints.record([], removed=names)
+    fingerprints.record_table(table_modified())
+    fingerprints.commit()
+    with METRICS.stage('trend_update'):
+        trends.replace_sources(names, empty)
+    with METRICS.stage('state_save'):
+        trends.save(bucket)
+        fingerprints.save(bucket)
+
+
+def stream_account_file(blob, categories_mapping, loaded_model, watermarks=None, model_version=None):
+    """
+        Function to stream one account file from the bucket and extract and categorize its transactions.
+
+        Returns:
+            list: Categorized DataFrames of the file, as returned by process_account_file().
+    """
+    with blob.open('rb', chunk_size=STREAM_CHUNK_BYTES) as fp:
+        reader = TimedReader(fp)
+        dfs = process_account_file(reader, categories_mapping, loaded_model, watermarks, blob.name, model_version)
+    METRICS.record('download', reader.seconds, bytes_read=reader.bytes_read)
+    return dfs
+
+
+def _init_worker():
+    # Każdy proces ładuje model raz; kopia na dysku jest już pobrana przez proces główny
+    global _worker_model, _worker_model_version
+    _worker_model, _worker_model_version = load_model_with_version()
+
+
+def _process_blob(bucket_name, name, generation, watermarks_state):
+    # Metryki procesu roboczego zbierane są osobno dla każdego pliku i scalane w procesie głównym
+    METRICS.reset()
+    # Do procesu przekazywana jest tylko nazwa; plik czytany jest strumieniowo, jak w ścieżce szeregowej
+    blob = get_storage_client().bucket(bucket_name).blob(name, generation=generation)
+    watermarks = WatermarkStore(watermarks_state) if watermarks_state is not None else None
+    dfs = stream_account_file(blob, create_categories_mapping(), _worker_model, watermarks, _worker_model_version)
+    return name, dfs, watermarks.pending if watermarks is not None else None, METRICS.stages
+
+
+def process_files(blobs, loaded_model, watermarks=None, max_workers=MAX_WORKERS, model_version=None):
+    """
+        Function to extract and categorize several account files concurrently.
+
+        Every file is streamed from the bucket, extracted and categorized by a process of a pool that
+        receives only the blob name, so the total time depends on the largest file rather than on the
+        sum of all files, and no file is held in memory as a whole. With max_workers=1 files are
+        streamed one after another in the current process.
+
+        Args:
+            blobs (list): Blobs of the account files.
+            loaded_model: The categorization model, used when files are processed in this process.
+            watermarks (WatermarkStore): Optional watermarks for the incremental mode.
+            max_workers (int): Size of the process pool.
+            model_version (str): Version of `loaded_model`; worker processes load the model and its
+                version themselves.
+
+        Returns:
+            list: Categorized DataFrames of all files.
+    """
+    dfs_to_concat = []
+    watermarks_state = watermarks.state if watermarks is not None else None
+
+    if max_workers <= 1 or len(blobs) <= 1:
+        categories_mapping = create_categories_mapping()
+        for blob in blobs:
+            dfs = stream_account_file(blob, categories_mapping, loaded_model, watermarks, model_version)
+            dfs_to_concat.extend(dfs)
+            print("This many transactions in {}: {}".format(blob.name, sum(len(df) for df in dfs)))
+        return dfs_to_concat
+
+    workers = min(max_workers, len(blobs))
+    # spawn zamiast fork, bo klient GCS i gRPC nie są bezpieczne po fork
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as cpu_pool:
+        results = [cpu_pool.submit(_process_blob, blob.bucket.name, blob.name, blob.generation, watermarks_state)
+                   for blob in blobs]
+        for result in as_completed(results):
+            name, dfs, pending, stages = result.result()
+            dfs_to_concat.extend(dfs)
+            METRICS.merge(stages)
+            if watermarks is not None:
+                watermarks.merge_pending(pending)
+            print("This many transactions in {}: {}".format(name, sum(len(df) for df in dfs)))
+
+    return dfs_to_concat
 
 
 def trend(data):
-    data.drop(columns=['currency', 'institution', 'description'], inplace=True)
-    print(data.head())
+    """
+        Total amount and latest transaction date per label, computed from a full frame.
+
+        function() uses the incrementally maintained TrendStore instead; this is kept for ad-hoc use.
+    """
+    data = data.drop(columns=['currency', 'institution', 'description'])
     result = data.groupby('label').agg({'amount': 'sum', 'date_time': 'max'}).reset_index()
     return result
 
@@ -251,92 +590,280 @@ def get_last_table_load_time(client, dataset_id, table_id):
     return table.modified
 
 
-def get_blob_updated_time(bucket_name, file_name):
-    client = storage.Client(project='bank-account-analysis-412412')
-    bucket = client.bucket(bucket_name)
-    blob = bucket.get_blob(file_name)
-    print('blob w funkcji', blob)
-
-    if blob.exists():
-        return blob.updated
-
-    return None
-
-
 def function(data, context):
     """
        Function to process data from multiple files, assign category labels to transactions,
-       and load the processed data into a BigQuery table.
+       and load the processed data into a BigQuery table (or local Parquet files with SINK=parquet).
 
        Args:
            data: Input data, usually from Cloud Storage triggers.
            context: Metadata about the triggering event.
 
        Note:
-           This function assumes that the data parameter contains information about multiple files,
-           and each file represents a batch of transactions.
+           Account files are discovered by listing the bucket (ACCOUNT_FILES_PREFIX), and each file
+           represents a batch of transactions. Files in the bank-ndjson format (*.ndjson.gz) and in the
+           previous JSON list layout (*.json) are both read as streams.
 
-           It iterates over each file, extracts transaction data, assigns category labels using
-           a pre-trained machine learning model, and concatenates the processed dataframes.
+           The files are processed concurrently with process_files(): transaction data is extracted,
+           category labels are assigned using a pre-trained machine learning model, and the processed
+           dataframes are concatenated once at the end.
 
            The concatenated dataframe is then loaded into a BigQuery table named 'bank_data_table'
            with the load mode set to 'truncate'.
 
-           It also checks the last load time of another table named 'bank_data_trends' and,
-           if the conditions are met, performs additional processing and loads the result into
-           'bank_data_trends' table.
+           With the LOAD_MODE environment variable set to 'incremental', per-account watermarks
+           stored in the bucket are used to keep only transactions that were not loaded before.
+           Only those rows are categorized and appended to 'bank_data_table'; the watermarks are
+           saved after a successful load. While no watermarks are stored yet (the first incremental
+           run, also after switching LOAD_MODE on an existing table), every account file is read and
+           the table is reloaded in full, and the watermarks are seeded from the same rows.
 
+           It also checks the last load time of another table named 'bank_data_trends' and,
+           if the conditions are met, loads the per-label totals into 'bank_data_trends' table.
+           The totals come from a TrendStore of label x institution x month/day aggregates. In the
+           incremental mode the store is kept in the bucket and updated with the new rows only.
+
+           When the event names an object (EVENT_SCOPED=1, the default), only that file is read.
+           Objects that are not account files, such as the state files saved by the function, are ignored
+           before anything is loaded. Every row carries the name of its account file ('source_file').
+           In the 'truncate' mode the rows of that file are replaced in 'bank_data_table', rows of other
+           files of the same institution are kept. BigQuery runs DELETE and INSERT in one transaction;
+           Parquet rewrites the institution partitions holding the file's rows. The file's aggregates in
+           the TrendStore are rebuilt the same way. A *.ndjson.gz file replaces the legacy *.json file of
+           the same user, so the rows of both are replaced together; a legacy file is not read while its
+           *.ndjson.gz successor exists. When the object of the event no longer exists (deleted or
+           renamed), its rows and aggregates are removed. In the 'incremental' mode only the new
+           transactions of the file are appended and rows are never removed; the watermarks keep a
+           migrated history from being loaded twice. Without an object name every account file is
+           processed as before.
+           A table written before 'source_file' existed is reloaded in full once, in either mode.
+
+           Before the model is loaded or any file is downloaded, the fingerprint of every account file is
+           computed from the listing metadata (md5/crc32c and size) and compared with the fingerprints
+           of the last successful run (fingerprints.py). The same is done for the model blob; a new model
+           turns an event-scoped run into a full reload, since it changes the labels of every file. A full
+           run also reloads the table when it was modified after the last recorded load. When nothing
+           changed the function returns right away. In the incremental and event-scoped runs only changed
+           files are read. The processed and skipped file counts are logged with the metrics.
+
+           Every stage (download, parse, extract, model load, rules, predict, concat, load, trend
+           check, ...) is measured with metrics.METRICS; its wall time, rows, bytes and memory are
+           printed as structured JSON logs at the end of the invocation and written to METRICS_OUTPUT
+           when it is set.
        """
-    bucket_name = "bank_data_milo"
-    file_names = ["Jacek Milo PKO_BPKOPLPW.json", "Jacek Milo MBANK_RETAIL_BREXPLPW.json"]
-
-    client = storage.Client(project='bank-account-analysis-412412')
-
-    dfs_to_concat = []
-    bucket = client.get_bucket(bucket_name)
-    # Utworzenie obiektu Blob (pliku) w GCS
-    for file in file_names:
-        blob = bucket.blob(file)
-
-        # Pobranie zawartości pliku
-        file_content = blob.download_as_text()
-
-        # Deserializacja zawartości JSON
-        data = json.loads(file_content)
-
-        categories_mapping = create_categories_mapping()
-
-        df = extractor(data, "Jacek", 1)
-        df = assign_category(df, category_mapping=categories_mapping)
-        dfs_to_concat.append(df)
-        df_final = pd.concat(dfs_to_concat, ignore_index=True)
-
-    print('df_final', df_final.head())
-
-    load(df_final, 'bank_data_table', load_mode='truncate')
+    METRICS.reset()
+    try:
+        run_pipeline(data)
+    finally:
+        # Jedna linia JSON na etap, niezależnie od tego, czy wywołanie się powiodło
+        METRICS.log()
+        METRICS.export()
+
+
+def run_pipeline(data=None):
+    bucket_name, event_name, event_generation = event_target(data)
+    # Pliki stanu i inne obiekty odrzucane są przed pobraniem czegokolwiek
+    if event_name is not None and (not is_account_file(event_name) or event_name.startswith(STATE_PREFIX)):
+        print("Ignoring {}: not an account file".format(event_name))
+        return
+
+    incremental = LOAD_MODE == 'incremental'
+    deleted = False
+    with METRICS.stage('list') as listing:
+        bucket = get_storage_client().bucket(bucket_name)
+        if event_name is not None:
+            blob, deleted = event_blob(bucket, event_name, event_generation)
+            blobs = [blob] if blob is not None else []
+            superseding = ndjson_name(event_name)
+            if blobs and superseding is not None and bucket.get_blob(superseding) is not None:
+                print("Ignoring {}: replaced by {}".format(event_name, superseding))
+                blobs = []
+        else:
+            blobs = list_account_files(bucket)
+        listing.add(rows=len(blobs))
+    if deleted:
+        if incremental:
+            # Tryb przyrostowy tylko dopisuje; po migracji do bank-ndjson historia zostaje pod starą nazwą
+            print("Keeping the rows of {}: the incremental mode does not remove rows".format(event_name))
+            return
+        if not table_outdated('bank_data_table'):
+            # Usunięty (albo przemianowany) plik nie może zostawić swoich wierszy w tabeli
+            remove_sources(bucket, [event_name])
+            return
+        blobs = list_account_files(bucket)
+    if not blobs:
+        return
+    print("Account files:", [blob.name for blob in blobs])
+
+    with METRICS.stage('state_load'):
+        watermarks = WatermarkStore.load(bucket) if incremental else None
+        outdated = table_outdated('bank_data_table')
+    if outdated:
+        print("bank_data_table has no source_file column, reloading it in full")
+        if incremental:
+            watermarks = WatermarkStore()
+    # Pierwsze wywołanie przyrostowe (np. po zmianie LOAD_MODE na istniejącej tabeli) przeładowuje tabelę
+    # w całości i zapisuje znaczniki tych samych wierszy, zamiast dopisywać całą historię drugi raz
+    seeding = incremental and not watermarks.state
+    if (seeding or outdated) and event_name is not None:
+        with METRICS.stage('list') as listing:
+            blobs = list_account_files(bucket)
+            listing.add(rows=len(blobs))
+        if not incremental:
+            event_name = None
+
+    # Odciski z metadanych listingu: niezmienione pliki nie są nawet pobierane
+    with METRICS.stage('change_detection', rows=len(blobs)):
+        fingerprints = FingerprintStore.load(bucket)
+        model_blob = bucket.get_blob(MODEL_FILE_NAME) if MODEL_BUCKET_NAME == bucket_name else \
+            get_storage_client().bucket(MODEL_BUCKET_NAME).get_blob(MODEL_FILE_NAME)
+        # Nowy model zmienia etykiety także niezmienionych plików; w trybie przyrostowym stare wiersze zostają
+        model_changed = not incremental and fingerprints.model_changed(model_blob)
+        if model_changed and event_name is not None:
+            print("Model changed, reprocessing all account files instead of", event_name)
+            blobs = list_account_files(bucket)
+            event_name = None
+        changed = blobs if seeding or outdated else [blob for blob in blobs if fingerprints.is_changed(blob)]
+        if event_name is None:
+            removed = fingerprints.removed(blobs)
+        else:
+            # Plik bank-ndjson zastępuje stary plik .json tego samego użytkownika, także gdy sam się nie zmienił
+            removed = [name for name in event_sources(event_name)[1:]
+                       if name in fingerprints.files and not incremental]
+        if model_changed:
+            changed = blobs
+        if not incremental and event_name is None and fingerprints.table_changed(table_modified()):
+            # Odciski plików opisują tabelę tylko wtedy, gdy nikt jej nie zmienił od ostatniego ładowania
+            print("bank_data_table changed since the last run, reloading it in full")
+            changed = blobs
+        if (changed or removed) and not incremental and event_name is None:
+            # Tabela ładowana jest od nowa, więc potrzebne są wszystkie pliki
+            changed = blobs
+    METRICS.count('files_processed', len(changed))
+    METRICS.count('files_skipped', len(blobs) - len(changed))
+    print("change detection: {} processed, {} skipped, {} removed".format(
+        len(changed), len(blobs) - len(changed), len(removed)))
+    if not changed and not removed:
+        print('No account file changed')
+        return
+    # Odcisk modelu zapisywany jest tylko wtedy, gdy ten model nadał etykiety wszystkim wierszom tabeli
+    relabels_all = seeding or (not incremental and event_name is None)
+    fingerprints.record(changed, model_blob if relabels_all else None, removed)
+
+    with METRICS.stage('model_load'):
+        loaded_model, model_version = load_model_with_version()
+    with METRICS.stage('process_files') as processing:
+        dfs_to_concat = process_files(changed, loaded_model, watermarks, model_version=model_version)
+        processing.add(rows=sum(len(df) for df in dfs_to_concat))
+
+    print('model cache', MODEL_CACHE.stats())
+    print('prediction cache', PREDICTION_CACHE.stats())
+    if USE_MERCHANT_RULES:
+        print('merchant rules', get_rules().stats())
+
+    if incremental:
+        if not dfs_to_concat:
+            print('No new transactions')
+            with METRICS.stage('state_save'):
+                fingerprints.commit()
+                fingerprints.save(bucket)
+            return
+        with METRICS.stage('concat') as concat:
+            df_final = pd.concat(dfs_to_concat, ignore_index=True)
+            concat.add(rows=len(df_final))
+        with METRICS.stage('load', rows=len(df_final)):
+            load(df_final, 'bank_data_table', load_mode='truncate' if seeding else 'append')
+        watermarks.commit()
+        fingerprints.record_table(table_modified())
+        fingerprints.commit()
+        # Agregaty trendów aktualizowane są tylko nowymi wierszami
+        with METRICS.stage('trend_update', rows=len(df_final)):
+            if seeding:
+                trends = TrendStore.from_frame(df_final)
+            else:
+                trends = TrendStore.load(bucket)
+                trends.update(df_final)
+        # Zapis stanu do tego samego bucketa wywoła funkcję ponownie, ale zdarzenia dla plików stanu
+        # są od razu odrzucane
+        with METRICS.stage('state_save'):
+            watermarks.save(bucket)
+            trends.save(bucket)
+            fingerprints.save(bucket)
+    elif event_name is not None:
+        if not dfs_to_concat:
+            # Plik bez transakcji: jego poprzednie wiersze i tak są usuwane
+            print('No transactions in', event_name)
+            dfs_to_concat = [pd.DataFrame(columns=TABLE_COLUMNS)]
+        with METRICS.stage('concat') as concat:
+            df_final = pd.concat(dfs_to_concat, ignore_index=True)
+            concat.add(rows=len(df_final))
+        # Wiersze z tego pliku zastępują poprzednie razem z wierszami zastąpionego pliku .json, w jednej
+        # transakcji; pliki innych użytkowników tej samej instytucji zostają
+        sources = event_sources(event_name) if changed else removed
+        with METRICS.stage('load', rows=len(df_final)):
+            replace(df_final, 'bank_data_table', 'source_file', sources)
+        fingerprints.record_table(table_modified())
+        fingerprints.commit()
+        with METRICS.stage('trend_update', rows=len(df_final)):
+            trends = TrendStore.load(bucket)
+            trends.replace_sources(sources, df_final)
+        with METRICS.stage('state_save'):
+            trends.save(bucket)
+            fingerprints.save(bucket)
+    else:
+        with METRICS.stage('concat') as concat:
+            df_final = pd.concat(dfs_to_concat, ignore_index=True)
+            concat.add(rows=len(df_final))
+        print('df_final', df_final.head())
+        with METRICS.stage('load', rows=len(df_final)):
+            load(df_final, 'bank_data_table', load_mode='truncate')
+        fingerprints.record_table(table_modified())
+        fingerprints.commit()
+        # Tabela jest przeładowywana w całości, więc agregaty budowane są od zera; zapisane są po to,
+        # żeby kolejne wywołania dla pojedynczego pliku podmieniały w nich tylko ten plik
+        with METRICS.stage('trend_update', rows=len(df_final)):
+            trends = TrendStore.from_frame(df_final)
+        with METRICS.stage('state_save'):
+            trends.save(bucket)
+            fingerprints.save(bucket)
+
+    with METRICS.stage('trend_check'):
+        load_trends(trends, changed)
+
+
+def load_trends(trends, blobs):
+    """
+        Load the per-label totals into 'bank_data_trends' when an account file was updated today
+        and the table was not loaded during the last day.
 
-    bigquery_client = bigquery.Client()
-    dataset_id = 'bankData'
+        Args:
+            trends (TrendStore): Aggregates of the loaded transactions.
+            blobs (list): Processed account file blobs; their update time comes from the listing metadata.
+    """
+    sink = get_sink()
     table_id = 'bank_data_trends'
-    current_time = datetime.now()
+    current_time = datetime.now(timezone.utc)
 
-    last_load_time = get_last_table_load_time(bigquery_client, dataset_id, table_id)
+    last_load_time = sink.last_modified(table_id)
     print("last_load_time to bank_data_trends:{}".format(last_load_time))
-    for file_name in file_names:
-        blob_time = get_blob_updated_time(bucket_name, file_name)
-        print("wszedl do pierwszej petli, blob_time:{}".format(blob_time))
-        print("blob_time", blob_time)
+    for blob in blobs:
+        blob_time = blob.updated
+        print("blob_time {}: {}".format(blob.name, blob_time))
 
         if blob_time and blob_time.date() == current_time.date():
-            last_load_time = get_last_table_load_time(bigquery_client, dataset_id, table_id)
-            print("last_load_time to bank_data_trends:{}".format(last_load_time))
-            current_time = datetime.now(timezone.utc)
-            print("current_time", current_time)
-
-            # Sprawdź czy ostatni load był nie wcześniej niż 1 dni temu
-            if last_load_time and (current_time - last_load_time).days >= 1:
-                result = trend(df_final)  # Załóżmy, że df_final jest zdefiniowane gdzieś wcześniej
+            # Sprawdź czy ostatni load był nie wcześniej niż 1 dni temu (albo czy tabela jest jeszcze pusta)
+            if last_load_time is None or (current_time - last_load_time).days >= 1:
+                result = trends.label_totals()
                 result['date_time'] = result['date_time'].astype(str)
 
                 load(result, table_id, load_mode='append')
                 print('loaded to bank_data_trends')
+                break
+
+if PREWARM_MODEL:
+    try:
+        load_model()
+        print('model prewarmed', MODEL_CACHE.stats())
+    except Exception as error:
+        # Brak modelu przy starcie nie może blokować instancji, zostanie załadowany przy wywołaniu
+        print('model prewarm failed:', error)
@@ -0,0 +1,108 @@
+"""
+Rule-based fast path for well known merchants.
+
+Merchant patterns are read from merchant_rules.json (category name -> list of patterns) and compiled
+once into an Aho-Corasick automaton. Every description is scanned in a single pass over its
+characters; a description is labelled by the rules only if all whole-word matches point to one
+category. Everything else is left for the ML model.
+"""
+
+import json
+import os
+import time
+from collections import deque
+
+DEFAULT_RULES_PATH = os.environ.get(
+    "MERCHANT_RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "merchant_rules.json"))
+
+
+class MerchantRules:
+    """
+    Aho-Corasick automaton over case-folded merchant patterns.
+    """
+
+    def __init__(self, rules):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for category, patterns in rules.items():
+            for pattern in patterns:
+                self._add(pattern.casefold(), category)
+        self._build_failure_links()
+        self.counters = {'rule_rows': 0, 'model_rows': 0, 'rule_seconds': 0.0, 'model_seconds': 0.0}
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_RULES_PATH):
+        with open(path, encoding='utf8') as rules_file:
+            return cls(json.load(rules_file))
+
+    def _add(self, pattern, category):
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][char] = next_state
+            state = next_state
+        self._output[state].append((len(pattern), category))
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def match(self, text):
+        """
+            Return the category of `text` if all whole-word pattern matches agree, otherwise None.
+        """
+        if not isinstance(text, str):
+            return None
+        text = text.casefold()
+        goto, fail, output = self._goto, self._fail, self._output
+        categories = set()
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, category in output[state]:
+                start = position - length + 1
+                # Dopasowanie tylko całych słów, 'SPP' nie może trafić w środek innego wyrazu
+                if (start == 0 or not text[start - 1].isalnum()) and \
+                        (position + 1 == len(text) or not text[position + 1].isalnum()):
+                    categories.add(category)
+        if len(categories) == 1:
+            return categories.pop()
+        return None
+
+    def label(self, descriptions):
+        """
+            Return a list with the rule category (or None) for every description.
+        """
+        return [self.match(description) for description in descriptions]
+
+    def stats(self):
+        return dict(self.counters)
+
+
+_rules = None
+
+
+def get_rules():
+    """
+    Return the rules compiled from DEFAULT_RULES_PATH, compiling them on first use.
+    """
+    global _rules
+    if _rules is None:
+        _rules = MerchantRules.from_file()
+    return _rules
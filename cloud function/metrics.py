@@ -0,0 +1,249 @@
+"""
+Per-stage timing and memory metrics of the categorization pipeline.
+
+Every stage of function() runs inside METRICS.stage(name), which records its wall time, the rows
+and bytes it processed and the memory high-water mark. Stages called many times (one call per chunk
+or file) are aggregated into a single entry. At the end of an invocation METRICS.log() prints one
+structured JSON line per stage, which Cloud Logging parses into jsonPayload, and METRICS.snapshot()
+returns the same data as a dict, optionally exported to METRICS_OUTPUT. Plain counts that are not
+stages, such as the number of skipped files, are added with METRICS.count().
+
+With METRICS_TRACE_MEMORY=1 Python allocations are also traced with tracemalloc, which gives the peak
+of every stage separately (the process RSS high-water mark never goes down) at the cost of slower
+allocations.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_OUTPUT = os.environ.get("METRICS_OUTPUT")
+TRACE_MEMORY = os.environ.get("METRICS_TRACE_MEMORY", "0") == "1"
+
+
+def rss_mb():
+    """
+        Current resident set size of the process in MB.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """
+        Highest resident set size of the process so far in MB.
+    """
+    # ru_maxrss jest w KB na Linuksie
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageHandle:
+    """
+    Handle yielded by PipelineMetrics.stage(), used to report what the stage processed.
+    """
+
+    def __init__(self, rows=0, bytes_read=0):
+        self.rows = rows
+        self.bytes_read = bytes_read
+        self.excluded_seconds = 0.0
+
+    def add(self, rows=0, bytes_read=0):
+        self.rows += rows
+        self.bytes_read += bytes_read
+
+    def exclude(self, seconds):
+        """
+            Do not count `seconds` spent inside the stage, e.g. waiting for a stream already
+            reported as another stage.
+        """
+        self.excluded_seconds += seconds
+
+
+class TimedReader:
+    """
+    Wrapper of a binary file-like object counting the time spent in read() and the bytes read.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.seconds = 0.0
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.fp.read(size)
+        self.seconds += time.perf_counter() - start
+        self.bytes_read += len(data)
+        return data
+
+
+class PipelineMetrics:
+    """
+    Collects per-stage metrics of one invocation.
+
+    Args:
+        trace_memory (bool): Trace Python allocations with tracemalloc to get per-stage peaks.
+    """
+
+    def __init__(self, trace_memory=TRACE_MEMORY):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.counters = {}
+        self._traced_peaks = []
+        self.started = time.time()
+        # Pobieranie plików mierzone jest w wątkach puli
+        self._lock = threading.Lock()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        self._traced_peaks = []
+        self.started = time.time()
+
+    @contextmanager
+    def stage(self, name, rows=0, bytes_read=0):
+        """
+            Measure the block as one call of stage `name`.
+
+            Args:
+                name (str): Stage name, e.g. 'download' or 'predict'.
+                rows (int): Rows processed, if known before the stage starts.
+                bytes_read (int): Bytes read, if known before the stage starts.
+
+            Yields:
+                StageHandle: Call handle.add(rows=..., bytes_read=...) when the amounts are known
+                    only inside the stage.
+        """
+        handle = StageHandle(rows, bytes_read)
+        tracing = self._start_tracing()
+        start = time.perf_counter()
+        try:
+            yield handle
+        finally:
+            seconds = time.perf_counter() - start - handle.excluded_seconds
+            traced_peak = self._stop_tracing() if tracing else None
+            self.record(name, seconds, handle.rows, handle.bytes_read, traced_peak)
+
+    def _start_tracing(self):
+        if not self.trace_memory:
+            return False
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self._traced_peaks:
+            # Szczyt etapu nadrzędnego zapamiętywany jest przed wyzerowaniem licznika
+            self._traced_peaks[-1] = max(self._traced_peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self._traced_peaks.append(0)
+        return True
+
+    def _stop_tracing(self):
+        import tracemalloc
+        peak = max(self._traced_peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if self._traced_peaks:
+            self._traced_peaks[-1] = max(self._traced_peaks[-1], peak)
+        else:
+            tracemalloc.stop()
+        return peak / 1024 ** 2
+
+    def record(self, name, seconds, rows=0, bytes_read=0, traced_peak_mb=None):
+        """
+            Add one call of stage `name` measured outside of stage().
+        """
+        current_rss = rss_mb()
+        # statm i ru_maxrss liczone są trochę inaczej, szczyt nie może być niższy od bieżącej wartości
+        peak_rss = max(peak_rss_mb(), current_rss)
+        with self._lock:
+            entry = self.stages.setdefault(name, {
+                'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0, 'bytes': 0,
+                'rss_mb': 0.0, 'peak_rss_mb': 0.0,
+            })
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['rows'] += rows
+            entry['bytes'] += bytes_read
+            entry['rss_mb'] = max(entry['rss_mb'], current_rss)
+            entry['peak_rss_mb'] = max(entry['peak_rss_mb'], peak_rss)
+            if traced_peak_mb is not None:
+                entry['peak_traced_mb'] = max(entry.get('peak_traced_mb', 0.0), traced_peak_mb)
+
+    def count(self, name, value=1):
+        """
+            Add `value` to counter `name`.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, stages):
+        """
+            Add stages collected in another process, e.g. a worker of the process pool.
+
+            Args:
+                stages (dict): The `stages` attribute of the PipelineMetrics of the other process.
+        """
+        for name, other in stages.items():
+            entry = self.stages.get(name)
+            if entry is None:
+                self.stages[name] = dict(other)
+                continue
+            for field in ('calls', 'seconds', 'rows', 'bytes'):
+                entry[field] += other[field]
+            for field in ('max_seconds', 'rss_mb', 'peak_rss_mb', 'peak_traced_mb'):
+                if field in other:
+                    entry[field] = max(entry.get(field, 0.0), other[field])
+
+    def snapshot(self):
+        """
+            Return the collected metrics.
+
+            Returns:
+                dict: Start time, total wall time, per-stage calls, seconds, max_seconds, rows,
+                    bytes, rows_per_second and memory in MB, and the counters.
+        """
+        stages = {}
+        for name, entry in self.stages.items():
+            stage = dict(entry)
+            stage['rows_per_second'] = (round(entry['rows'] / entry['seconds'], 1)
+                                       if entry['seconds'] and entry['rows'] else None)
+            for field in ('seconds', 'max_seconds'):
+                stage[field] = round(stage[field], 4)
+            for field in ('rss_mb', 'peak_rss_mb', 'peak_traced_mb'):
+                if field in stage:
+                    stage[field] = round(stage[field], 1)
+            stages[name] = stage
+        return {
+            'started': self.started,
+            'wall_seconds': round(time.time() - self.started, 4),
+            'stages': stages,
+            'counters': dict(self.counters),
+        }
+
+    def log(self):
+        """
+            Print one structured JSON log line per stage, and one with the counters.
+        """
+        snapshot = self.snapshot()
+        for name, stage in snapshot['stages'].items():
+            print(json.dumps(dict(stage, severity='INFO', message='pipeline stage {}'.format(name), stage=name)))
+        if snapshot['counters']:
+            print(json.dumps(dict(snapshot['counters'], severity='INFO', message='pipeline counters')))
+
+    def export(self, path=METRICS_OUTPUT):
+        """
+            Write snapshot() as JSON to `path`; does nothing when no path is configured.
+        """
+        if not path:
+            return None
+        with open(path, 'w') as output:
+            json.dump(self.snapshot(), output, indent=2)
+        return path
+
+
+METRICS = PipelineMetrics()
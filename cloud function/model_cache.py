@@ -0,0 +1,153 @@
+"""
+Process-wide cache of the categorization model.
+
+The model blob is identified by its GCS generation. As long as the generation does not change,
+the deserialized model is served from memory; after a restart of the instance it is loaded
+from the copy kept on local disk. Only a new generation of the blob triggers a download.
+Lite models (lite_model.py) are recognized by their header and memory-mapped instead of unpickled.
+"""
+
+import os
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", "/tmp/model_cache")
+
+
+def joblib_load(path):
+    # joblib (i sklearn przy odczycie) importowane dopiero przy pierwszym ładowaniu modelu
+    import joblib
+    return joblib.load(path)
+
+
+def load_model_file(path):
+    """
+    Load a lite model (lite_model.py) or a joblib pipeline, depending on the file content.
+
+    Raises:
+        ValueError: The model was trained on another text format than NORMALIZE_TEXT selects.
+    """
+    import lite_model
+    from text_normalizer import check_text_format
+    model = lite_model.load(path) if lite_model.is_lite_file(path) else joblib_load(path)
+    check_text_format(model, path)
+    return model
+
+
+class ModelCache:
+    """
+    Cache of deserialized models keyed by bucket, blob name and blob generation.
+
+    Counters available through stats():
+        memory_hits: model returned from memory.
+        disk_hits: model loaded from the local disk copy, without download.
+        misses: model downloaded from the bucket.
+        download_seconds / load_seconds: total time spent downloading / deserializing.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, loader=load_model_file):
+        self.cache_dir = cache_dir
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'download_seconds': 0.0,
+            'load_seconds': 0.0,
+        }
+
+    def get(self, bucket, file_name):
+        """
+        Return the model stored in `file_name`, downloading and loading it only if its generation changed.
+
+        Args:
+            bucket (google.cloud.storage.Bucket): Bucket holding the model.
+            file_name (str): Name of the model blob.
+
+        Returns:
+            The deserialized model.
+        """
+        return self.get_with_version(bucket, file_name)[0]
+
+    def get_with_version(self, bucket, file_name):
+        """
+        Like get(), but return the generation of the returned model too, e.g. to key predictions by it.
+
+        Returns:
+            tuple: (deserialized model, generation as str).
+        """
+        # Only metadata is fetched here, the content is downloaded when the generation is new
+        blob = bucket.get_blob(file_name)
+        if blob is None:
+            raise FileNotFoundError("Model {} not found in bucket {}".format(file_name, bucket.name))
+
+        key = (bucket.name, file_name)
+        version = str(blob.generation or blob.etag)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._counters['memory_hits'] += 1
+                return entry[1], version
+
+            path = self._local_path(file_name, version)
+            if os.path.exists(path):
+                self._counters['disk_hits'] += 1
+            else:
+                self._counters['misses'] += 1
+                self._download(blob, path)
+
+            start = time.perf_counter()
+            model = self.loader(path)
+            self._counters['load_seconds'] += time.perf_counter() - start
+
+            self._entries[key] = (version, model)
+            self._remove_stale_copies(file_name, version)
+            return model, version
+
+    def stats(self):
+        """
+        Return a copy of the cache counters.
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def clear(self):
+        """
+        Drop all models held in memory. Disk copies are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _local_name(self, file_name):
+        # Bloby z katalogów (np. models/online_sgd.joblib) trzymane są płasko w cache_dir
+        return file_name.replace('/', '__')
+
+    def _local_path(self, file_name, version):
+        return os.path.join(self.cache_dir, "{}.{}".format(self._local_name(file_name), version))
+
+    def _download(self, blob, path):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Procesy puli mogą pobierać ten sam model naraz, więc każdy ma własny plik tymczasowy
+        tmp_path = "{}.{}.part".format(path, os.getpid())
+        start = time.perf_counter()
+        blob.download_to_filename(tmp_path)
+        # Plik pojawia się pod docelową nazwą dopiero po pełnym pobraniu
+        os.replace(tmp_path, path)
+        self._counters['download_seconds'] += time.perf_counter() - start
+
+    def _remove_stale_copies(self, file_name, version):
+        current = os.path.basename(self._local_path(file_name, version))
+        prefix = self._local_name(file_name) + "."
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and name != current and not name.endswith(".part"):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+
+# Jedna instancja na cały proces, współdzielona między wywołaniami funkcji
+MODEL_CACHE = ModelCache()
@@ -0,0 +1,172 @@
+"""
+Memoization of model predictions for repeating transaction descriptions.
+
+Predictions are keyed by the normalized description and an amount bucket, and stored together
+with the version (blob generation) of the model that produced them. Lookups go to an in-memory
+LRU first and then to a SQLite file on local disk; only keys found in neither are sent to the model.
+Entries written by another model version are dropped as soon as a new version is used.
+"""
+
+import math
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_PATH = os.environ.get("PREDICTION_CACHE_PATH", "/tmp/prediction_cache.sqlite")
+DEFAULT_MAX_ENTRIES = int(os.environ.get("PREDICTION_CACHE_SIZE", 100000))
+
+# SQLite ma limit liczby parametrów w jednym zapytaniu
+_QUERY_BATCH = 500
+
+
+def normalize_description(description):
+    if description is None or (isinstance(description, float) and math.isnan(description)):
+        return ''
+    return ' '.join(str(description).casefold().split())
+
+
+def amount_bucket(amount):
+    """
+        Return a coarse bucket of the amount: its sign times the binary order of magnitude.
+    """
+    if amount is None or math.isnan(amount):
+        return 'nan'
+    return str(int(math.copysign(math.floor(math.log2(abs(amount) + 1)), amount)))
+
+
+def cache_key(description, amount):
+    return normalize_description(description) + '|' + amount_bucket(amount)
+
+
+class PredictionCache:
+    """
+    Two-level (LRU + SQLite) cache of labels predicted for a given model version.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.model_version = None
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self.hits = 0
+        self.misses = 0
+
+    def _db(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS predictions "
+                "(key TEXT PRIMARY KEY, model_version TEXT NOT NULL, label INTEGER NOT NULL)")
+        return self._connection
+
+    def set_model_version(self, model_version):
+        """
+            Switch the cache to `model_version`, dropping entries of any other version.
+        """
+        with self._lock:
+            if model_version == self.model_version:
+                return
+            self.model_version = model_version
+            self._lru.clear()
+            with self._db() as db:
+                db.execute("DELETE FROM predictions WHERE model_version != ?", (model_version,))
+
+    def lookup(self, keys):
+        """
+            Return a dict with the cached labels of those `keys` that are known.
+        """
+        found = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    found[key] = self._lru[key]
+                else:
+                    missing.append(key)
+
+            db = self._db()
+            for start in range(0, len(missing), _QUERY_BATCH):
+                batch = missing[start:start + _QUERY_BATCH]
+                rows = db.execute(
+                    "SELECT key, label FROM predictions WHERE model_version = ? AND key IN ({})".format(
+                        ','.join('?' * len(batch))),
+                    [self.model_version] + batch).fetchall()
+                for key, label in rows:
+                    found[key] = label
+                    self._remember(key, label)
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def store(self, labels):
+        """
+            Save a dict of key -> label predicted by the current model version.
+        """
+        with self._lock:
+            for key, label in labels.items():
+                self._remember(key, label)
+            with self._db() as db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO predictions (key, model_version, label) VALUES (?, ?, ?)",
+                    [(key, self.model_version, int(label)) for key, label in labels.items()])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'memory_entries': len(self._lru),
+        }
+
+    def _remember(self, key, label):
+        self._lru[key] = label
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+
+def predict_cached(model, X, cache, model_version):
+    """
+        Predict labels for `X`, sending to the model only rows whose key is not cached.
+
+        Rows sharing a key are predicted once, using the first row with that key.
+
+        Args:
+            model: Fitted model with a predict() method.
+            X (pandas.DataFrame): Model input with 'preprocessed_text' and 'amount' columns.
+            cache (PredictionCache): Cache to use.
+            model_version (str): Version of `model`, e.g. its blob generation.
+
+        Returns:
+            numpy.ndarray: Predicted labels.
+    """
+    cache.set_model_version(model_version)
+    keys = [cache_key(description, amount) for description, amount in zip(X['preprocessed_text'], X['amount'])]
+
+    unique_keys = list(dict.fromkeys(keys))
+    labels = cache.lookup(unique_keys)
+
+    missing_positions = {}
+    for position, key in enumerate(keys):
+        if key not in labels and key not in missing_positions:
+            missing_positions[key] = position
+
+    if missing_positions:
+        predicted = model.predict(X.iloc[list(missing_positions.values())])
+        new_labels = dict(zip(missing_positions.keys(), predicted))
+        cache.store(new_labels)
+        labels.update(new_labels)
+
+    return np.array([labels[key] for key in keys])
+
+
+# Jedna instancja na proces
+PREDICTION_CACHE = PredictionCache()
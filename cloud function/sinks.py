@@ -0,0 +1,355 @@
+"""
+Output sinks for categorized transactions.
+
+BigQuerySink is the original loader of the bankData dataset. ParquetSink writes the same tables to
+a local directory as Parquet with an explicit schema and compact dtypes; bank_data_table is
+partitioned by institution/year/month, so readers can prune partitions and the whole pipeline
+can run offline.
+
+replace() swaps the rows of a slice for new ones, used by event-scoped runs that reprocess a single
+account file: the slice is the rows whose source_file is that file, since several files (users) can
+share an institution. BigQuery deletes and inserts the slice in one transaction; Parquet rewrites the
+institution=<id> partitions holding rows of the slice next to the table and swaps the directories.
+"""
+
+import os
+import shutil
+import uuid
+from datetime import datetime, timezone
+
+import pandas as pd
+
+DATASET_ID = 'bankData'
+PARQUET_ROOT = os.environ.get("PARQUET_ROOT", "/tmp/bank_data")
+
+
+class Sink:
+    """
+    Interface of an output sink.
+    """
+
+    def write(self, df, table, load_mode='truncate'):
+        """
+            Write `df` to `table`, replacing its content ('truncate') or adding to it ('append').
+        """
+        raise NotImplementedError
+
+    def replace(self, df, table, column, values):
+        """
+            Replace the rows of `table` whose `column` is one of `values` with `df`; other rows are kept.
+        """
+        raise NotImplementedError
+
+    def last_modified(self, table):
+        """
+            Return the time of the last write to `table`, or None if it has no data.
+        """
+        raise NotImplementedError
+
+    def columns(self, table):
+        """
+            Return the column names of `table`, or None if it does not exist.
+        """
+        raise NotImplementedError
+
+
+def check_load_mode(load_mode):
+    if load_mode not in ('truncate', 'append'):
+        raise ValueError("Invalid load_mode. Supported values are 'truncate' or 'append'.")
+
+
+class BigQuerySink(Sink):
+    """
+    Loads DataFrames into tables of a BigQuery dataset.
+    """
+
+    def __init__(self, client, dataset_id=DATASET_ID):
+        self.client = client
+        self.dataset_id = dataset_id
+
+    def _table_ref(self, table):
+        return self.client.dataset(self.dataset_id).table(table)
+
+    def table_name(self, table):
+        """
+            Return the quoted full name of `table` for use in queries.
+        """
+        return '`{}.{}.{}`'.format(self.client.project, self.dataset_id, table)
+
+    def write(self, df, table, load_mode='truncate', schema=None):
+        """
+            Write `df` to `table`; with `schema` (e.g. from table_schema()) the columns are converted to it
+            instead of being autodetected.
+        """
+        from google.cloud import bigquery
+        check_load_mode(load_mode)
+
+        if load_mode == 'truncate':
+            write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+        else:
+            write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,  # lub inny format wspierany przez BigQuery
+            write_disposition=write_disposition,
+            autodetect=schema is None
+        )
+        if schema is not None:
+            job_config.schema = schema
+
+        job = self.client.load_table_from_dataframe(df, self._table_ref(table), job_config=job_config)
+
+        job.result()  # Czekaj na zakończenie ładowania danych
+
+        print("Loaded {} rows.".format(job.output_rows))
+
+    def replace(self, df, table, column, values):
+        from google.cloud import bigquery
+        from google.api_core.exceptions import NotFound
+
+        try:
+            self.client.get_table(self._table_ref(table))
+        except NotFound:
+            # Pierwszy zapis, nie ma czego usuwać
+            if not df.empty:
+                self.write(df, table, load_mode='append')
+            return
+
+        condition = '`{}` IN UNNEST(@values)'.format(column)
+        parameters = [bigquery.ArrayQueryParameter('values', 'STRING', [str(value) for value in values])]
+        if df.empty:
+            # Nie ma czego wstawiać, wystarczy usunąć wycinek
+            query = "DELETE FROM {} WHERE {}".format(self.table_name(table), condition)
+            self.client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=parameters)).result()
+            print("Replaced {} = {} with 0 rows.".format(column, list(values)))
+            return
+
+        # Wycinek ładowany jest najpierw do tabeli tymczasowej, a DELETE i INSERT idą w jednej transakcji
+        staging = '{}__staging_{}'.format(table, uuid.uuid4().hex)
+        self.write(df, staging, load_mode='truncate')
+        try:
+            self.swap(table, staging, df.columns, condition, parameters)
+        finally:
+            self.drop(staging)
+        print("Replaced {} = {} with {} rows.".format(column, list(values), len(df)))
+
+    def swap(self, table, staging, columns, condition, query_parameters=()):
+        """
+            Delete the rows of `table` matching the SQL `condition` and insert all rows of the `staging`
+            table in their place, in one transaction.
+
+            Args:
+                columns (list): Columns copied from `staging`.
+                condition (str): WHERE condition; its parameters are passed in `query_parameters`.
+        """
+        from google.cloud import bigquery
+        columns = ', '.join('`{}`'.format(name) for name in columns)
+        query = """
+            BEGIN TRANSACTION;
+            DELETE FROM {target} WHERE {condition};
+            INSERT INTO {target} ({columns}) SELECT {columns} FROM {source};
+            COMMIT TRANSACTION;
+        """.format(target=self.table_name(table), source=self.table_name(staging), condition=condition,
+                   columns=columns)
+        job_config = bigquery.QueryJobConfig(query_parameters=list(query_parameters))
+        self.client.query(query, job_config=job_config).result()
+
+    def drop(self, table):
+        self.client.delete_table(self._table_ref(table), not_found_ok=True)
+
+    def table_schema(self, table):
+        return self.client.get_table(self._table_ref(table)).schema
+
+    def last_modified(self, table):
+        from google.api_core.exceptions import NotFound
+        try:
+            return self.client.get_table(self._table_ref(table)).modified
+        except NotFound:
+            return None
+
+    def columns(self, table):
+        from google.api_core.exceptions import NotFound
+        try:
+            return [field.name for field in self.client.get_table(self._table_ref(table)).schema]
+        except NotFound:
+            return None
+
+
+def table_schemas():
+    import pyarrow as pa
+
+    # Powtarzające się wartości tekstowe zapisywane są słownikowo
+    category = pa.dictionary(pa.int32(), pa.string())
+    return {
+        'bank_data_table': pa.schema([
+            ('date_time', pa.timestamp('ms')),
+            ('amount', pa.float64()),
+            ('currency', category),
+            ('description', pa.string()),
+            ('label', category),
+            ('institution', pa.string()),
+            ('source_file', category),
+            ('year', pa.int16()),
+            ('month', pa.int8()),
+        ]),
+        'bank_data_trends': pa.schema([
+            ('label', pa.string()),
+            ('amount', pa.float64()),
+            ('date_time', pa.string()),
+        ]),
+    }
+
+
+PARTITION_COLUMNS = {
+    'bank_data_table': ['institution', 'year', 'month'],
+}
+
+
+class ParquetSink(Sink):
+    """
+    Writes tables as Parquet datasets under `root`, one directory per table.
+
+    bank_data_table is partitioned as institution=<id>/year=<yyyy>/month=<m>/part-<uuid>.parquet.
+    Directories starting with '.' (staging of replace() and of the backfill) are not part of a table.
+    """
+
+    def __init__(self, root=PARQUET_ROOT):
+        self.root = root
+
+    def table_path(self, table):
+        return os.path.join(self.root, table)
+
+    def _prepare(self, df, table):
+        df = df.copy()
+        if table in PARTITION_COLUMNS:
+            df['date_time'] = pd.to_datetime(df['date_time'])
+            df['year'] = df['date_time'].dt.year.astype('int16')
+            df['month'] = df['date_time'].dt.month.astype('int8')
+        return df
+
+    def write(self, df, table, load_mode='truncate'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        check_load_mode(load_mode)
+
+        path = self.table_path(table)
+        if load_mode == 'truncate' and os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+
+        df = self._prepare(df, table)
+        schema = table_schemas().get(table)
+        if schema is not None:
+            arrow_table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+        else:
+            arrow_table = pa.Table.from_pandas(df, preserve_index=False)
+
+        basename = 'part-{}'.format(uuid.uuid4().hex)
+        partition_cols = PARTITION_COLUMNS.get(table)
+        if partition_cols:
+            pq.write_to_dataset(arrow_table, path, partition_cols=partition_cols,
+                                basename_template=basename + '-{i}.parquet')
+        else:
+            pq.write_table(arrow_table, os.path.join(path, basename + '.parquet'))
+
+        print("Loaded {} rows.".format(arrow_table.num_rows))
+
+    def replace(self, df, table, column, values):
+        partition_cols = PARTITION_COLUMNS.get(table)
+        if not partition_cols:
+            raise ValueError("{} is not partitioned and cannot be replaced by slices".format(table))
+
+        path = self.table_path(table)
+        first = partition_cols[0]
+        # Nowe partycje zapisywane są obok tabeli i podmieniane katalogami, więc czytelnik nie widzi
+        # stanu pośredniego dłużej niż na czas zmiany nazwy
+        staging = os.path.join(self.root, '.staging-{}'.format(uuid.uuid4().hex))
+        try:
+            os.makedirs(staging)
+            if column == first:
+                partitions = [str(value) for value in values]
+                new_rows = df
+            else:
+                # Wycinek po innej kolumnie: przepisywane są całe partycje, w których występuje
+                partitions = self._partitions_with(path, first, column, values)
+                partitions = sorted(set(partitions) | {str(value) for value in df[first].dropna().unique()})
+                kept = [self._read_partition(path, first, value, column, values) for value in partitions]
+                new_rows = pd.concat([part for part in kept if not part.empty] + [df], ignore_index=True)
+            if not new_rows.empty:
+                ParquetSink(staging).write(new_rows, table, load_mode='truncate')
+            os.makedirs(path, exist_ok=True)
+            for value in partitions:
+                partition = '{}={}'.format(first, value)
+                target = os.path.join(path, partition)
+                trash = os.path.join(staging, 'old-' + partition)
+                if os.path.exists(target):
+                    os.replace(target, trash)
+                new_partition = os.path.join(staging, table, partition)
+                if os.path.exists(new_partition):
+                    os.replace(new_partition, target)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        print("Replaced {} = {} with {} rows.".format(column, list(values), len(df)))
+
+    def _partitions_with(self, path, first, column, values):
+        """
+            Return the values of the first partition column whose partitions hold rows with `column` in `values`.
+        """
+        import pyarrow.parquet as pq
+        if not os.path.exists(path):
+            return []
+        values = {str(value) for value in values}
+        found = []
+        for name in sorted(os.listdir(path)):
+            if not name.startswith(first + '='):
+                continue
+            # Czytana jest tylko jedna kolumna
+            stored = pq.read_table(os.path.join(path, name), columns=[column], partitioning=None).column(column)
+            if values & {str(value) for value in stored.unique().to_pylist()}:
+                found.append(name.split('=', 1)[1])
+        return found
+
+    def _read_partition(self, path, first, value, column, values):
+        """
+            Read the rows of partition `first`=`value` whose `column` is not in `values`.
+        """
+        import pyarrow.parquet as pq
+        partition = os.path.join(path, '{}={}'.format(first, value))
+        if not os.path.exists(partition):
+            return pd.DataFrame()
+        # Kolumny partycji (year, month) wyliczane są ponownie przy zapisie
+        df = pq.read_table(partition, partitioning=None).to_pandas()
+        df[first] = value
+        return df[~df[column].astype(str).isin({str(value) for value in values})]
+
+    def last_modified(self, table):
+        mtimes = []
+        has_data = False
+        for directory, _, names in os.walk(self.table_path(table)):
+            # Czas katalogu zmienia się też wtedy, gdy partycja lub plik zostały usunięte
+            mtimes.append(os.path.getmtime(directory))
+            for name in names:
+                if name.endswith('.parquet'):
+                    has_data = True
+                    mtimes.append(os.path.getmtime(os.path.join(directory, name)))
+        if not has_data:
+            return None
+        return datetime.fromtimestamp(max(mtimes), tz=timezone.utc)
+
+    def columns(self, table):
+        import pyarrow.parquet as pq
+        for directory, directories, names in os.walk(self.table_path(table)):
+            directories[:] = sorted(name for name in directories if not name.startswith('.'))
+            for name in sorted(names):
+                if name.endswith('.parquet'):
+                    columns = pq.read_schema(os.path.join(directory, name)).names
+                    return columns + [column for column in PARTITION_COLUMNS.get(table, []) if column not in columns]
+        return None
+
+    def read(self, table, filters=None):
+        """
+            Read `table` back into a DataFrame; `filters` are passed to pyarrow for partition pruning,
+            e.g. [('institution', '=', 'PKO_BPKOPLPW'), ('year', '=', 2024)].
+        """
+        import pyarrow.parquet as pq
+        return pq.read_table(self.table_path(table), filters=filters).to_pandas()
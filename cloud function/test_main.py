@@ -0,0 +1,101 @@
+import os
+import sys
+
+import joblib
+import pandas as pd
+import pytest
+from sklearn.compose import ColumnTransformer
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.extend([os.path.join(ROOT, 'benchmarks'), os.path.join(ROOT, 'application', 'Static_version')])
+
+import main
+from local_gcs import LocalStorageClient
+from sinks import ParquetSink
+from synthetic_data import write_account, write_account_ndjson
+from trend_store import TrendStore
+
+LEGACY = 'Jan Kowalski PKO_BPKOPLPW.json'
+NDJSON = 'Jan Kowalski PKO_BPKOPLPW.ndjson.gz'
+OTHER = 'Anna Nowak PKO_BPKOPLPW.json'
+
+
+def train_model():
+    X = pd.DataFrame({'preprocessed_text': ['biedronka zakupy', 'orlen paliwo', 'lidl zakupy', 'shell paliwo'],
+                      'amount': [-50.0, -200.0, -30.0, -180.0]})
+    preprocessor = ColumnTransformer(transformers=[('text', CountVectorizer(), 'preprocessed_text'),
+                                                   ('numeric', StandardScaler(), ['amount'])])
+    return Pipeline([('preprocessor', preprocessor), ('classifier', LogisticRegression())]).fit(X, [1, 3, 1, 3])
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    client = LocalStorageClient(str(tmp_path / 'gcs'))
+    monkeypatch.setattr(main, '_storage_client', client)
+    monkeypatch.setattr(main, '_sink', ParquetSink(str(tmp_path / 'parquet')))
+    monkeypatch.setattr(main, 'LOAD_MODE', 'truncate')
+    monkeypatch.setattr(main, 'EVENT_SCOPED', True)
+    monkeypatch.setattr(main, 'USE_PREDICTION_CACHE', False)
+    monkeypatch.setattr(main.MODEL_CACHE, 'cache_dir', str(tmp_path / 'model_cache'))
+    main.MODEL_CACHE.clear()
+    bucket = client.bucket(main.BUCKET_NAME)
+    joblib.dump(train_model(), os.path.join(bucket.root, main.MODEL_FILE_NAME))
+    return bucket
+
+
+def event(name):
+    return {'bucket': main.BUCKET_NAME, 'name': name}
+
+
+def table_rows():
+    return main.get_sink().read('bank_data_table')['source_file'].value_counts().to_dict()
+
+
+def trend_rows(bucket):
+    return sum(entry['count'] for entry in TrendStore.load(bucket).monthly.values())
+
+
+def test_ndjson_migration_replaces_the_legacy_file(bucket):
+    write_account(os.path.join(bucket.root, LEGACY), 500)
+    main.run_pipeline()
+    write_account(os.path.join(bucket.root, OTHER), 40, seed=1)
+    main.run_pipeline(event(OTHER))
+    assert table_rows() == {LEGACY: 500, OTHER: 40}
+
+    # Tak jak uploader: najpierw nowy plik, potem usunięcie starego
+    write_account_ndjson(os.path.join(bucket.root, NDJSON), 510)
+    main.run_pipeline(event(NDJSON))
+    assert table_rows() == {NDJSON: 510, OTHER: 40}
+    assert trend_rows(bucket) == 550
+
+    bucket.blob(LEGACY).delete()
+    main.run_pipeline(event(LEGACY))
+    assert table_rows() == {NDJSON: 510, OTHER: 40}
+    assert trend_rows(bucket) == 550
+
+
+def test_legacy_file_is_skipped_while_its_ndjson_exists(bucket):
+    write_account(os.path.join(bucket.root, LEGACY), 500)
+    write_account_ndjson(os.path.join(bucket.root, NDJSON), 510)
+    assert [blob.name for blob in main.list_account_files(bucket)] == [NDJSON]
+
+    main.run_pipeline(event(NDJSON))
+    main.run_pipeline(event(LEGACY))
+    assert table_rows() == {NDJSON: 510}
+
+
+def test_deleted_file_is_removed(bucket):
+    write_account(os.path.join(bucket.root, LEGACY), 100)
+    main.run_pipeline()
+    write_account(os.path.join(bucket.root, OTHER), 40, seed=1)
+    main.run_pipeline(event(OTHER))
+
+    bucket.blob(OTHER).delete()
+    main.run_pipeline(event(OTHER))
+    assert table_rows() == {LEGACY: 100}
+    assert trend_rows(bucket) == 100
+    assert OTHER not in main.FingerprintStore.load(bucket).files
@@ -0,0 +1,128 @@
+"""
+Lightweight text normalizer shared by the training script and the Cloud Function.
+
+The model sees exactly the same text at training and serving time, without loading spaCy:
+descriptions are case-folded, card/terminal noise is removed, the text is tokenized, stop words
+are dropped and the remaining tokens are lemmatized with a lookup table precomputed from spaCy.
+The table (normalizer_table.json) is generated from the training corpus with ML/build_normalizer_table.py
+and is not edited by hand.
+
+NORMALIZE_TEXT is the one setting that selects the model input text for both sides: with 1 the training
+scripts in ML/ and assign_category() pass normalized descriptions to the model, with 0 (the default, as
+long as no table is committed) both pass the raw descriptions. prepare_texts() applies it. The training
+scripts record the format in the model (text_format attribute) and load_model_file() refuses a model
+trained on the other format.
+"""
+
+import json
+import os
+import re
+from functools import lru_cache
+
+# Ten sam przełącznik czytają skrypty treningowe i Cloud Function
+NORMALIZE_TEXT = os.environ.get("NORMALIZE_TEXT", "0") == "1"
+DEFAULT_TABLE_PATH = os.environ.get(
+    "NORMALIZER_TABLE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "normalizer_table.json"))
+
+# Stałe fragmenty opisów PKO/mBank, które nie niosą informacji o sprzedawcy
+NOISE_PATTERNS = [
+    r'numer karty:?\s*\S+',
+    r'nr karty:?\s*\S+',
+    r'\d{4,6}[*x]{4,}\d{4}',
+    r'data (wykonania operacji|transakcji|księgowania):?',
+    r'oryginalna kwota operacji:?',
+    r'(lokalizacja|adres|miasto|kraj|tytuł):',
+    r'(płatność|zakup przy użyciu|transakcja) kart[aąy]\b',
+    r'\d{4}-\d{2}-\d{2}',
+    r'\d{2}[.-]\d{2}[.-]\d{4}',
+    r'\d{1,2}:\d{2}(:\d{2})?',
+    r'\d+[.,]\d{2}\s*(pln|eur|usd|gbp|chf)?',
+]
+NOISE_RE = re.compile('|'.join('(?:{})'.format(pattern) for pattern in NOISE_PATTERNS))
+TOKEN_RE = re.compile(r'\w*\d\w*|[^\W\d_]{2,}')
+
+
+class TextNormalizer:
+    """
+    Normalizer configured with a stop word list and a token -> lemma table.
+    """
+
+    def __init__(self, stop_words=(), lemmas=None):
+        self.stop_words = frozenset(stop_words)
+        self.lemmas = lemmas or {}
+        # Opisy powtarzają się w kółko, więc wynik jest cache'owany per tekst
+        self.normalize = lru_cache(maxsize=65536)(self._normalize)
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_TABLE_PATH):
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                "Normalizer table {} not found; generate it with ML/build_normalizer_table.py".format(path))
+        with open(path, encoding='utf8') as table_file:
+            table = json.load(table_file)
+        return cls(table.get('stop_words', ()), table.get('lemmas', {}))
+
+    def tokens(self, text):
+        """
+            Return case-folded tokens of `text` with the noise removed; tokens containing digits
+            (store, terminal and reference numbers) are skipped.
+        """
+        text = NOISE_RE.sub(' ', text.casefold())
+        return [token for token in TOKEN_RE.findall(text) if not any(char.isdigit() for char in token)]
+
+    def _normalize(self, text):
+        if not isinstance(text, str):
+            return ''
+        lemmas = self.lemmas
+        return ' '.join(lemmas.get(token, token) for token in self.tokens(text) if token not in self.stop_words)
+
+    def normalize_many(self, texts):
+        return [self.normalize(text) for text in texts]
+
+
+_normalizer = None
+
+
+def get_normalizer():
+    """
+    Return the normalizer built from DEFAULT_TABLE_PATH, loading the table on first use.
+    """
+    global _normalizer
+    if _normalizer is None:
+        _normalizer = TextNormalizer.from_file()
+    return _normalizer
+
+
+def normalize(text):
+    return get_normalizer().normalize(text)
+
+
+def normalize_many(texts):
+    return get_normalizer().normalize_many(texts)
+
+
+def text_format(normalize_text=NORMALIZE_TEXT):
+    """
+    Return the name of the model input text format: 'normalized' or 'raw'.
+    """
+    return 'normalized' if normalize_text else 'raw'
+
+
+def check_text_format(model, name='model', normalize_text=NORMALIZE_TEXT):
+    """
+    Raise ValueError when `model` records a text format other than the one selected with NORMALIZE_TEXT.
+    Models without the record (trained before it was added) are accepted.
+    """
+    trained = getattr(model, 'text_format', None)
+    if trained is not None and trained != text_format(normalize_text):
+        raise ValueError("{} was trained on {} text, but NORMALIZE_TEXT selects {} text".format(
+            name, trained, text_format(normalize_text)))
+
+
+def prepare_texts(texts, normalize_text=NORMALIZE_TEXT):
+    """
+    Return the model input text of the descriptions `texts`, in the format selected with NORMALIZE_TEXT.
+    """
+    if normalize_text:
+        return normalize_many(texts)
+    return list(texts)
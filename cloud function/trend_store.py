@@ -0,0 +1,144 @@
+"""
+Incrementally maintained trend aggregates.
+
+Categorized transactions are folded into per label x institution x month and per
+label x institution x day sums (amount, count, latest date_time), kept separately for every source
+account file, so the contribution of one file can be replaced. Updating the store costs O(new rows);
+trend outputs, rolling windows and month-over-month changes are computed from the aggregates alone,
+without scanning the transaction history again.
+"""
+
+import json
+from datetime import timedelta
+
+import pandas as pd
+
+TREND_STORE_BLOB_NAME = "state/trend_aggregates.json"
+# Agregaty dzienne starsze niż to nie są potrzebne do okien kroczących
+DAILY_RETENTION_DAYS = 400
+
+
+def with_source(key):
+    return key if key.count('|') >= 3 else key + '|'
+
+
+class TrendStore:
+    """
+    Monthly and daily aggregates of categorized transactions, serializable to JSON.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        # Klucze label|institution|period|source_file; zapisane przed dodaniem źródła nie mają ostatniego pola
+        self.monthly = {with_source(key): entry for key, entry in state.get('monthly', {}).items()}
+        self.daily = {with_source(key): entry for key, entry in state.get('daily', {}).items()}
+
+    @classmethod
+    def load(cls, bucket, blob_name=TREND_STORE_BLOB_NAME):
+        blob = bucket.get_blob(blob_name)
+        if blob is None:
+            return cls()
+        return cls(json.loads(blob.download_as_text()))
+
+    def save(self, bucket, blob_name=TREND_STORE_BLOB_NAME):
+        blob = bucket.blob(blob_name)
+        blob.upload_from_string(json.dumps({'monthly': self.monthly, 'daily': self.daily}),
+                                content_type='application/json')
+
+    @classmethod
+    def from_frame(cls, df):
+        store = cls()
+        store.update(df)
+        return store
+
+    def update(self, df):
+        """
+            Add newly categorized transactions to the aggregates.
+
+            Args:
+                df (pandas.DataFrame): Rows with 'label', 'institution', 'amount', 'date_time' and
+                    optionally 'source_file'.
+        """
+        if df.empty:
+            return
+        rows = df[['label', 'institution', 'amount', 'date_time']].dropna(subset=['date_time'])
+        date_time = pd.to_datetime(rows['date_time'])
+        source_file = df['source_file'] if 'source_file' in df else ''
+        rows = rows.assign(month=date_time.dt.strftime('%Y-%m'), day=date_time.dt.strftime('%Y-%m-%d'),
+                           date_time=date_time, source_file=source_file)
+
+        for period, aggregates in (('month', self.monthly), ('day', self.daily)):
+            grouped = rows.groupby(['label', 'institution', period, 'source_file']).agg(
+                amount=('amount', 'sum'), count=('amount', 'size'), last=('date_time', 'max'))
+            for (label, institution, key, source), values in grouped.iterrows():
+                entry_key = '|'.join([str(label), str(institution), key, str(source)])
+                entry = aggregates.setdefault(entry_key, {'amount': 0.0, 'count': 0, 'last': None})
+                entry['amount'] += float(values['amount'])
+                entry['count'] += int(values['count'])
+                last = values['last'].isoformat()
+                entry['last'] = max(entry['last'], last) if entry['last'] else last
+
+        self._prune_daily()
+
+    def replace_sources(self, sources, df):
+        """
+            Drop the aggregates of the account files `sources` and rebuild them from `df`, e.g. after
+            one account file was reprocessed; files of other users of the same institution are kept.
+        """
+        sources = {str(source) for source in sources}
+        for aggregates in ('monthly', 'daily'):
+            setattr(self, aggregates, {key: entry for key, entry in getattr(self, aggregates).items()
+                                       if key.split('|', 3)[3] not in sources})
+        self.update(df)
+
+    def _prune_daily(self):
+        days = [key.split('|', 3)[2] for key in self.daily]
+        if not days:
+            return
+        cutoff = (pd.Timestamp(max(days)) - timedelta(days=DAILY_RETENTION_DAYS)).strftime('%Y-%m-%d')
+        self.daily = {key: entry for key, entry in self.daily.items() if key.split('|', 3)[2] >= cutoff}
+
+    def _frame(self, aggregates, period):
+        records = []
+        for key, entry in aggregates.items():
+            label, institution, value, _ = key.split('|', 3)
+            records.append({'label': label, 'institution': institution, period: value,
+                            'amount': entry['amount'], 'count': entry['count'], 'date_time': entry['last']})
+        frame = pd.DataFrame(records, columns=['label', 'institution', period, 'amount', 'count', 'date_time'])
+        frame['date_time'] = pd.to_datetime(frame['date_time'])
+        return frame
+
+    def label_totals(self):
+        """
+            Return the total amount and the latest transaction date per label, in the format
+            previously produced by trend().
+        """
+        monthly = self._frame(self.monthly, 'month')
+        return monthly.groupby('label').agg({'amount': 'sum', 'date_time': 'max'}).reset_index()
+
+    def rolling(self, days, as_of=None, by=('label',)):
+        """
+            Return amount and count per `by` over the last `days` days up to `as_of`
+            (the latest aggregated day by default).
+        """
+        daily = self._frame(self.daily, 'day')
+        if daily.empty:
+            return daily.groupby(list(by))[['amount', 'count']].sum().reset_index()
+        as_of = pd.Timestamp(as_of) if as_of is not None else pd.Timestamp(daily['day'].max())
+        start = (as_of - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        window = daily[(daily['day'] >= start) & (daily['day'] <= as_of.strftime('%Y-%m-%d'))]
+        return window.groupby(list(by))[['amount', 'count']].sum().reset_index()
+
+    def month_over_month(self, by=('label',)):
+        """
+            Return the amount per month and `by`, with the change against the previous month
+            present in the aggregates.
+        """
+        monthly = self._frame(self.monthly, 'month')
+        keys = list(by)
+        result = monthly.groupby(keys + ['month'])['amount'].sum().reset_index().sort_values(keys + ['month'])
+        previous = result.groupby(keys)['amount'].shift(1)
+        result['previous_amount'] = previous
+        result['change'] = result['amount'] - previous
+        result['change_pct'] = result['change'] / previous.abs() * 100
+        return result.reset_index(drop=True)